@@ -10,6 +10,13 @@ while [[ $# -gt 0 ]]; do
             PROFILE_CPU=true
             CPU_PROFILE_OUTPUT_PATH="$2"
             shift 2;;
+        --uuid-table-cache-path)
+            UUID_TABLE_CACHE_PATH="$2"
+            UUID_TABLE_CACHE_ARG="--uuid-table-cache-path /data/phone-number-uuid-table.sqlite"
+            shift 2;;
+        --uuid-table-cache-ttl-days)
+            UUID_TABLE_CACHE_TTL_DAYS_ARG="--uuid-table-cache-ttl-days $2"
+            shift 2;;
         --)
             shift
             break;;
@@ -22,7 +29,8 @@ done
 # Check that the correct number of arguments were provided.
 if [[ $# -ne 5 ]]; then
     echo "Usage: ./docker-run.sh
-    [--profile-cpu <profile-output-path>]
+    [--profile-cpu <profile-output-path>] [--uuid-table-cache-path <uuid-table-cache-path>]
+    [--uuid-table-cache-ttl-days <uuid-table-cache-ttl-days>]
     <google-cloud-credentials-file-path> <pipeline-configuration-file-path> <traced-data-input-path>
     <bossaso-output-path> <baidoa-output-path>"
     exit
@@ -44,6 +52,7 @@ if [[ "$PROFILE_CPU" = true ]]; then
     SYS_PTRACE_CAPABILITY="--cap-add SYS_PTRACE"
 fi
 CMD="pipenv run $PROFILE_CPU_CMD python -u export_undp_rco_contact_lists.py \
+    ${UUID_TABLE_CACHE_ARG} ${UUID_TABLE_CACHE_TTL_DAYS_ARG} \
     /credentials/google-cloud-credentials.json /data/pipeline-configuration.json /data/traced-data.json \
     /data/bossaso-phone-numbers.csv /data/baidoa-phone-numbers.csv
 "
@@ -53,6 +62,9 @@ container="$(docker container create ${SYS_PTRACE_CAPABILITY} -w /app "$IMAGE_NA
 docker cp "$INPUT_GOOGLE_CLOUD_CREDENTIALS" "$container:/credentials/google-cloud-credentials.json"
 docker cp "$INPUT_PIPELINE_CONFIGURATION" "$container:/data/pipeline-configuration.json"
 docker cp "$INPUT_TRACED_DATA" "$container:/data/traced-data.json"
+if [[ -f "$UUID_TABLE_CACHE_PATH" ]]; then
+    docker cp "$UUID_TABLE_CACHE_PATH" "$container:/data/phone-number-uuid-table.sqlite"
+fi
 
 # Run the container
 docker start -a -i "$container"
@@ -62,6 +74,10 @@ mkdir -p "$(dirname "$OUTPUT_BOSSASO")"
 docker cp "$container:/data/bossaso-phone-numbers.csv" "$OUTPUT_BOSSASO"
 mkdir -p "$(dirname "$OUTPUT_BAIDOA")"
 docker cp "$container:/data/baidoa-phone-numbers.csv" "$OUTPUT_BAIDOA"
+if [[ -n "$UUID_TABLE_CACHE_PATH" ]]; then
+    mkdir -p "$(dirname "$UUID_TABLE_CACHE_PATH")"
+    docker cp "$container:/data/phone-number-uuid-table.sqlite" "$UUID_TABLE_CACHE_PATH"
+fi
 
 if [[ "$PROFILE_CPU" = true ]]; then
     mkdir -p "$(dirname "$CPU_PROFILE_OUTPUT_PATH")"
@@ -10,6 +10,12 @@ while [[ $# -gt 0 ]]; do
             PROFILE_CPU=true
             CPU_PROFILE_OUTPUT_PATH="$2"
             shift 2;;
+        --max-concurrent-flows)
+            MAX_CONCURRENT_FLOWS_ARG="--max-concurrent-flows $2"
+            shift 2;;
+        --offline-uuid-table)
+            OFFLINE_UUID_TABLE_ARG="--offline-uuid-table"
+            shift 1;;
         --)
             shift
             break;;
@@ -21,7 +27,7 @@ done
 # Check that the correct number of arguments were provided.
 if [[ $# -ne 4 ]]; then
     echo "Usage: ./docker-run-fetch-raw-data.sh
-    [--profile-cpu <profile-output-path>]
+    [--profile-cpu <profile-output-path>] [--max-concurrent-flows <max-concurrent-flows>] [--offline-uuid-table]
     <user> <google-cloud-credentials-file-path> <pipeline-configuration-file-path>
     <raw-data-dir>"
     exit
@@ -41,7 +47,7 @@ if [[ "$PROFILE_CPU" = true ]]; then
     PROFILE_CPU_CMD="pyflame -o /data/cpu.prof -t"
     SYS_PTRACE_CAPABILITY="--cap-add SYS_PTRACE"
 fi
-CMD="pipenv run $PROFILE_CPU_CMD python -u fetch_raw_data.py \
+CMD="pipenv run $PROFILE_CPU_CMD python -u fetch_raw_data.py ${MAX_CONCURRENT_FLOWS_ARG} ${OFFLINE_UUID_TABLE_ARG} \
     \"$USER\" /credentials/google-cloud-credentials.json \
     /data/pipeline-configuration.json /data/Raw\ Data
 "
@@ -53,12 +59,21 @@ docker cp "$INPUT_PIPELINE_CONFIGURATION" "$container:/data/pipeline-configurati
 mkdir -p "$OUTPUT_RAW_DATA_DIR"
 docker cp "$OUTPUT_RAW_DATA_DIR/." "$container:/data/Raw Data/"
 
-# Run the container
-docker start -a -i "$container"
+# Run the container.
+# Save the exit status rather than exiting immediately if the fetch fails, so that the partial outputs, checkpoint,
+# and raw export logs are still copied out and the next fetch can resume from them.
+status=0
+docker start -a -i "$container" || status=$?
 
 # Copy the output data back out of the container
 docker cp "$container:/data/Raw Data/." "$OUTPUT_RAW_DATA_DIR"
 
+if [[ $status -ne 0 ]]; then
+    echo "Fetch failed with exit status $status. The partial fetch was copied to '$OUTPUT_RAW_DATA_DIR', so re-running \
+this script will resume it"
+    exit $status
+fi
+
 if [[ "$PROFILE_CPU" = true ]]; then
     mkdir -p "$(dirname "$CPU_PROFILE_OUTPUT_PATH")"
     docker cp "$container:/data/cpu.prof" "$CPU_PROFILE_OUTPUT_PATH"
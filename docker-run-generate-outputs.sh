@@ -10,6 +10,43 @@ while [[ $# -gt 0 ]]; do
             PROFILE_CPU=true
             CPU_PROFILE_OUTPUT_PATH="$2"
             shift 2;;
+        --stage-cache-dir)
+            STAGE_CACHE_DIR="$2"
+            STAGE_CACHE_ARG="--stage-cache-dir /data/stage-cache"
+            shift 2;;
+        --max-load-workers)
+            MAX_LOAD_WORKERS_ARG="--max-load-workers $2"
+            shift 2;;
+        --max-stage-workers)
+            MAX_STAGE_WORKERS_ARG="--max-stage-workers $2"
+            shift 2;;
+        --stage-metrics-dir)
+            STAGE_METRICS_DIR="$2"
+            STAGE_METRICS_ARG="--stage-metrics-dir /data/stage-metrics"
+            shift 2;;
+        --profile-stages)
+            PROFILE_STAGES_ARG="--profile-stages"
+            shift 1;;
+        --trace-stage-memory)
+            TRACE_STAGE_MEMORY_ARG="--trace-stage-memory"
+            shift 1;;
+        --field-stats-output-path)
+            FIELD_STATS_OUTPUT_PATH="$2"
+            FIELD_STATS_ARG="--field-stats-output-path /data/output-field-stats.json"
+            shift 2;;
+        --noise-cache-path)
+            NOISE_CACHE_PATH="$2"
+            NOISE_CACHE_ARG="--noise-cache-path /data/noise-cache.json"
+            shift 2;;
+        --drive-upload-manifest-path)
+            DRIVE_UPLOAD_MANIFEST_PATH="$2"
+            DRIVE_UPLOAD_MANIFEST_ARG="--drive-upload-manifest-path /data/drive-upload-manifest.json"
+            shift 2;;
+        --additional-location)
+            ADDITIONAL_LOCATION_CONFIGURATIONS+=("$2")
+            ADDITIONAL_LOCATION_PREV_CODED_DIRS+=("$3")
+            ADDITIONAL_LOCATION_OUTPUT_DIRS+=("$4")
+            shift 4;;
         --)
             shift
             break;;
@@ -22,7 +59,10 @@ done
 # Check that the correct number of arguments were provided.
 if [[ $# -ne 12 ]]; then
     echo "Usage: ./docker-run.sh
-    [--profile-cpu <profile-output-path>]
+    [--profile-cpu <profile-output-path>] [--stage-cache-dir <stage-cache-dir>] [--max-load-workers <n>] [--max-stage-workers <n>]
+    [--stage-metrics-dir <stage-metrics-dir> [--profile-stages] [--trace-stage-memory]] [--drive-upload-manifest-path <manifest-path>]
+    [--field-stats-output-path <field-stats-output-path>] [--noise-cache-path <noise-cache-path>]
+    [--additional-location <pipeline-configuration-file-path> <prev-coded-dir> <output-dir>]...
     <user> <google-cloud-credentials-file-path> <pipeline-configuration-file-path>
     <raw-data-dir> <prev-coded-dir> <messages-json-output-path> <individuals-json-output-path>
     <icr-output-dir> <coded-output-dir> <messages-output-csv> <individuals-output-csv> <production-output-csv>"
@@ -46,12 +86,20 @@ OUTPUT_PRODUCTION_CSV=${12}
 # Build an image for this pipeline stage.
 docker build --build-arg INSTALL_CPU_PROFILER="$PROFILE_CPU" -t "$IMAGE_NAME" .
 
+# Each additional location's files are kept in /data/location-<i>-* in the container.
+ADDITIONAL_LOCATIONS_ARG=""
+for i in "${!ADDITIONAL_LOCATION_CONFIGURATIONS[@]}"; do
+    ADDITIONAL_LOCATIONS_ARG="$ADDITIONAL_LOCATIONS_ARG --additional-location \
+        /data/location-$i-pipeline_configuration.json /data/location-$i-prev-coded /data/location-$i-outputs"
+done
+
 # Create a container from the image that was just built.
 if [[ "$PROFILE_CPU" = true ]]; then
     PROFILE_CPU_CMD="pyflame -o /data/cpu.prof -t"
     SYS_PTRACE_CAPABILITY="--cap-add SYS_PTRACE"
 fi
-CMD="pipenv run $PROFILE_CPU_CMD python -u generate_outputs.py \
+CMD="pipenv run $PROFILE_CPU_CMD python -u generate_outputs.py ${STAGE_CACHE_ARG} ${MAX_LOAD_WORKERS_ARG} ${MAX_STAGE_WORKERS_ARG} ${STAGE_METRICS_ARG} ${PROFILE_STAGES_ARG} ${TRACE_STAGE_MEMORY_ARG} \
+    ${DRIVE_UPLOAD_MANIFEST_ARG} ${FIELD_STATS_ARG} ${NOISE_CACHE_ARG} ${ADDITIONAL_LOCATIONS_ARG} \
     \"$USER\" /credentials/google-cloud-credentials.json /data/pipeline_configuration.json \
     /data/raw-data /data/prev-coded \
     /data/output-messages.jsonl /data/output-individuals.jsonl /data/output-icr /data/coded \
@@ -66,6 +114,54 @@ docker cp "$INPUT_RAW_DATA_DIR" "$container:/data/raw-data"
 if [[ -d "$PREV_CODED_DIR" ]]; then
     docker cp "$PREV_CODED_DIR" "$container:/data/prev-coded"
 fi
+for i in "${!ADDITIONAL_LOCATION_CONFIGURATIONS[@]}"; do
+    docker cp "${ADDITIONAL_LOCATION_CONFIGURATIONS[$i]}" "$container:/data/location-$i-pipeline_configuration.json"
+    if [[ -d "${ADDITIONAL_LOCATION_PREV_CODED_DIRS[$i]}" ]]; then
+        docker cp "${ADDITIONAL_LOCATION_PREV_CODED_DIRS[$i]}" "$container:/data/location-$i-prev-coded"
+    fi
+    if [[ -n "$STAGE_CACHE_DIR" && -d "${ADDITIONAL_LOCATION_OUTPUT_DIRS[$i]}" ]]; then
+        docker cp "${ADDITIONAL_LOCATION_OUTPUT_DIRS[$i]}/." "$container:/data/location-$i-outputs/"
+    elif [[ -d "${ADDITIONAL_LOCATION_OUTPUT_DIRS[$i]}" ]]; then
+        # Copy in the files from the previous run which are read again by this run.
+        # docker cp can only create the outputs directory in the container when copying a directory.
+        STAGING_DIR="$(mktemp -d)"
+        for STATE_FILE in drive_upload_manifest.json noise_cache.json; do
+            if [[ -f "${ADDITIONAL_LOCATION_OUTPUT_DIRS[$i]}/$STATE_FILE" ]]; then
+                cp "${ADDITIONAL_LOCATION_OUTPUT_DIRS[$i]}/$STATE_FILE" "$STAGING_DIR"
+            fi
+        done
+        docker cp "$STAGING_DIR/." "$container:/data/location-$i-outputs/"
+        rm -r "$STAGING_DIR"
+    fi
+done
+if [[ -f "$DRIVE_UPLOAD_MANIFEST_PATH" ]]; then
+    docker cp "$DRIVE_UPLOAD_MANIFEST_PATH" "$container:/data/drive-upload-manifest.json"
+fi
+if [[ -f "$NOISE_CACHE_PATH" ]]; then
+    docker cp "$NOISE_CACHE_PATH" "$container:/data/noise-cache.json"
+fi
+if [[ -n "$STAGE_CACHE_DIR" ]]; then
+    # Copy in the stage cache, and the outputs of the previous run (which are needed to check whether the cached
+    # stages' output files are still up to date).
+    mkdir -p "$STAGE_CACHE_DIR"
+    docker cp "$STAGE_CACHE_DIR/." "$container:/data/stage-cache/"
+    for OUTPUT_FILE in "$OUTPUT_MESSAGES_JSONL:/data/output-messages.jsonl" \
+                       "$OUTPUT_INDIVIDUALS_JSONL:/data/output-individuals.jsonl" \
+                       "$OUTPUT_MESSAGES_CSV:/data/output-messages.csv" \
+                       "$OUTPUT_INDIVIDUALS_CSV:/data/output-individuals.csv" \
+                       "$OUTPUT_PRODUCTION_CSV:/data/output-production.csv" \
+                       "$FIELD_STATS_OUTPUT_PATH:/data/output-field-stats.json"; do
+        if [[ -f "${OUTPUT_FILE%%:/data/*}" ]]; then
+            docker cp "${OUTPUT_FILE%%:/data/*}" "$container:/data/${OUTPUT_FILE##*:/data/}"
+        fi
+    done
+    if [[ -d "$OUTPUT_ICR_DIR" ]]; then
+        docker cp "$OUTPUT_ICR_DIR/." "$container:/data/output-icr/"
+    fi
+    if [[ -d "$OUTPUT_CODED_DIR" ]]; then
+        docker cp "$OUTPUT_CODED_DIR/." "$container:/data/coded/"
+    fi
+fi
 
 # Run the container
 docker start -a -i "$container"
@@ -92,6 +188,36 @@ docker cp "$container:/data/output-messages.csv" "$OUTPUT_MESSAGES_CSV"
 mkdir -p "$(dirname "$OUTPUT_INDIVIDUALS_CSV")"
 docker cp "$container:/data/output-individuals.csv" "$OUTPUT_INDIVIDUALS_CSV"
 
+if [[ -n "$FIELD_STATS_OUTPUT_PATH" ]]; then
+    mkdir -p "$(dirname "$FIELD_STATS_OUTPUT_PATH")"
+    docker cp "$container:/data/output-field-stats.json" "$FIELD_STATS_OUTPUT_PATH"
+fi
+
+for i in "${!ADDITIONAL_LOCATION_OUTPUT_DIRS[@]}"; do
+    mkdir -p "${ADDITIONAL_LOCATION_OUTPUT_DIRS[$i]}"
+    docker cp "$container:/data/location-$i-outputs/." "${ADDITIONAL_LOCATION_OUTPUT_DIRS[$i]}"
+done
+
+if [[ -n "$STAGE_CACHE_DIR" ]]; then
+    docker cp "$container:/data/stage-cache/." "$STAGE_CACHE_DIR"
+fi
+
+if [[ -n "$DRIVE_UPLOAD_MANIFEST_PATH" ]]; then
+    # The manifest is only written if the pipeline configuration requests a Drive upload.
+    docker cp "$container:/data/drive-upload-manifest.json" "$DRIVE_UPLOAD_MANIFEST_PATH" 2>/dev/null || true
+fi
+
+if [[ -n "$NOISE_CACHE_PATH" ]]; then
+    # The cache is only written if there were any messages to classify.
+    mkdir -p "$(dirname "$NOISE_CACHE_PATH")"
+    docker cp "$container:/data/noise-cache.json" "$NOISE_CACHE_PATH" 2>/dev/null || true
+fi
+
+if [[ -n "$STAGE_METRICS_DIR" ]]; then
+    mkdir -p "$STAGE_METRICS_DIR"
+    docker cp "$container:/data/stage-metrics/." "$STAGE_METRICS_DIR"
+fi
+
 if [[ "$PROFILE_CPU" = true ]]; then
     mkdir -p "$(dirname "$CPU_PROFILE_OUTPUT_PATH")"
     docker cp "$container:/data/cpu.prof" "$CPU_PROFILE_OUTPUT_PATH"
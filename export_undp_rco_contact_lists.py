@@ -7,7 +7,7 @@ from core_data_modules.traced_data.io import TracedDataJsonIO
 from id_infrastructure.firestore_uuid_table import FirestoreUuidTable
 from storage.google_cloud import google_cloud_utils
 
-from src.lib import PipelineConfiguration
+from src.lib import PipelineConfiguration, CachedUuidTable
 from src.lib.code_schemes import CodeSchemes
 
 Logger.set_project_name("UNDP-RCO")
@@ -17,6 +17,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generates lists of phone numbers of UNDP-RCO respondents who "
                                                  "reported living in baidoa or bossaso")
 
+    parser.add_argument("--uuid-table-cache-path",
+                        help="Path to a SQLite file to cache phone number <-> uuid mappings in, for re-use by later "
+                             "runs. If not set, all mappings are read from Firestore")
+    parser.add_argument("--uuid-table-cache-ttl-days", type=float,
+                        help="Number of days for which cached phone number <-> uuid mappings may be used before they "
+                             "are re-read from Firestore. If not set, cached mappings never expire")
+
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
                         help="Path to a Google Cloud service account credentials file to use to access the "
                              "credentials bucket")
@@ -37,6 +44,8 @@ if __name__ == "__main__":
     traced_data_path = args.traced_data_path
     bossaso_output_path = args.bossaso_output_path
     baidoa_output_path = args.baidoa_output_path
+    uuid_table_cache_path = args.uuid_table_cache_path
+    uuid_table_cache_ttl_days = args.uuid_table_cache_ttl_days
 
     # Read the settings from the configuration file
     log.info("Loading Pipeline Configuration File...")
@@ -54,6 +63,11 @@ if __name__ == "__main__":
         firestore_uuid_table_credentials,
         "avf-phone-uuid-"
     )
+    if uuid_table_cache_path is not None:
+        phone_number_uuid_table = CachedUuidTable(
+            phone_number_uuid_table, uuid_table_cache_path,
+            ttl=None if uuid_table_cache_ttl_days is None else uuid_table_cache_ttl_days * 24 * 60 * 60
+        )
     log.info("Initialised the Firestore UUID table")
 
     log.info(f"Loading UNDP-RCO traced data from file '{traced_data_path}'...")
@@ -1,19 +1,21 @@
 import argparse
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
-from core_data_modules.cleaners import PhoneCleaner, Codes
-from core_data_modules.cleaners.cleaning_utils import CleaningUtils
 from core_data_modules.logging import Logger
-from core_data_modules.traced_data import Metadata
 from core_data_modules.traced_data.io import TracedDataJsonIO
-from core_data_modules.util import IOUtils, TimeUtils
+from core_data_modules.util import IOUtils
 from id_infrastructure.firestore_uuid_table import FirestoreUuidTable
 from rapid_pro_tools.rapid_pro_client import RapidProClient
 from storage.google_cloud import google_cloud_utils
 from temba_client.v2 import Contact, Run
 
-from src.lib import PipelineConfiguration
-from src.lib.pipeline_configuration import CodeSchemes
+from src.lib import PipelineConfiguration, ConvertedRunsCache, CachedUuidTable, InMemoryUuidTable, SegmentedStore, \
+    OperatorLabeller, FetchCheckpoint
+from src.lib.blob_cache import BlobCache, GoogleCloudStorageBlobSource, LocalDirectoryBlobSource
 
 Logger.set_project_name("UNDP-RCO")
 log = Logger(__name__)
@@ -22,6 +24,26 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Fetches all the raw data for this project from Rapid Pro. "
                                                  "This script must be run from its parent directory.")
 
+    parser.add_argument("--max-concurrent-flows", type=int, default=1,
+                        help="Maximum number of flows to fetch and convert in parallel. Defaults to 1, which fetches "
+                             "each flow in turn")
+
+    parser.add_argument("--uuid-table-cache-ttl-days", type=float,
+                        help="Number of days for which phone number <-> uuid mappings cached in "
+                             "<raw-data-dir>/phone_number_uuid_table.sqlite may be used before they are re-read from "
+                             "Firestore. If not set, cached mappings never expire")
+
+    parser.add_argument("--offline-uuid-table", action="store_true",
+                        help="Don't connect to the Firestore phone number <-> uuid table. Instead, assign uuids "
+                             "locally, and cache them in <raw-data-dir>/phone_number_uuid_table_offline.sqlite. "
+                             "For testing without access to Firestore: the uuids assigned will not match those in "
+                             "Firestore, so are never written to the cache used by online runs")
+
+    parser.add_argument("--blob-source-dir",
+                        help="Read the previous seasons' demog datasets from this local directory instead of from "
+                             "Google Cloud Storage, for testing. The dataset at gs://<bucket>/<path> is read from "
+                             "<blob-source-dir>/<bucket>/<path>")
+
     parser.add_argument("user", help="Identifier of the user launching this program")
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
                         help="Path to a Google Cloud service account credentials file to use to access the "
@@ -37,117 +59,237 @@ if __name__ == "__main__":
     pipeline_configuration_file_path = args.pipeline_configuration_file_path
     google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
     raw_data_dir = args.raw_data_dir
+    max_concurrent_flows = args.max_concurrent_flows
+    uuid_table_cache_ttl_days = args.uuid_table_cache_ttl_days
+    offline_uuid_table = args.offline_uuid_table
+    blob_source_dir = args.blob_source_dir
+
+    assert max_concurrent_flows >= 1, "--max-concurrent-flows must be at least 1"
+    assert not (offline_uuid_table and uuid_table_cache_ttl_days is not None), \
+        "--uuid-table-cache-ttl-days can't be used with --offline-uuid-table, because there is no table to re-read " \
+        "expired mappings from"
 
     # Read the settings from the configuration file
     log.info("Loading Pipeline Configuration File...")
     with open(pipeline_configuration_file_path) as f:
         pipeline_configuration = PipelineConfiguration.from_configuration_file(f)
 
-    log.info("Downloading Rapid Pro access token...")
-    rapid_pro_token = google_cloud_utils.download_blob_to_string(
-        google_cloud_credentials_file_path, pipeline_configuration.rapid_pro_token_file_url).strip()
-
-    log.info("Downloading Firestore UUID Table credentials...")
-    firestore_uuid_table_credentials = json.loads(google_cloud_utils.download_blob_to_string(
-        google_cloud_credentials_file_path,
-        pipeline_configuration.phone_number_uuid_table.firebase_credentials_file_url
-    ))
+    # Download the credentials files in parallel, because each download spends most of its time waiting for
+    # Google Cloud Storage.
+    log.info("Downloading Rapid Pro access token and Firestore UUID Table credentials...")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        rapid_pro_token_future = executor.submit(
+            google_cloud_utils.download_blob_to_string,
+            google_cloud_credentials_file_path, pipeline_configuration.rapid_pro_token_file_url
+        )
+        firestore_uuid_table_credentials_future = None
+        if not offline_uuid_table:
+            firestore_uuid_table_credentials_future = executor.submit(
+                google_cloud_utils.download_blob_to_string,
+                google_cloud_credentials_file_path,
+                pipeline_configuration.phone_number_uuid_table.firebase_credentials_file_url
+            )
+    rapid_pro_token = rapid_pro_token_future.result().strip()
 
-    phone_number_uuid_table = FirestoreUuidTable(
-        pipeline_configuration.phone_number_uuid_table.table_name,
-        firestore_uuid_table_credentials,
-        "avf-phone-uuid-"
+    # The uuids assigned by an offline table don't match those in Firestore, so they are cached in a separate file
+    # from the Firestore mappings, so that they are never used by an online run.
+    if offline_uuid_table:
+        log.warning("Running with an offline uuid table. Phone numbers will be assigned uuids which do not match "
+                    "those in Firestore")
+        uuid_table_backend = InMemoryUuidTable("avf-phone-uuid-")
+        uuid_table_cache_path = f"{raw_data_dir}/phone_number_uuid_table_offline.sqlite"
+    else:
+        uuid_table_backend = FirestoreUuidTable(
+            pipeline_configuration.phone_number_uuid_table.table_name,
+            json.loads(firestore_uuid_table_credentials_future.result()),
+            "avf-phone-uuid-"
+        )
+        uuid_table_cache_path = f"{raw_data_dir}/phone_number_uuid_table.sqlite"
+    phone_number_uuid_table = CachedUuidTable(
+        uuid_table_backend,
+        uuid_table_cache_path,
+        ttl=None if uuid_table_cache_ttl_days is None else uuid_table_cache_ttl_days * 24 * 60 * 60
     )
-    log.info("Initialised the Firestore UUID table")
+    log.info("Initialised the UUID table")
 
     rapid_pro = RapidProClient(pipeline_configuration.rapid_pro_domain, rapid_pro_token)
 
     # Load the previous export of contacts if it exists, otherwise fetch all contacts from Rapid Pro.
+    # Raw contacts are kept in an append-only segmented store. Exports written by earlier versions of this script to
+    # a single json file are migrated to the store the first time they are loaded.
     raw_contacts_path = f"{raw_data_dir}/contacts_raw.json"
     contacts_log_path = f"{raw_data_dir}/contacts_log.jsonl"
-    try:
-        log.info(f"Loading raw contacts from file '{raw_contacts_path}'...")
-        with open(raw_contacts_path) as raw_contacts_file:
-            raw_contacts = [Contact.deserialize(contact_json) for contact_json in json.load(raw_contacts_file)]
+    contacts_store = SegmentedStore(f"{raw_data_dir}/contacts_raw", Contact.deserialize,
+                                    lambda contact: contact.uuid, lambda contact: contact.modified_on)
+    contacts_store.migrate_from_json(raw_contacts_path)
+    if contacts_store.exists():
+        log.info(f"Loading raw contacts from store '{contacts_store.dir_path}'...")
+        raw_contacts = contacts_store.load()
         log.info(f"Loaded {len(raw_contacts)} contacts")
-    except FileNotFoundError:
-        log.info(f"File '{raw_contacts_path}' not found, will fetch all contacts from the Rapid Pro server")
+
+        # Fetch the contacts which have changed since the previous export. Each flow only fetches the contacts again
+        # if they were last synced before that flow's runs were fetched (see export_flow), because each update
+        # re-scans all the contacts and makes another API request.
+        contacts_synced_at = time.monotonic()
+        with open(contacts_log_path, "a") as contacts_log_file:
+            raw_contacts = rapid_pro.update_raw_contacts_with_latest_modified(
+                raw_contacts, raw_export_log_file=contacts_log_file)
+    else:
+        log.info(f"Store '{contacts_store.dir_path}' not found, will fetch all contacts from the Rapid Pro server")
+        contacts_synced_at = time.monotonic()
         with open(contacts_log_path, "a") as contacts_log_file:
             raw_contacts = rapid_pro.get_raw_contacts(raw_export_log_file=contacts_log_file)
 
-    # Download the demog runs from previous seasons
+    # Index the contacts by uuid, so that each flow can look up just the contacts its runs refer to.
+    contacts_by_uuid = {contact.uuid: contact for contact in raw_contacts}
+
+    # Download the demog runs from previous seasons.
+    # These datasets are archived and never change, so they are kept in a local blob cache and are only downloaded
+    # again if the version in Google Cloud Storage changes.
+    if blob_source_dir is None:
+        blob_source = GoogleCloudStorageBlobSource(google_cloud_credentials_file_path)
+    else:
+        log.warning(f"Reading the previous seasons' demog datasets from local directory '{blob_source_dir}'")
+        blob_source = LocalDirectoryBlobSource(blob_source_dir)
+    blob_cache = BlobCache(blob_source, f"{raw_data_dir}/blob_cache")
     for flow in pipeline_configuration.activation_flow_names + pipeline_configuration.survey_flow_names:
         if flow not in {"csap_demog", "csap_s02_demog"}:
             continue
 
-        demog_string = google_cloud_utils.download_blob_to_string(
-            google_cloud_credentials_file_path, f"gs://avf-project-datasets/2019/UNDP-RCO/{flow}.jsonl"
-        )
         traced_runs_output_path = f"{raw_data_dir}/{flow}.jsonl"
         log.info(f"Saving {flow} to file '{traced_runs_output_path}'...")
-        with open(traced_runs_output_path, "w") as traced_runs_output_file:
-            traced_runs_output_file.write(demog_string)
+        if blob_cache.download_to_file(f"gs://avf-project-datasets/2019/UNDP-RCO/{flow}.jsonl",
+                                       traced_runs_output_path):
+            log.info(f"Saved {flow}")
+        else:
+            log.info(f"File '{traced_runs_output_path}' is already up to date")
 
-    # Download all the runs for each of the other surveys
-    for flow in pipeline_configuration.activation_flow_names + pipeline_configuration.survey_flow_names:
-        if flow in {"csap_demog", "csap_s02_demog"}:
-            continue
+    # Download all the runs for each of the other surveys.
+    # Each flow is exported by export_flow, which may be run for several flows at once on a bounded pool of worker
+    # threads. Flows only share the contacts index, so updates to that (and to the contacts log) are serialised with
+    # a lock. All the other state, including each flow's raw export log, is private to that flow.
+    contacts_lock = threading.Lock()
+    operator_labeller = OperatorLabeller(phone_number_uuid_table, f"{raw_data_dir}/operator_codes.json")
+    stores = [contacts_store]  # Segmented stores which may be compacting in the background
+    stores_lock = threading.Lock()
+
+    # Flows which completed in an earlier, interrupted attempt at this fetch are skipped, and a flow which was
+    # interrupted part way through resumes from the runs it had already logged to its raw export log.
+    checkpoint = FetchCheckpoint(f"{raw_data_dir}/fetch_checkpoint.json")
+
+    def merge_runs(runs, new_runs):
+        """
+        Adds new_runs to runs, replacing any runs with the same id by the version with the latest modified_on.
+        """
+        runs_lut = {run.id: run for run in runs}
+        for run in new_runs:
+            if run.id not in runs_lut or run.modified_on > runs_lut[run.id].modified_on:
+                runs_lut[run.id] = run
+        return list(runs_lut.values())
+
+    def export_flow(flow):
+        global raw_contacts, contacts_by_uuid, contacts_synced_at
+
+        if checkpoint.is_flow_complete(flow):
+            log.info(f"Skipping flow '{flow}' because it was completed by an earlier attempt at this fetch")
+            return
+
+        # Give each worker its own client, so that no HTTP session state is shared between threads.
+        flow_rapid_pro = RapidProClient(pipeline_configuration.rapid_pro_domain, rapid_pro_token)
 
         runs_log_path = f"{raw_data_dir}/{flow}_log.jsonl"
         raw_runs_path = f"{raw_data_dir}/{flow}_raw.json"
         traced_runs_output_path = f"{raw_data_dir}/{flow}.jsonl"
         log.info(f"Exporting flow '{flow}' to '{traced_runs_output_path}'...")
 
-        flow_id = rapid_pro.get_flow_id(flow)
+        runs_store = SegmentedStore(f"{raw_data_dir}/{flow}_raw", Run.deserialize,
+                                    lambda run: run.id, lambda run: run.modified_on)
+        runs_store.migrate_from_json(raw_runs_path)
+        with stores_lock:
+            stores.append(runs_store)
+
+        flow_id = flow_rapid_pro.get_flow_id(flow)
 
         # Load the previous export of runs for this flow, and update them with the newest runs.
         # If there is no previous export for this flow, fetch all the runs from Rapid Pro.
         with open(runs_log_path, "a") as raw_runs_log_file:
-            try:
-                log.info(f"Loading raw runs from file '{raw_runs_path}'...")
-                with open(raw_runs_path) as raw_runs_file:
-                    raw_runs = [Run.deserialize(run_json) for run_json in json.load(raw_runs_file)]
+            raw_runs = []
+            if runs_store.exists():
+                log.info(f"Loading raw runs from store '{runs_store.dir_path}'...")
+                raw_runs = runs_store.load()
                 log.info(f"Loaded {len(raw_runs)} runs")
-                raw_runs = rapid_pro.update_raw_runs_with_latest_modified(
+
+            range_start_inclusive = max(run.modified_on for run in raw_runs) if len(raw_runs) > 0 else None
+            resume_state = checkpoint.start_flow(flow, runs_log_path, range_start_inclusive)
+            if resume_state is not None:
+                resume_log_offset, range_start_inclusive = resume_state
+                try:
+                    logged_runs = FetchCheckpoint.read_logged_objects(runs_log_path, resume_log_offset,
+                                                                      Run.deserialize)
+                except ValueError as e:
+                    log.warning(f"Not resuming flow '{flow}' from its raw export log, because the log is corrupt: {e}")
+                    logged_runs = []
+
+                if not FetchCheckpoint.is_contiguous_range(logged_runs, lambda run: run.modified_on,
+                                                           range_start_inclusive):
+                    log.warning(f"Not resuming flow '{flow}' from its raw export log, because the runs logged by the "
+                                f"interrupted fetch are not a contiguous range of runs modified since "
+                                f"{range_start_inclusive}")
+                    logged_runs = []
+
+                if len(logged_runs) > 0:
+                    # The runs logged by the interrupted attempt include every run modified between the earliest and
+                    # latest logged modified_on. Fetch the runs between the start of the interrupted attempt's range
+                    # and the earliest logged run here; the update below fetches the runs modified after the latest
+                    # logged run.
+                    log.info(f"Resuming flow '{flow}' from {len(logged_runs)} runs logged by an interrupted fetch...")
+                    gap_runs = flow_rapid_pro.get_raw_runs_for_flow_id(
+                        flow_id,
+                        range_start_inclusive=range_start_inclusive,
+                        range_end_exclusive=logged_runs[-1].modified_on + timedelta(microseconds=1),
+                        raw_export_log_file=raw_runs_log_file
+                    )
+                    raw_runs = merge_runs(raw_runs, logged_runs + gap_runs)
+
+            if len(raw_runs) > 0:
+                raw_runs = flow_rapid_pro.update_raw_runs_with_latest_modified(
                     flow_id, raw_runs, raw_export_log_file=raw_runs_log_file)
-            except FileNotFoundError:
-                log.info(f"File '{raw_runs_path}' not found, will fetch all runs from the Rapid Pro server for flow '{flow}'")
-                raw_runs = rapid_pro.get_raw_runs_for_flow_id(flow_id, raw_export_log_file=raw_runs_log_file)
+            else:
+                log.info(f"No previous export of runs found, will fetch all runs from the Rapid Pro server "
+                         f"for flow '{flow}'")
+                raw_runs = flow_rapid_pro.get_raw_runs_for_flow_id(flow_id, raw_export_log_file=raw_runs_log_file)
+        runs_fetched_at = time.monotonic()
 
-        # Fetch the latest contacts from Rapid Pro.
-        with open(contacts_log_path, "a") as raw_contacts_log_file:
-            raw_contacts = rapid_pro.update_raw_contacts_with_latest_modified(raw_contacts,
-                                                                              raw_export_log_file=raw_contacts_log_file)
+        # Select the contacts these runs refer to from the contacts index. Contacts may have been created or modified
+        # since the contacts were last synced, e.g. while this flow's runs were being fetched, so if the last sync
+        # started before these runs were fetched, fetch the contacts modified since then first. A sync started by
+        # another flow after these runs were fetched is re-used.
+        with contacts_lock:
+            if contacts_synced_at < runs_fetched_at:
+                log.info(f"Fetching the contacts modified since the last sync before converting flow '{flow}'...")
+                contacts_synced_at = time.monotonic()
+                with open(contacts_log_path, "a") as raw_contacts_log_file:
+                    raw_contacts = flow_rapid_pro.update_raw_contacts_with_latest_modified(
+                        raw_contacts, raw_export_log_file=raw_contacts_log_file)
+                contacts_by_uuid = {contact.uuid: contact for contact in raw_contacts}
+            run_contact_uuids = list(dict.fromkeys(run.contact.uuid for run in raw_runs))
+            flow_raw_contacts = [contacts_by_uuid[contact_uuid] for contact_uuid in run_contact_uuids
+                                 if contact_uuid in contacts_by_uuid]
 
-        # Convert the runs to TracedData.
-        traced_runs = rapid_pro.convert_runs_to_traced_data(
-            user, raw_runs, raw_contacts, phone_number_uuid_table, pipeline_configuration.rapid_pro_test_contact_uuids)
+        # Convert the runs to TracedData, re-using the conversions of runs which haven't changed since the
+        # previous fetch.
+        traced_runs = ConvertedRunsCache.convert_runs_to_traced_data(
+            flow_rapid_pro, user, raw_runs, flow_raw_contacts, phone_number_uuid_table,
+            pipeline_configuration.rapid_pro_test_contact_uuids, f"{raw_data_dir}/{flow}_converted")
 
         # Set the operator codes for each message.
         if flow in pipeline_configuration.activation_flow_names:
-            uuids = {td["avf_phone_id"] for td in traced_runs}
-            uuid_to_phone_lut = phone_number_uuid_table.uuid_to_data_batch(uuids)
-            for td in traced_runs:
-                operator_code = PhoneCleaner.clean_operator(uuid_to_phone_lut[td["avf_phone_id"]])
-                if operator_code == Codes.NOT_CODED:
-                    operator_label = CleaningUtils.make_label_from_cleaner_code(
-                        CodeSchemes.SOMALIA_OPERATOR,
-                        CodeSchemes.SOMALIA_OPERATOR.get_code_with_control_code(Codes.NOT_CODED),
-                        Metadata.get_call_location()
-                    )
-                else:
-                    operator_label = CleaningUtils.make_label_from_cleaner_code(
-                        CodeSchemes.SOMALIA_OPERATOR,
-                        CodeSchemes.SOMALIA_OPERATOR.get_code_with_match_value(operator_code),
-                        Metadata.get_call_location()
-                    )
-                td.append_data({"operator_coded": operator_label.to_dict()},
-                               Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+            operator_labeller.set_operator_codes(user, traced_runs)
 
-        log.info(f"Saving {len(raw_runs)} raw runs to {raw_runs_path}...")
-        with open(raw_runs_path, "w") as raw_runs_file:
-            json.dump([run.serialize() for run in raw_runs], raw_runs_file)
-        log.info(f"Saved {len(raw_runs)} raw runs")
+        log.info(f"Saving {len(raw_runs)} raw runs to {runs_store.dir_path}...")
+        appended_count = runs_store.save(raw_runs)
+        log.info(f"Saved {len(raw_runs)} raw runs ({appended_count} new or modified)")
+        runs_store.compact_in_background()
 
         log.info(f"Saving {len(traced_runs)} traced runs to {traced_runs_output_path}...")
         IOUtils.ensure_dirs_exist_for_file(traced_runs_output_path)
@@ -155,7 +297,27 @@ if __name__ == "__main__":
             TracedDataJsonIO.export_traced_data_iterable_to_jsonl(traced_runs, traced_runs_output_file)
         log.info(f"Saved {len(traced_runs)} traced runs")
 
-    log.info(f"Saving {len(raw_contacts)} raw contacts to file '{raw_contacts_path}'...")
-    with open(raw_contacts_path, "w") as raw_contacts_file:
-        json.dump([contact.serialize() for contact in raw_contacts], raw_contacts_file)
-    log.info(f"Saved {len(raw_contacts)} contacts")
+        checkpoint.complete_flow(flow, [traced_runs_output_path])
+
+    flows_to_export = [flow for flow in pipeline_configuration.activation_flow_names +
+                       pipeline_configuration.survey_flow_names if flow not in {"csap_demog", "csap_s02_demog"}]
+    if max_concurrent_flows == 1:
+        for flow in flows_to_export:
+            export_flow(flow)
+    else:
+        log.info(f"Exporting {len(flows_to_export)} flows, up to {max_concurrent_flows} at a time...")
+        with ThreadPoolExecutor(max_workers=max_concurrent_flows) as executor:
+            # Consume the results in order so that any exception raised by a worker is re-raised here.
+            for _ in executor.map(export_flow, flows_to_export):
+                pass
+
+    log.info(f"Saving {len(raw_contacts)} raw contacts to {contacts_store.dir_path}...")
+    appended_count = contacts_store.save(raw_contacts)
+    log.info(f"Saved {len(raw_contacts)} contacts ({appended_count} new or modified)")
+    contacts_store.compact_in_background()
+
+    log.info("Waiting for raw data stores to finish compacting...")
+    for store in stores:
+        store.wait_for_compaction()
+
+    checkpoint.clear()
@@ -1,17 +1,14 @@
 import argparse
-import json
+import multiprocessing
 import os
 
 from core_data_modules.logging import Logger
-from core_data_modules.traced_data.io import TracedDataJsonIO
-from core_data_modules.util import IOUtils
-from storage.google_cloud import google_cloud_utils
-from storage.google_drive import drive_client_wrapper
 
-from src import CombineRawDatasets, TranslateRapidProKeys, AutoCodeShowMessages, AutoCodeSurveys, ProductionFile, \
-    AnalysisFile, ApplyManualCodes, WSCorrection
+from src import CombineRawDatasets, LocationPipeline
 from src.lib import PipelineConfiguration, MessageFilters
-from src.lib.pipeline_configuration import CodeSchemes
+from src.lib.drive_uploader import GoogleDriveUploadTarget, LocalDirectoryUploadTarget
+from src.lib.stage_graph import PipelineStage, StageGraph, hash_file, hash_files
+from src.lib.stage_metrics import StageMetrics
 
 Logger.set_project_name("UNDP-RCO")
 log = Logger(__name__)
@@ -52,6 +49,54 @@ if __name__ == "__main__":
                         help="Path to a CSV file to write raw message and demographic responses to, for use in "
                              "radio show production"),
 
+    parser.add_argument("--additional-location", nargs=3, action="append", default=[],
+                        metavar=("PIPELINE_CONFIGURATION_FILE", "PREV_CODED_DIR_PATH", "OUTPUT_DIR"),
+                        help="Also generate the outputs for another location, from the same raw data. The raw data is "
+                             "only loaded and combined once, and then each location's stages are run in parallel in a "
+                             "separate process. The outputs for the additional location are written to OUTPUT_DIR, "
+                             "using the same file names as run_scripts/3_generate_outputs.sh. May be repeated")
+    parser.add_argument("--max-load-workers", type=int, default=1,
+                        help="Maximum number of processes to use to load the raw data files. Defaults to 1, which "
+                             "loads each file in turn")
+    parser.add_argument("--max-stage-workers", type=int, default=1,
+                        help="Maximum number of processes that each of the stages which can be run in parallel "
+                             "(the noise classification, and the Coda and ICR exports) may use, per "
+                             "location. Defaults to 1, which runs every "
+                             "stage in a single process")
+    parser.add_argument("--stage-cache-dir",
+                        help="Directory to cache the outputs of each pipeline stage in. If set, stages whose inputs "
+                             "have not changed since a previous run with the same cache directory are skipped")
+
+    parser.add_argument("--stage-metrics-dir",
+                        help="Directory to write a JSON report of the wall time, CPU time, records in and out, "
+                             "and throughput of each stage to. The report for each additional "
+                             "location is written to a sub-directory named after its pipeline configuration file, and the "
+                             "report for the raw data combined for all the locations to the sub-directory 'shared'")
+    parser.add_argument("--profile-stages", action="store_true",
+                        help="Also profile each stage with cProfile, writing the stats to "
+                             "<stage-metrics-dir>/<stage>.prof. Requires --stage-metrics-dir")
+    parser.add_argument("--trace-stage-memory", action="store_true",
+                        help="Also measure the peak memory allocated by each stage with tracemalloc. This slows down "
+                             "every stage. Requires --stage-metrics-dir")
+
+    parser.add_argument("--field-stats-output-path",
+                        help="Path to write a JSON file of the number of values of each raw radio show and survey "
+                             "field which were present, empty and null, and a histogram of their lengths, to. The "
+                             "statistics for each additional location are written to its OUTPUT_DIR")
+    parser.add_argument("--noise-cache-path",
+                        help="Path to a JSON file to cache whether each message text is noise in. If set, only the "
+                             "texts which were not seen in a previous run are classified. The cache for each "
+                             "additional location is written to its OUTPUT_DIR")
+    parser.add_argument("--drive-upload-manifest-path",
+                        help="Path to a json file to record the hashes of the files uploaded to Google Drive in. If "
+                             "set, files which have not changed since they were last uploaded are not uploaded again. "
+                             "The manifest for each additional location is written to its OUTPUT_DIR")
+    parser.add_argument("--max-upload-workers", type=int, default=5,
+                        help="Maximum number of files to upload to Google Drive at once")
+    parser.add_argument("--local-drive-dir",
+                        help="Directory to copy the files to be uploaded to, instead of uploading them to Google "
+                             "Drive, for use in testing")
+
     args = parser.parse_args()
 
     csv_by_message_drive_path = None
@@ -72,133 +117,156 @@ if __name__ == "__main__":
     csv_by_message_output_path = args.csv_by_message_output_path
     csv_by_individual_output_path = args.csv_by_individual_output_path
     production_csv_output_path = args.production_csv_output_path
-
-    # Load the pipeline configuration file
+    stage_cache_dir = args.stage_cache_dir
+    max_load_workers = args.max_load_workers
+    max_stage_workers = args.max_stage_workers
+    stage_metrics_dir = args.stage_metrics_dir
+    profile_stages = args.profile_stages
+    trace_stage_memory = args.trace_stage_memory
+    field_stats_output_path = args.field_stats_output_path
+    noise_cache_path = args.noise_cache_path
+    drive_upload_manifest_path = args.drive_upload_manifest_path
+    max_upload_workers = args.max_upload_workers
+    local_drive_dir = args.local_drive_dir
+
+    assert max_load_workers >= 1, "--max-load-workers must be at least 1"
+    assert max_stage_workers >= 1, "--max-stage-workers must be at least 1"
+    assert stage_metrics_dir is not None or not profile_stages, "--profile-stages requires --stage-metrics-dir"
+    assert stage_metrics_dir is not None or not trace_stage_memory, \
+        "--trace-stage-memory requires --stage-metrics-dir"
+    assert max_upload_workers >= 1, "--max-upload-workers must be at least 1"
+
+    # Load the pipeline configuration files.
     log.info("Loading Pipeline Configuration File...")
     with open(pipeline_configuration_file_path) as f:
         pipeline_configuration = PipelineConfiguration.from_configuration_file(f)
 
-    if pipeline_configuration.drive_upload is not None:
-        log.info(f"Downloading Google Drive service account credentials...")
-        credentials_info = json.loads(google_cloud_utils.download_blob_to_string(
-            google_cloud_credentials_file_path, pipeline_configuration.drive_upload.drive_credentials_file_url))
-        drive_client_wrapper.init_client_from_info(credentials_info)
-
-    # Load messages
-    messages_datasets = []
-    for i, activation_flow_name in enumerate(pipeline_configuration.activation_flow_names):
-        raw_activation_path = f"{raw_data_dir}/{activation_flow_name}.jsonl"
-        log.info(f"Loading {raw_activation_path}...")
-        with open(raw_activation_path, "r") as f:
-            messages = TracedDataJsonIO.import_jsonl_to_traced_data_iterable(f)
-        log.info(f"Loaded {len(messages)} messages")
-        messages_datasets.append(messages)
-
-    log.info("Loading surveys datasets:")
-    surveys_datasets = []
-    for i, survey_flow_name in enumerate(pipeline_configuration.survey_flow_names):
-        raw_survey_path = f"{raw_data_dir}/{survey_flow_name}.jsonl"
-        log.info(f"Loading {raw_survey_path}...")
-        with open(raw_survey_path, "r") as f:
-            contacts = TracedDataJsonIO.import_jsonl_to_traced_data_iterable(f)
-        log.info(f"Loaded {len(contacts)} contacts")
-        surveys_datasets.append(contacts)
-
-    # Add survey data to the messages
-    log.info("Combining Datasets...")
-    coalesced_surveys_datasets = []
-    for dataset in surveys_datasets:
-        coalesced_surveys_datasets.append(CombineRawDatasets.coalesce_traced_runs_by_key(user, dataset, "avf_phone_id"))
-    data = CombineRawDatasets.combine_raw_datasets(user, messages_datasets, coalesced_surveys_datasets)
-
-    # Infer which RQA coding plans to use from the operator.
-    # This 'hack' is necessary because the rqa coding plans are still not being set in the configuration json.
-    if pipeline_configuration.filter_operator == "golis":
-        log.info("Running in Bossaso mode")
-        PipelineConfiguration.RQA_CODING_PLANS = PipelineConfiguration.BOSSASO_RQA_CODING_PLANS
+    # (pipeline configuration file path, LocationPipeline, stage cache dir, stage metrics dir) for each location to
+    # generate outputs for
+    locations = [(
+        pipeline_configuration_file_path,
+        LocationPipeline(user, pipeline_configuration, prev_coded_dir_path, messages_json_output_path,
+                         individuals_json_output_path, icr_output_dir, coded_dir_path, csv_by_message_output_path,
+                         csv_by_individual_output_path, production_csv_output_path, drive_upload_manifest_path,
+                         max_stage_workers, field_stats_output_path, noise_cache_path),
+        stage_cache_dir,
+        stage_metrics_dir
+    )]
+    for location_configuration_file_path, location_prev_coded_dir_path, location_output_dir in args.additional_location:
+        with open(location_configuration_file_path) as f:
+            location_configuration = PipelineConfiguration.from_configuration_file(f)
+        assert location_configuration.survey_flow_names == pipeline_configuration.survey_flow_names, \
+            f"The survey flows in '{location_configuration_file_path}' differ from those in " \
+            f"'{pipeline_configuration_file_path}'. Locations can only be run together if they have the same surveys"
+
+        location_name = os.path.splitext(os.path.basename(location_configuration_file_path))[0]
+        locations.append((
+            location_configuration_file_path,
+            LocationPipeline.from_output_dir(user, location_configuration, location_prev_coded_dir_path,
+                                             location_output_dir, max_stage_workers),
+            None if stage_cache_dir is None else os.path.join(stage_cache_dir, location_name),
+            None if stage_metrics_dir is None else os.path.join(stage_metrics_dir, location_name)
+        ))
+
+    # Only create an upload target for the locations whose pipeline configurations request a Drive upload.
+    upload_targets = []
+    for _, location_pipeline, _, _ in locations:
+        if location_pipeline.pipeline_configuration.drive_upload is None:
+            upload_targets.append(None)
+        elif local_drive_dir is not None:
+            upload_targets.append(LocalDirectoryUploadTarget(local_drive_dir))
+        else:
+            upload_targets.append(GoogleDriveUploadTarget(
+                location_pipeline.download_drive_credentials(google_cloud_credentials_file_path)))
+
+    # Every location loads the same raw data: the messages from all the locations' activation flows, and the surveys.
+    activation_flow_names = []
+    for _, location_pipeline, _, _ in locations:
+        for flow_name in location_pipeline.pipeline_configuration.activation_flow_names:
+            if flow_name not in activation_flow_names:
+                activation_flow_names.append(flow_name)
+    survey_flow_names = pipeline_configuration.survey_flow_names
+    raw_data_paths = [f"{raw_data_dir}/{flow_name}.jsonl" for flow_name in activation_flow_names + survey_flow_names]
+
+    def combine_raw_datasets():
+        return CombineRawDatasets.load_and_combine_raw_datasets(user, raw_data_dir, activation_flow_names,
+                                                                survey_flow_names, max_load_workers)
+
+    # When several locations are being run, the raw data is combined once here, before the location processes are
+    # forked, and each location starts from its own copy of the messages from its activation flows.
+    combined_data = None
+
+    def make_location_combine_stage(location_pipeline):
+        def select_location_data():
+            return MessageFilters.filter_flows(combined_data,
+                                               location_pipeline.pipeline_configuration.activation_flow_names)
+        return PipelineStage("combine_raw_datasets", select_location_data, input_paths=raw_data_paths,
+                             cacheable=False)
+
+    # Express each location's pipeline as a graph of stages, so that, if a stage cache directory was given, a re-run
+    # only needs to re-run the stages whose inputs have changed (e.g. only the stages from WS correction onwards if
+    # only the manually coded Coda files have changed).
+    # The pipeline's code is found relative to this script, so that the hash doesn't depend on the working directory.
+    code_hash = hash_files(os.path.dirname(os.path.abspath(__file__)),
+                           ["code_schemes/*.json", "src/**/*.py", "generate_outputs.py"])
+    graphs = []
+    for location_configuration_file_path, location_pipeline, location_stage_cache_dir, location_stage_metrics_dir \
+            in locations:
+        location_pipeline.set_rqa_coding_plans()
+        if len(locations) == 1:
+            combine_stage = PipelineStage("combine_raw_datasets", combine_raw_datasets, input_paths=raw_data_paths)
+        else:
+            combine_stage = make_location_combine_stage(location_pipeline)
+
+        # Every stage's cache key includes a hash of the user, the pipeline configuration, the code schemes and the
+        # pipeline's code, so that changing any of these invalidates all the cached stages.
+        fingerprint = f"{user}:{hash_file(location_configuration_file_path)}:{code_hash}"
+        stage_metrics = None
+        if location_stage_metrics_dir is not None:
+            stage_metrics = StageMetrics(location_stage_metrics_dir, profile_stages, trace_stage_memory)
+        graphs.append(StageGraph(location_pipeline.build_stages(combine_stage), location_stage_cache_dir,
+                                 fingerprint, stage_metrics))
+
+    if len(locations) == 1:
+        graphs[0].run()
     else:
-        assert pipeline_configuration.filter_operator == "hormud", "FilterOperator must be either 'golis' or 'hormud'"
-        log.info("Running in Baidoa mode")
-        PipelineConfiguration.RQA_CODING_PLANS = PipelineConfiguration.BAIDOA_RQA_CODING_PLANS
-
-    if pipeline_configuration.filter_operator is not None:
-        data = MessageFilters.filter_operator(
-            data, "operator_coded",
-            CodeSchemes.SOMALIA_OPERATOR.get_code_with_match_value(pipeline_configuration.filter_operator)
-        )
-
-    log.info("Translating Rapid Pro Keys...")
-    data = TranslateRapidProKeys.translate_rapid_pro_keys(user, data, pipeline_configuration, prev_coded_dir_path)
-
-    log.info("Redirecting WS messages...")
-    data = WSCorrection.move_wrong_scheme_messages(user, data, prev_coded_dir_path)
-
-    log.info("Auto Coding Messages...")
-    data = AutoCodeShowMessages.auto_code_show_messages(user, data, pipeline_configuration, icr_output_dir, coded_dir_path)
-
-    log.info("Exporting production CSV...")
-    data = ProductionFile.generate(data, production_csv_output_path)
-
-    log.info("Auto Coding Surveys...")
-    data = AutoCodeSurveys.auto_code_surveys(user, data, pipeline_configuration, coded_dir_path)
-
-    log.info("Applying Manual Codes from Coda...")
-    data = ApplyManualCodes.apply_manual_codes(user, data, prev_coded_dir_path)
-
-    log.info("Generating Analysis CSVs...")
-    messages_data, individuals_data = AnalysisFile.generate(user, data, csv_by_message_output_path,
-                                                            csv_by_individual_output_path)
-
-    log.info("Writing messages TracedData to file...")
-    IOUtils.ensure_dirs_exist_for_file(messages_json_output_path)
-    with open(messages_json_output_path, "w") as f:
-        TracedDataJsonIO.export_traced_data_iterable_to_jsonl(messages_data, f)
-
-    log.info("Writing individuals TracedData to file...")
-    IOUtils.ensure_dirs_exist_for_file(individuals_json_output_path)
-    with open(individuals_json_output_path, "w") as f:
-        TracedDataJsonIO.export_traced_data_iterable_to_jsonl(individuals_data, f)
+        if any(graph.needs_run() for graph in graphs):
+            if stage_metrics_dir is None:
+                combined_data = combine_raw_datasets()
+            else:
+                combined_data = StageMetrics(os.path.join(stage_metrics_dir, "shared"), profile_stages,
+                                             trace_stage_memory).measure(
+                    "combine_raw_datasets", combine_raw_datasets, [])
+
+        # PipelineConfiguration.RQA_CODING_PLANS is global, so each location needs to be run in its own process.
+        # The processes are forked so that they can share the combined data without it being serialized.
+        fork_context = multiprocessing.get_context("fork")
+        location_processes = []
+        for (location_configuration_file_path, location_pipeline, _, _), graph in zip(locations, graphs):
+            if not graph.needs_run():
+                log.info(f"Skipping location '{location_configuration_file_path}' because all of its cached stage "
+                         f"outputs are still valid")
+                continue
+
+            def run_location(location_pipeline=location_pipeline, graph=graph):
+                location_pipeline.set_rqa_coding_plans()
+                graph.run()
+
+            process = fork_context.Process(target=run_location)
+            process.start()
+            location_processes.append((location_configuration_file_path, process))
+
+        for location_configuration_file_path, process in location_processes:
+            process.join()
+        for location_configuration_file_path, process in location_processes:
+            assert process.exitcode == 0, \
+                f"Generating the outputs for location '{location_configuration_file_path}' failed " \
+                f"(exit code {process.exitcode})"
 
     # Upload to Google Drive, if requested.
-    # Note: This should happen as late as possible in order to reduce the risk of the remainder of the pipeline failing
-    # after a Drive upload has occurred. Failures could result in inconsistent outputs or outputs with no
-    # traced data log.
-    if pipeline_configuration.drive_upload is not None:
-        log.info("Uploading CSVs to Google Drive...")
-
-        production_csv_drive_dir = os.path.dirname(pipeline_configuration.drive_upload.production_upload_path)
-        production_csv_drive_file_name = os.path.basename(pipeline_configuration.drive_upload.production_upload_path)
-        drive_client_wrapper.update_or_create(production_csv_output_path, production_csv_drive_dir,
-                                              target_file_name=production_csv_drive_file_name,
-                                              target_folder_is_shared_with_me=True)
-
-        messages_csv_drive_dir = os.path.dirname(pipeline_configuration.drive_upload.messages_upload_path)
-        messages_csv_drive_file_name = os.path.basename(pipeline_configuration.drive_upload.messages_upload_path)
-        drive_client_wrapper.update_or_create(csv_by_message_output_path, messages_csv_drive_dir,
-                                              target_file_name=messages_csv_drive_file_name,
-                                              target_folder_is_shared_with_me=True)
-
-        individuals_csv_drive_dir = os.path.dirname(pipeline_configuration.drive_upload.individuals_upload_path)
-        individuals_csv_drive_file_name = os.path.basename(pipeline_configuration.drive_upload.individuals_upload_path)
-        drive_client_wrapper.update_or_create(csv_by_individual_output_path, individuals_csv_drive_dir,
-                                              target_file_name=individuals_csv_drive_file_name,
-                                              target_folder_is_shared_with_me=True)
-
-        traced_data_drive_dir = os.path.dirname(pipeline_configuration.drive_upload.messages_traced_data_upload_path)
-        traced_data_drive_file_name = os.path.basename(
-            pipeline_configuration.drive_upload.messages_traced_data_upload_path)
-        drive_client_wrapper.update_or_create(messages_json_output_path, traced_data_drive_dir,
-                                              target_file_name=traced_data_drive_file_name,
-                                              target_folder_is_shared_with_me=True)
-
-        traced_data_drive_dir = os.path.dirname(pipeline_configuration.drive_upload.individuals_traced_data_upload_path)
-        traced_data_drive_file_name = os.path.basename(
-            pipeline_configuration.drive_upload.individuals_traced_data_upload_path)
-        drive_client_wrapper.update_or_create(individuals_json_output_path, traced_data_drive_dir,
-                                              target_file_name=traced_data_drive_file_name,
-                                              target_folder_is_shared_with_me=True)
-    else:
-        log.info("Skipping uploading to Google Drive (because the pipeline configuration json does not contain the key "
-                 "'DriveUploadPaths')")
+    # Note: This should happen as late as possible, and only once every location has succeeded, in order to reduce
+    # the risk of the remainder of the pipeline failing after a Drive upload has occurred.
+    for (_, location_pipeline, _, _), upload_target in zip(locations, upload_targets):
+        location_pipeline.upload_to_drive(upload_target, max_upload_workers)
 
     log.info("Python script complete")
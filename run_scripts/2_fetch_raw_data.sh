@@ -10,6 +10,12 @@ while [[ $# -gt 0 ]]; do
 
             CPU_PROFILE_ARG="--profile-cpu $CPU_PROFILE_OUTPUT_PATH"
             shift 2;;
+        --max-concurrent-flows)
+            MAX_CONCURRENT_FLOWS_ARG="--max-concurrent-flows $2"
+            shift 2;;
+        --offline-uuid-table)
+            OFFLINE_UUID_TABLE_ARG="--offline-uuid-table"
+            shift 1;;
         --)
             shift
             break;;
@@ -19,7 +25,7 @@ while [[ $# -gt 0 ]]; do
 done
 
 if [[ $# -ne 4 ]]; then
-    echo "Usage: ./2_fetch_raw_data.sh [--profile-cpu <cpu-profile-output-path>] <user> <google-cloud-credentials-file-path> <pipeline-configuration-file-path> <data-root>"
+    echo "Usage: ./2_fetch_raw_data.sh [--profile-cpu <cpu-profile-output-path>] [--max-concurrent-flows <max-concurrent-flows>] [--offline-uuid-table] <user> <google-cloud-credentials-file-path> <pipeline-configuration-file-path> <data-root>"
     echo "Fetches all the raw data from Rapid Pro and converts to TracedData"
     exit
 fi
@@ -32,5 +38,5 @@ DATA_ROOT=$4
 mkdir -p "$DATA_ROOT/Raw Data"
 
 cd ..
-./docker-run-fetch-raw-data.sh ${CPU_PROFILE_ARG} \
+./docker-run-fetch-raw-data.sh ${CPU_PROFILE_ARG} ${MAX_CONCURRENT_FLOWS_ARG} ${OFFLINE_UUID_TABLE_ARG} \
     "$USER" "$GOOGLE_CLOUD_CREDENTIALS_FILE_PATH" "$PIPELINE_CONFIGURATION_FILE_PATH" "$DATA_ROOT/Raw Data"
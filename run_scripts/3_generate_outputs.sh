@@ -10,6 +10,29 @@ while [[ $# -gt 0 ]]; do
 
             CPU_PROFILE_ARG="--profile-cpu $CPU_PROFILE_OUTPUT_PATH"
             shift 2;;
+        --stage-cache)
+            USE_STAGE_CACHE=true
+            shift 1;;
+        --max-load-workers)
+            MAX_LOAD_WORKERS_ARG="--max-load-workers $2"
+            shift 2;;
+        --max-stage-workers)
+            MAX_STAGE_WORKERS_ARG="--max-stage-workers $2"
+            shift 2;;
+        --stage-metrics)
+            USE_STAGE_METRICS=true
+            shift 1;;
+        --profile-stages)
+            PROFILE_STAGES_ARG="--profile-stages"
+            shift 1;;
+        --trace-stage-memory)
+            TRACE_STAGE_MEMORY_ARG="--trace-stage-memory"
+            shift 1;;
+        --additional-location)
+            mkdir -p "$3/Coded Coda Files"
+            mkdir -p "$3/Outputs"
+            ADDITIONAL_LOCATION_ARGS+=(--additional-location "$2" "$3/Coded Coda Files" "$3/Outputs")
+            shift 3;;
         --)
             shift
             break;;
@@ -19,7 +42,7 @@ while [[ $# -gt 0 ]]; do
 done
 
 if [[ $# -ne 4 ]]; then
-    echo "Usage: ./3_generate_outputs.sh [--profile-cpu <cpu-profile-output-path>] <user> <google-cloud-credentials-file-path> <pipeline-configuration-file-path> <data-root>"
+    echo "Usage: ./3_generate_outputs.sh [--profile-cpu <cpu-profile-output-path>] [--stage-cache] [--max-load-workers <n>] [--max-stage-workers <n>] [--stage-metrics [--profile-stages] [--trace-stage-memory]] [--additional-location <pipeline-configuration-file-path> <data-root>]... <user> <google-cloud-credentials-file-path> <pipeline-configuration-file-path> <data-root>"
     echo "Generates the outputs needed downstream from raw data files generated by step 2 and uploads to Google Drive"
     exit
 fi
@@ -33,7 +56,11 @@ mkdir -p "$DATA_ROOT/Coded Coda Files"
 mkdir -p "$DATA_ROOT/Outputs"
 
 cd ..
-./docker-run-generate-outputs.sh ${CPU_PROFILE_ARG} \
+./docker-run-generate-outputs.sh ${CPU_PROFILE_ARG} ${MAX_LOAD_WORKERS_ARG} ${MAX_STAGE_WORKERS_ARG} "${ADDITIONAL_LOCATION_ARGS[@]}" ${USE_STAGE_CACHE:+--stage-cache-dir "$DATA_ROOT/Stage Cache"} \
+    ${USE_STAGE_METRICS:+--stage-metrics-dir "$DATA_ROOT/Stage Metrics"} ${PROFILE_STAGES_ARG} ${TRACE_STAGE_MEMORY_ARG} \
+    --drive-upload-manifest-path "$DATA_ROOT/Outputs/drive_upload_manifest.json" \
+    --field-stats-output-path "$DATA_ROOT/Outputs/field_stats.json" \
+    --noise-cache-path "$DATA_ROOT/Outputs/noise_cache.json" \
     "$USER" "$GOOGLE_CLOUD_CREDENTIALS_FILE_PATH" "$PIPELINE_CONFIGURATION_FILE_PATH" \
     "$DATA_ROOT/Raw Data" "$DATA_ROOT/Coded Coda Files/" \
     "$DATA_ROOT/Outputs/messages_traced_data.jsonl" "$DATA_ROOT/Outputs/individuals_traced_data.jsonl" \
@@ -3,6 +3,7 @@ from .apply_manual_codes import ApplyManualCodes
 from .auto_code_show_messages import AutoCodeShowMessages
 from .auto_code_surveys import AutoCodeSurveys
 from .combine_raw_datasets import CombineRawDatasets
+from .location_pipeline import LocationPipeline
 from .production_file import ProductionFile
 from .translate_rapid_pro_keys import TranslateRapidProKeys
 from .ws_correction import WSCorrection
@@ -185,10 +185,6 @@ class AnalysisFile(object):
         )
 
         # Fold data to have one respondent per row
-        to_be_folded = []
-        for td in data:
-            to_be_folded.append(td.copy())
-
         folded_data = FoldTracedData.fold_iterable_of_traced_data(
             user, data, fold_id_fn=lambda td: td["uid"],
             equal_keys=equal_keys, concat_keys=concat_keys, matrix_keys=matrix_keys, bool_keys=bool_keys,
@@ -8,6 +8,7 @@ from core_data_modules.traced_data.io import TracedDataCodaV2IO
 
 from src.lib import PipelineConfiguration
 from src.lib.code_schemes import CodeSchemes
+from src.lib.coda_dataset_cache import CodaDatasetCache
 from src.lib.pipeline_configuration import CodingModes
 
 
@@ -48,20 +49,18 @@ class ApplyManualCodes(object):
             coda_input_path = path.join(coda_input_dir, plan.coda_filename)
 
             for cc in plan.coding_configurations:
+                # Coda files are read through the CodaDatasetCache, which has usually already parsed them in
+                # WSCorrection.
                 f = None
-                try:
-                    if path.exists(coda_input_path):
-                        f = open(coda_input_path, "r")
+                if path.exists(coda_input_path):
+                    f = CodaDatasetCache.open_for_schemes(coda_input_path, [cc.code_scheme])
 
-                    if cc.coding_mode == CodingModes.SINGLE:
-                        TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable(
-                            user, data, plan.id_field, {cc.coded_field: cc.code_scheme}, f)
-                    else:
-                        TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable_multi_coded(
-                            user, data, plan.id_field, {cc.coded_field: cc.code_scheme}, f)
-                finally:
-                    if f is not None:
-                        f.close()
+                if cc.coding_mode == CodingModes.SINGLE:
+                    TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable(
+                        user, data, plan.id_field, {cc.coded_field: cc.code_scheme}, f)
+                else:
+                    TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable_multi_coded(
+                        user, data, plan.id_field, {cc.coded_field: cc.code_scheme}, f)
 
         # Label data for which there is no response as TRUE_MISSING.
         # Label data for which the response is the empty string as NOT_CODED.
@@ -1,11 +1,18 @@
 import random
+import time
+from functools import partial
+from operator import itemgetter
 from os import path
 
 from core_data_modules.logging import Logger
+from core_data_modules.traced_data import Metadata
 from core_data_modules.traced_data.io import TracedDataCSVIO, TracedDataCodaV2IO
 from core_data_modules.util import IOUtils
 
-from src.lib import PipelineConfiguration, MessageFilters, ICRTools
+from src.lib import PipelineConfiguration, MessageFilters, MessageFilterChain, ICRSampler
+from src.lib.export_scheduler import ExportScheduler
+from src.lib.noise_classifier import NoiseClassifier
+from src.lib.field_stats import FieldStats
 
 # from src.lib.channels import Channels
 
@@ -15,48 +22,73 @@ log = Logger(__name__)
 class AutoCodeShowMessages(object):
     SENT_ON_KEY = "sent_on"
     NOISE_KEY = "noise"
+    NOISE_MIN_LENGTH = 10
     ICR_MESSAGES_COUNT = 200
     ICR_SEED = 0
+    # How to stratify the ICR sample: None, "day" (by the date the message was sent on), or "operator".
+    ICR_STRATIFY_BY = None
+    # Whether to only sample the first of each group of messages with identical text for ICR.
+    ICR_DEDUPLICATE_MESSAGES = False
 
-    @staticmethod
-    def log_empty_string_stats(data, raw_fields):
-        for raw_field in raw_fields:
-            total_messages_count = 0
-            empty_string_messages_count = 0
+    @classmethod
+    def _get_icr_stratify_fn(cls):
+        if cls.ICR_STRATIFY_BY is None:
+            return None
+        if cls.ICR_STRATIFY_BY == "day":
+            # The date part of the ISO 8601 sent_on string
+            return lambda td: td[cls.SENT_ON_KEY][:10]
+        assert cls.ICR_STRATIFY_BY == "operator", f"Unknown ICR_STRATIFY_BY '{cls.ICR_STRATIFY_BY}'"
+        return lambda td: td["operator_coded"]["CodeID"]
 
-            for td in data:
-                if raw_field in td:
-                    total_messages_count += 1
-                    if td[raw_field] == "":
-                        empty_string_messages_count += 1
+    @classmethod
+    def _export_coda_file(cls, not_noise, plan, output_path):
+        with open(output_path, "w") as f:
+            TracedDataCodaV2IO.export_traced_data_iterable_to_coda_2(
+                not_noise, plan.raw_field, cls.SENT_ON_KEY, plan.id_field, {}, f
+            )
 
-            log.debug(f"{raw_field}: {empty_string_messages_count} messages were \"\", out "
-                      f"of {total_messages_count} total")
+    @staticmethod
+    def _export_icr_file(icr_messages, plan, icr_output_path):
+        with open(icr_output_path, "w") as f:
+            TracedDataCSVIO.export_traced_data_iterable_to_csv(
+                icr_messages, f, headers=[plan.run_id_field, plan.raw_field]
+            )
 
     @classmethod
-    def auto_code_show_messages(cls, user, data, pipeline_configuration, icr_output_dir, coda_output_dir):
+    def auto_code_show_messages(cls, user, data, pipeline_configuration, icr_output_dir, coda_output_dir,
+                                field_stats_output_path=None, max_workers=1, noise_cache_path=None):
+        # Apply the following filters in a single pass over the messages:
+        message_filters = MessageFilterChain()
+
         # Filter out test messages sent by AVF.
         if pipeline_configuration.filter_test_messages:
-            data = MessageFilters.filter_test_messages(data)
+            message_filters.add_test_messages_filter()
         else:
             log.debug("Not filtering out test messages (because the pipeline configuration json key "
                       "'FilterTestMessages' was set to false)")
 
         # Filter for runs which don't contain a response to any week's question
-        data = MessageFilters.filter_empty_messages(data, [plan.raw_field for plan in PipelineConfiguration.RQA_CODING_PLANS])
+        message_filters.add_empty_messages_filter([plan.raw_field for plan in PipelineConfiguration.RQA_CODING_PLANS])
 
         # Filter out runs sent outwith the project start and end dates
-        data = MessageFilters.filter_time_range(
-            data, cls.SENT_ON_KEY, pipeline_configuration.project_start_date, pipeline_configuration.project_end_date)
-
-        # Skipping auto-assigning noise, as an experiment on this project.
-        # If it turns out we need this, uncomment this block.
-        # for td in data:
-        #     is_noise = True
-        #     for rqa_key in cls.RQA_KEYS:
-        #         if rqa_key in td and not somali.DemographicCleaner.is_noise(td[rqa_key], min_length=10):
-        #             is_noise = False
-        #     td.append_data({cls.NOISE_KEY: is_noise}, Metadata(user, Metadata.get_call_location(), time.time()))
+        message_filters.add_time_range_filter(
+            cls.SENT_ON_KEY, pipeline_configuration.project_start_date, pipeline_configuration.project_end_date)
+
+        data = list(message_filters.filter(data))
+
+        # Label each message with whether it is noise. A message is noise if all of its RQA responses are noise.
+        # Each distinct response is only classified once, and the verdicts are cached between runs if a
+        # noise_cache_path was given.
+        rqa_keys = [plan.raw_field for plan in PipelineConfiguration.RQA_CODING_PLANS]
+        noise_classifier = NoiseClassifier(cls.NOISE_MIN_LENGTH, noise_cache_path, max_workers)
+        verdicts = noise_classifier.classify(td[rqa_key] for td in data for rqa_key in rqa_keys if rqa_key in td)
+        noise_metadata = Metadata(user, Metadata.get_call_location(), time.time())
+        for td in data:
+            is_noise = True
+            for rqa_key in rqa_keys:
+                if rqa_key in td and not verdicts[td[rqa_key]]:
+                    is_noise = False
+            td.append_data({cls.NOISE_KEY: is_noise}, noise_metadata)
 
         # TODO: Label each message with channel keys
         # Channels.set_channel_keys(user, data, cls.SENT_ON_KEY,
@@ -65,51 +97,59 @@ class AutoCodeShowMessages(object):
         # Filter for messages which aren't noise (in order to export to Coda and export for ICR)
         not_noise = MessageFilters.filter_noise(data, cls.NOISE_KEY, lambda x: x)
 
-        # Compute the number of RQA messages that were the empty string
-        log.debug("Counting the number of empty string messages for each raw radio show field...")
+        # Compute the number of RQA and survey messages that were the empty string, in a single pass over the data.
+        # Each participant's survey responses are only counted once.
+        log.debug("Counting the number of empty string messages for each raw radio show and survey field...")
         raw_rqa_fields = []
         for plan in PipelineConfiguration.RQA_CODING_PLANS:
             if plan.raw_field not in raw_rqa_fields:
                 raw_rqa_fields.append(plan.raw_field)
-        cls.log_empty_string_stats(data, raw_rqa_fields)
-
-        # Compute the number of survey messages that were the empty string
-        log.debug("Counting the number of empty string messages for each survey field...")
         raw_survey_fields = []
         for plan in PipelineConfiguration.SURVEY_CODING_PLANS:
             if plan.raw_field not in raw_survey_fields:
                 raw_survey_fields.append(plan.raw_field)
-        survey_data = dict()
+
+        rqa_stats = FieldStats(raw_rqa_fields)
+        survey_stats = FieldStats(raw_survey_fields, group_by_key="uid")
         for td in data:
-            survey_data[td["uid"]] = td
-        cls.log_empty_string_stats(survey_data.values(), raw_survey_fields)
+            rqa_stats.add(td)
+            survey_stats.add(td)
+        rqa_stats.log_stats(log)
+        survey_stats.log_stats(log)
+
+        if field_stats_output_path is not None:
+            log.info(f"Exporting raw field statistics to '{field_stats_output_path}'...")
+            FieldStats.export_to_json_file({"rqa": rqa_stats, "survey": survey_stats}, field_stats_output_path)
+
+        # Output messages which aren't noise to Coda, and a sample of them for ICR, running the export of each file
+        # in parallel. The message ids and ICR samples are computed first, because the exports can't update the data.
+        export_scheduler = ExportScheduler(max_workers)
 
-        # Output messages which aren't noise to Coda
         IOUtils.ensure_dirs_exist(coda_output_dir)
         for plan in PipelineConfiguration.RQA_CODING_PLANS:
             TracedDataCodaV2IO.compute_message_ids(user, not_noise, plan.raw_field, plan.id_field)
 
             output_path = path.join(coda_output_dir, plan.coda_filename)
-            with open(output_path, "w") as f:
-                TracedDataCodaV2IO.export_traced_data_iterable_to_coda_2(
-                    not_noise, plan.raw_field, cls.SENT_ON_KEY, plan.id_field, {}, f
-                )
+            export_scheduler.submit(output_path, partial(cls._export_coda_file, not_noise, plan, output_path))
 
-        # Output messages for ICR
+        # Sample every plan's messages for ICR in a single pass over the messages which aren't noise
         IOUtils.ensure_dirs_exist(icr_output_dir)
+        icr_samplers = []  # of (plan, ICRSampler)
         for plan in PipelineConfiguration.RQA_CODING_PLANS:
-            rqa_messages = []
-            for td in not_noise:
-                if plan.raw_field in td:
-                    rqa_messages.append(td)
+            deduplicate_fn = itemgetter(plan.raw_field) if cls.ICR_DEDUPLICATE_MESSAGES else None
+            icr_samplers.append((plan, ICRSampler(cls.ICR_MESSAGES_COUNT, random.Random(cls.ICR_SEED),
+                                                  cls._get_icr_stratify_fn(), deduplicate_fn)))
 
-            icr_messages = ICRTools.generate_sample_for_icr(
-                rqa_messages, cls.ICR_MESSAGES_COUNT, random.Random(cls.ICR_SEED))
+        for td in not_noise:
+            for plan, icr_sampler in icr_samplers:
+                if plan.raw_field in td:
+                    icr_sampler.add(td)
 
+        for plan, icr_sampler in icr_samplers:
             icr_output_path = path.join(icr_output_dir, plan.icr_filename)
-            with open(icr_output_path, "w") as f:
-                TracedDataCSVIO.export_traced_data_iterable_to_csv(
-                    icr_messages, f, headers=[plan.run_id_field, plan.raw_field]
-                )
+            export_scheduler.submit(icr_output_path, partial(cls._export_icr_file, icr_sampler.get_sample(), plan,
+                                                             icr_output_path))
+
+        export_scheduler.run()
 
         return data
@@ -1,4 +1,5 @@
 import time
+from functools import partial
 from os import path
 
 from core_data_modules.cleaners import Codes
@@ -7,10 +8,11 @@ from core_data_modules.logging import Logger
 from core_data_modules.traced_data import Metadata
 from core_data_modules.traced_data.io import TracedDataCodaV2IO
 from core_data_modules.util import IOUtils
-from dateutil.parser import isoparse
 
 from src.lib.code_schemes import CodeSchemes
+from src.lib.export_scheduler import ExportScheduler
 from src.lib.pipeline_configuration import PipelineConfiguration
+from src.lib.timestamp_index import TimestampIndex
 
 log = Logger(__name__)
 
@@ -18,8 +20,17 @@ log = Logger(__name__)
 class AutoCodeSurveys(object):
     SENT_ON_KEY = "sent_on"
 
+    @staticmethod
+    def _export_coda_file(data, plan, coda_output_path):
+        with open(coda_output_path, "w") as f:
+            TracedDataCodaV2IO.export_traced_data_iterable_to_coda_2(
+                data, plan.raw_field, plan.time_field, plan.id_field,
+                {cc.coded_field: cc.code_scheme for cc in plan.coding_configurations},
+                f
+            )
+
     @classmethod
-    def auto_code_surveys(cls, user, data, pipeline_configuration, coda_output_dir):
+    def auto_code_surveys(cls, user, data, pipeline_configuration, coda_output_dir, max_workers=1):
         # Auto-code surveys
         for plan in PipelineConfiguration.SURVEY_CODING_PLANS:
             for cc in plan.coding_configurations:
@@ -31,16 +42,21 @@ class AutoCodeSurveys(object):
         log.info("Hiding survey messages sent after the end of the project. These will not be exported in "
                  "production/analysis files")
         out_of_range_count = 0
-        for td in data:
-            for plan in PipelineConfiguration.SURVEY_CODING_PLANS:
-                # TODO: Come up with a better solution here e.g. separate DEMOG/SURVEY lists
-                if plan.raw_field in ["have_voice_raw", "suggestions_raw"]:
-                    continue
+        time_indices = dict()  # of time field -> TimestampIndex of data on that field
+        for plan in PipelineConfiguration.SURVEY_CODING_PLANS:
+            # TODO: Come up with a better solution here e.g. separate DEMOG/SURVEY lists
+            if plan.raw_field in ["have_voice_raw", "suggestions_raw"]:
+                continue
 
-                if plan.time_field in td and isoparse(td[plan.time_field]) > pipeline_configuration.project_end_date:
-                    out_of_range_count += 1
-                    td.hide_keys({plan.raw_field, plan.time_field},
-                                 Metadata(user, Metadata.get_call_location(), time.time()))
+            if plan.time_field not in time_indices:
+                time_indices[plan.time_field] = TimestampIndex(data, plan.time_field)
+            for i in time_indices[plan.time_field].select_after(pipeline_configuration.project_end_date):
+                # Skip TracedData whose time field was hidden by an earlier plan with the same time field.
+                if plan.time_field not in data[i]:
+                    continue
+                out_of_range_count += 1
+                data[i].hide_keys({plan.raw_field, plan.time_field},
+                                  Metadata(user, Metadata.get_call_location(), time.time()))
         log.info(f"Hid {out_of_range_count} survey messages sent after the end of the project")
 
         # For any locations where the cleaners assigned a code to a sub district, set the district code to NC
@@ -57,17 +73,15 @@ class AutoCodeSurveys(object):
                     td.append_data({"district_coded": nc_label.to_dict()},
                                    Metadata(user, Metadata.get_call_location(), time.time()))
 
-        # Output survey responses to coda for manual verification + coding
+        # Output survey responses to coda for manual verification + coding, running the export of each file in
+        # parallel. The message ids are computed first, because the exports can't update the data.
         IOUtils.ensure_dirs_exist(coda_output_dir)
+        export_scheduler = ExportScheduler(max_workers)
         for plan in PipelineConfiguration.SURVEY_CODING_PLANS:
             TracedDataCodaV2IO.compute_message_ids(user, data, plan.raw_field, plan.id_field)
 
             coda_output_path = path.join(coda_output_dir, plan.coda_filename)
-            with open(coda_output_path, "w") as f:
-                TracedDataCodaV2IO.export_traced_data_iterable_to_coda_2(
-                    data, plan.raw_field, plan.time_field, plan.id_field,
-                    {cc.coded_field: cc.code_scheme for cc in plan.coding_configurations},
-                    f
-                )
+            export_scheduler.submit(coda_output_path, partial(cls._export_coda_file, data, plan, coda_output_path))
+        export_scheduler.run()
 
         return data
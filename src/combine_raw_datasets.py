@@ -1,29 +1,129 @@
-from core_data_modules.traced_data import TracedData, Metadata
+from collections import OrderedDict
+
+from core_data_modules.logging import Logger
+from core_data_modules.traced_data import Metadata
 from core_data_modules.util import TimeUtils
 
+from src.lib import DatasetLoader, ConvertedRunsCache
+
+log = Logger(__name__)
+
 
 class CombineRawDatasets(object):
     @staticmethod
-    def coalesce_traced_runs_by_key(user, traced_runs, coalesce_key):
-        coalesced_runs = dict()
+    def coalesce_traced_runs_by_key(user, traced_runs, coalesce_key, run_id_key=None):
+        """
+        Coalesces runs which have the same value for the coalesce_key into a single TracedData.
+
+        The runs are grouped first, then the later runs in each group are merged into the first in a single update,
+        so each coalesced TracedData gains at most one history entry however many runs it was coalesced from.
+        Where a key is in more than one run, the value from the latest run is used.
 
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param traced_runs: Runs to coalesce.
+        :type traced_runs: iterable of TracedData
+        :param coalesce_key: Key in each run of the value to coalesce on.
+        :type coalesce_key: str
+        :param run_id_key: Key in each run of the run's id. If set, the ids of all the runs that each coalesced
+                           TracedData was built from are recorded, as provenance, in the source of the Metadata of
+                           the update which coalesced them. They are not written to a key, so they aren't exported.
+        :type run_id_key: str | None
+        :return: One TracedData for each value of the coalesce_key.
+        :rtype: list of TracedData
+        """
+        runs_by_key = OrderedDict()  # of coalesce key value -> list of TracedData
         for run in traced_runs:
-            if run[coalesce_key] not in coalesced_runs:
-                coalesced_runs[run[coalesce_key]] = run
-            else:
-                coalesced_runs[run[coalesce_key]].append_data(
-                    dict(run.items()), Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+            if run[coalesce_key] not in runs_by_key:
+                runs_by_key[run[coalesce_key]] = []
+            runs_by_key[run[coalesce_key]].append(run)
 
-        return list(coalesced_runs.values())
+        call_location = Metadata.get_call_location()
+        timestamp = TimeUtils.utc_now_as_iso_string()
+        coalesced_runs = []
+        for runs in runs_by_key.values():
+            coalesced_run = runs[0]
+            if len(runs) > 1:
+                merged = dict()
+                for run in runs[1:]:
+                    merged.update(run.items())
+                source = call_location
+                if run_id_key is not None:
+                    source = f"{call_location} (coalesced runs {[run.get(run_id_key) for run in runs]})"
+                coalesced_run.append_data(merged, Metadata(user, source, timestamp))
+            coalesced_runs.append(coalesced_run)
+
+        return coalesced_runs
 
     @staticmethod
     def combine_raw_datasets(user, messages_datasets, surveys_datasets):
-        data = []
+        """
+        Joins the survey responses of each participant onto each of their messages.
 
-        for messages_dataset in messages_datasets:
-            data.extend(messages_dataset)
+        The surveys datasets are first indexed by avf_phone_id, with each participant's responses from every surveys
+        dataset merged into a single TracedData, so that each message is only updated once. Where the same key is
+        present in more than one surveys dataset, the value from the later dataset is used.
 
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param messages_datasets: Messages datasets to combine.
+        :type messages_datasets: list of list of TracedData
+        :param surveys_datasets: Surveys datasets, each with at most one TracedData per avf_phone_id.
+        :type surveys_datasets: list of list of TracedData
+        :return: All the messages, with the survey responses of their senders.
+        :rtype: list of TracedData
+        """
+        metadata = Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
+
+        surveys_lut = dict()  # of avf_phone_id -> TracedData of that participant's responses to all the surveys
         for surveys_dataset in surveys_datasets:
-            TracedData.update_iterable(user, "avf_phone_id", data, surveys_dataset, "survey_responses")
+            for survey_td in surveys_dataset:
+                avf_phone_id = survey_td["avf_phone_id"]
+                if avf_phone_id not in surveys_lut:
+                    surveys_lut[avf_phone_id] = survey_td.copy()
+                else:
+                    surveys_lut[avf_phone_id].append_traced_data("survey_responses", survey_td, metadata)
+
+        data = []
+        for messages_dataset in messages_datasets:
+            for td in messages_dataset:
+                if td["avf_phone_id"] in surveys_lut:
+                    td.append_traced_data("survey_responses", surveys_lut[td["avf_phone_id"]], metadata)
+                data.append(td)
 
         return data
+
+    @classmethod
+    def load_and_combine_raw_datasets(cls, user, raw_data_dir, activation_flow_names, survey_flow_names,
+                                      max_load_workers=1):
+        """
+        Loads the raw data files exported by fetch_raw_data.py for the given flows, and adds the survey responses
+        of each participant to each of their messages.
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param raw_data_dir: Directory containing the raw data files exported by fetch_raw_data.py.
+        :type raw_data_dir: str
+        :param activation_flow_names: Names of the flows to load messages from.
+        :type activation_flow_names: list of str
+        :param survey_flow_names: Names of the flows to load survey responses from.
+        :type survey_flow_names: list of str
+        :param max_load_workers: Maximum number of processes to use to load the raw data files.
+        :type max_load_workers: int
+        :return: The messages, with the survey responses of their senders.
+        :rtype: list of TracedData
+        """
+        log.info("Loading messages and surveys datasets...")
+        raw_activation_paths = [f"{raw_data_dir}/{activation_flow_name}.jsonl"
+                                for activation_flow_name in activation_flow_names]
+        raw_survey_paths = [f"{raw_data_dir}/{survey_flow_name}.jsonl" for survey_flow_name in survey_flow_names]
+        datasets = DatasetLoader.load_jsonl_datasets(raw_activation_paths + raw_survey_paths, max_load_workers)
+        messages_datasets = datasets[:len(raw_activation_paths)]
+        surveys_datasets = datasets[len(raw_activation_paths):]
+
+        log.info("Combining Datasets...")
+        coalesced_surveys_datasets = []
+        for survey_flow_name, dataset in zip(survey_flow_names, surveys_datasets):
+            coalesced_surveys_datasets.append(cls.coalesce_traced_runs_by_key(
+                user, dataset, "avf_phone_id", f"{ConvertedRunsCache.RUN_ID_KEY_PREFIX}{survey_flow_name}"))
+        return cls.combine_raw_datasets(user, messages_datasets, coalesced_surveys_datasets)
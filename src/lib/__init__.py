@@ -1,3 +1,9 @@
-from .icr_tools import ICRTools
-from .message_filters import MessageFilters
+from .icr_tools import ICRSampler
+from .message_filters import MessageFilters, MessageFilterChain
 from .pipeline_configuration import PipelineConfiguration
+from .converted_runs_cache import ConvertedRunsCache
+from .cached_uuid_table import CachedUuidTable, InMemoryUuidTable
+from .segmented_store import SegmentedStore
+from .operator_labeller import OperatorLabeller
+from .fetch_checkpoint import FetchCheckpoint
+from .dataset_loader import DatasetLoader
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from urllib.parse import urlparse
+
+from core_data_modules.logging import Logger
+from core_data_modules.util import IOUtils
+from google.cloud import storage
+
+log = Logger(__name__)
+
+
+class GoogleCloudStorageBlobSource(object):
+    """
+    Reads blobs and their versions from Google Cloud Storage.
+    """
+    def __init__(self, google_cloud_credentials_file_path):
+        """
+        :param google_cloud_credentials_file_path: Path to a Google Cloud service account credentials file to use to
+                                                   access the blobs.
+        :type google_cloud_credentials_file_path: str
+        """
+        self._client = storage.Client.from_service_account_json(google_cloud_credentials_file_path)
+
+    def _get_blob(self, blob_url):
+        parsed_blob_url = urlparse(blob_url)
+        assert parsed_blob_url.scheme == "gs", f"Blob URL '{blob_url}' is not a gs URL"
+        blob = self._client.bucket(parsed_blob_url.netloc).get_blob(parsed_blob_url.path.lstrip("/"))
+        assert blob is not None, f"Blob '{blob_url}' not found"
+        return blob
+
+    def get_version(self, blob_url):
+        """
+        :return: Identifier of the current version of the given blob. This changes whenever the blob is re-written.
+        :rtype: str
+        """
+        blob = self._get_blob(blob_url)
+        return f"{blob.generation}-{blob.etag}"
+
+    def download_to_file(self, blob_url, file_path):
+        self._get_blob(blob_url).download_to_filename(file_path)
+
+
+class LocalDirectoryBlobSource(object):
+    """
+    Stand-in for Google Cloud Storage which reads blobs from a local directory, for use in testing.
+    The blob at gs://<bucket>/<path> is read from <root_dir>/<bucket>/<path>.
+    """
+    def __init__(self, root_dir):
+        """
+        :param root_dir: Directory containing a sub-directory for each bucket.
+        :type root_dir: str
+        """
+        self.root_dir = root_dir
+
+    def _get_blob_path(self, blob_url):
+        parsed_blob_url = urlparse(blob_url)
+        assert parsed_blob_url.scheme == "gs", f"Blob URL '{blob_url}' is not a gs URL"
+        return os.path.join(self.root_dir, parsed_blob_url.netloc, parsed_blob_url.path.lstrip("/"))
+
+    def get_version(self, blob_url):
+        stat = os.stat(self._get_blob_path(blob_url))
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    def download_to_file(self, blob_url, file_path):
+        shutil.copyfile(self._get_blob_path(blob_url), file_path)
+
+
+class BlobCache(object):
+    """
+    Local, content-addressed cache of blobs.
+
+    Blob contents are stored in the cache directory under their sha256 hash, and an index maps each blob URL to its
+    latest downloaded version and the hash of that version's contents. A blob is only downloaded if the version
+    currently in the source is not the version in the index. When a newer version of a blob is downloaded, the
+    contents of the older version are deleted, unless they are still the contents of another blob.
+
+    Files written by `download_to_file` are hard links to the cached contents where possible, so that the cache does
+    not hold a second copy of each file.
+    """
+    INDEX_FILE_NAME = "index.json"
+
+    def __init__(self, blob_source, cache_dir):
+        """
+        :param blob_source: Source to read blobs and their versions from.
+        :type blob_source: GoogleCloudStorageBlobSource | LocalDirectoryBlobSource
+        :param cache_dir: Directory to store the cached blobs in.
+        :type cache_dir: str
+        """
+        self.blob_source = blob_source
+        self.cache_dir = cache_dir
+
+        self._lock = threading.Lock()
+        self._index = dict()  # of blob url -> {"version": str, "sha": sha256 of the blob's contents}
+        if os.path.exists(self._index_path()):
+            with open(self._index_path()) as f:
+                self._index = json.load(f)
+            # Discard the entries of indexes written by earlier versions of this class, which mapped
+            # f"{blob_url}@{version}" -> sha. Their contents are deleted by the next call to _evict_unreferenced.
+            self._index = {blob_url: entry for blob_url, entry in self._index.items() if isinstance(entry, dict)}
+
+    def _index_path(self):
+        return os.path.join(self.cache_dir, self.INDEX_FILE_NAME)
+
+    def _object_path(self, sha):
+        return os.path.join(self.cache_dir, sha)
+
+    @staticmethod
+    def _hash_file(file_path):
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def _write_index(self):
+        temp_index_path = f"{self._index_path()}.tmp"
+        with open(temp_index_path, "w") as f:
+            json.dump(self._index, f)
+        os.replace(temp_index_path, self._index_path())
+
+    def _evict_unreferenced(self):
+        """
+        Deletes the cached contents which are not the contents of the latest version of any blob in the index.
+        Must be called with self._lock held.
+        """
+        referenced_shas = {entry["sha"] for entry in self._index.values()}
+        for file_name in os.listdir(self.cache_dir):
+            if len(file_name) == 64 and file_name not in referenced_shas:
+                log.debug(f"Evicting superseded blob contents '{file_name}' from the blob cache")
+                os.remove(self._object_path(file_name))
+
+    def get_path(self, blob_url):
+        """
+        Returns the path to a local copy of the current version of a blob, downloading it if it is not already
+        in the cache.
+
+        :param blob_url: URL of the blob e.g. gs://bucket/path/to/blob.
+        :type blob_url: str
+        :return: Path to the cached copy of the blob. This file must not be modified.
+        :rtype: str
+        """
+        version = self.blob_source.get_version(blob_url)
+
+        with self._lock:
+            entry = self._index.get(blob_url)
+        if entry is not None and entry["version"] == version and os.path.exists(self._object_path(entry["sha"])):
+            log.debug(f"Found '{blob_url}' in the blob cache")
+            return self._object_path(entry["sha"])
+
+        log.info(f"Downloading '{blob_url}' to the blob cache...")
+        IOUtils.ensure_dirs_exist(self.cache_dir)
+        temp_path = os.path.join(self.cache_dir, f"download-{threading.get_ident()}.tmp")
+        self.blob_source.download_to_file(blob_url, temp_path)
+        sha = self._hash_file(temp_path)
+        os.replace(temp_path, self._object_path(sha))
+
+        with self._lock:
+            self._index[blob_url] = {"version": version, "sha": sha}
+            self._write_index()
+            self._evict_unreferenced()
+
+        return self._object_path(sha)
+
+    def download_to_file(self, blob_url, file_path):
+        """
+        Writes the current version of a blob to a file. The file is only written if its contents differ from
+        the blob's. Where possible, the file is written as a hard link to the cached contents, so it must not be
+        modified in place.
+
+        :param blob_url: URL of the blob e.g. gs://bucket/path/to/blob.
+        :type blob_url: str
+        :param file_path: Path to write the blob to.
+        :type file_path: str
+        :return: Whether the file was (re-)written.
+        :rtype: bool
+        """
+        cached_path = self.get_path(blob_url)
+        if os.path.exists(file_path) and os.path.samefile(file_path, cached_path):
+            log.debug(f"'{file_path}' is already up to date with '{blob_url}'")
+            return False
+        # A file with the same contents which isn't a link (e.g. written by an earlier version of this class) is
+        # replaced by a link below, but doesn't count as being re-written.
+        is_up_to_date = os.path.exists(file_path) and self._hash_file(file_path) == os.path.basename(cached_path)
+
+        # Write to a temporary file then rename, so that an existing file which is a link to older cached contents
+        # is replaced rather than overwritten.
+        IOUtils.ensure_dirs_exist_for_file(file_path)
+        temp_file_path = f"{file_path}.tmp"
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        try:
+            os.link(cached_path, temp_file_path)
+        except OSError:
+            shutil.copyfile(cached_path, temp_file_path)
+        os.replace(temp_file_path, file_path)
+        return not is_up_to_date
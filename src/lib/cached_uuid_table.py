@@ -0,0 +1,142 @@
+import sqlite3
+import threading
+import time
+import uuid
+
+from core_data_modules.logging import Logger
+from core_data_modules.util import IOUtils
+
+log = Logger(__name__)
+
+
+class InMemoryUuidTable(object):
+    """
+    In-process stand-in for id_infrastructure.firestore_uuid_table.FirestoreUuidTable, for running without
+    access to Firestore (see the --offline-uuid-table option of fetch_raw_data.py). Mappings only last for the
+    lifetime of the object, unless the table is wrapped in a CachedUuidTable.
+    """
+    def __init__(self, uuid_prefix):
+        """
+        :param uuid_prefix: Prefix to give each new uuid e.g. "avf-phone-uuid-".
+        :type uuid_prefix: str
+        """
+        self.uuid_prefix = uuid_prefix
+        self._data_to_uuid = dict()
+        self._uuid_to_data = dict()
+
+    def data_to_uuid_batch(self, data):
+        data_to_uuid_lut = dict()
+        for datum in data:
+            if datum not in self._data_to_uuid:
+                new_uuid = f"{self.uuid_prefix}{uuid.uuid4()}"
+                self._data_to_uuid[datum] = new_uuid
+                self._uuid_to_data[new_uuid] = datum
+            data_to_uuid_lut[datum] = self._data_to_uuid[datum]
+        return data_to_uuid_lut
+
+    def uuid_to_data_batch(self, uuids):
+        return {data_uuid: self._uuid_to_data[data_uuid] for data_uuid in uuids}
+
+    def data_to_uuid(self, datum):
+        return self.data_to_uuid_batch([datum])[datum]
+
+    def uuid_to_data(self, data_uuid):
+        return self.uuid_to_data_batch([data_uuid])[data_uuid]
+
+
+class CachedUuidTable(object):
+    """
+    Read-through, write-through cache of a data <-> uuid table, stored in a local SQLite database.
+
+    Lookups are answered from the local database where possible. All of the data or uuids in a batch which are
+    missing from the local database are requested from the backing table in a single batch request, and the
+    results are written back to the local database for use by later lookups and later runs.
+    """
+    # Maximum number of values to look up in one SQLite query, to stay below SQLite's host parameter limit.
+    SQLITE_BATCH_SIZE = 500
+
+    def __init__(self, backend, cache_path, ttl=None):
+        """
+        :param backend: Table to read mappings from when they are not in the local cache e.g. a FirestoreUuidTable
+                        or an InMemoryUuidTable.
+        :type backend: id_infrastructure.firestore_uuid_table.FirestoreUuidTable | InMemoryUuidTable
+        :param cache_path: Path to the SQLite database file to cache mappings in. This file is created if it does
+                           not already exist.
+        :type cache_path: str
+        :param ttl: Time, in seconds, for which a cached mapping may be used before it is re-read from the backend.
+                    If None, cached mappings never expire.
+        :type ttl: float | None
+        """
+        self.backend = backend
+        self.cache_path = cache_path
+        self.ttl = ttl
+
+        IOUtils.ensure_dirs_exist_for_file(cache_path)
+        # The table may be shared by several threads (see fetch_raw_data.py), so serialise access to the connection.
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS uuid_table (data TEXT PRIMARY KEY, uuid TEXT NOT NULL, cached_at REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS uuid_table_uuid ON uuid_table (uuid)")
+
+    def _read_cached(self, column, values):
+        """
+        :return: List of (data, uuid) for each of the given values of `column` which are cached and have not expired.
+        :rtype: list of (str, str)
+        """
+        assert column in {"data", "uuid"}
+        min_cached_at = 0 if self.ttl is None else time.time() - self.ttl
+
+        values = list(values)
+        rows = []
+        with self._lock:
+            for i in range(0, len(values), self.SQLITE_BATCH_SIZE):
+                batch = values[i:i + self.SQLITE_BATCH_SIZE]
+                rows.extend(self._connection.execute(
+                    f"SELECT data, uuid FROM uuid_table "
+                    f"WHERE {column} IN ({', '.join('?' * len(batch))}) AND cached_at >= ?",
+                    batch + [min_cached_at]
+                ).fetchall())
+        return rows
+
+    def _write_cached(self, data_to_uuid_lut):
+        cached_at = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO uuid_table (data, uuid, cached_at) VALUES (?, ?, ?)",
+                [(datum, data_uuid, cached_at) for datum, data_uuid in data_to_uuid_lut.items()]
+            )
+
+    def data_to_uuid_batch(self, data):
+        data = set(data)
+        data_to_uuid_lut = {datum: data_uuid for datum, data_uuid in self._read_cached("data", data)}
+
+        misses = data - data_to_uuid_lut.keys()
+        log.debug(f"Found {len(data_to_uuid_lut)}/{len(data)} data in the local uuid cache")
+        if len(misses) > 0:
+            fetched = self.backend.data_to_uuid_batch(list(misses))
+            self._write_cached(fetched)
+            data_to_uuid_lut.update(fetched)
+
+        return data_to_uuid_lut
+
+    def uuid_to_data_batch(self, uuids):
+        uuids = set(uuids)
+        uuid_to_data_lut = {data_uuid: datum for datum, data_uuid in self._read_cached("uuid", uuids)}
+
+        misses = uuids - uuid_to_data_lut.keys()
+        log.debug(f"Found {len(uuid_to_data_lut)}/{len(uuids)} uuids in the local uuid cache")
+        if len(misses) > 0:
+            fetched = self.backend.uuid_to_data_batch(list(misses))
+            self._write_cached({datum: data_uuid for data_uuid, datum in fetched.items()})
+            uuid_to_data_lut.update(fetched)
+
+        return uuid_to_data_lut
+
+    def data_to_uuid(self, datum):
+        return self.data_to_uuid_batch([datum])[datum]
+
+    def uuid_to_data(self, data_uuid):
+        return self.uuid_to_data_batch([data_uuid])[data_uuid]
@@ -0,0 +1,83 @@
+import io
+import json
+import os
+
+
+class CodaDatasetCache(object):
+    """
+    Cache of parsed Coda V2 messages files, shared by all the stages which import labels from Coda in this process.
+
+    Each file is only read and parsed once (until it changes on disk), and is indexed by the schemes each message has
+    labels in. An import from the file then only needs to parse a copy of the file which contains the labels in the
+    schemes being imported, rather than the whole file. Messages with no labels in a scheme are imported in the same
+    way whether or not they are present in the file, so this gives the same results as importing from the whole file.
+
+    The TracedDataCodaV2IO import functions only accept a file, so each copy is serialized to JSON. The serialized
+    copy for each set of schemes is cached too, so a file is only serialized once for each set of schemes however many
+    times those schemes are imported (e.g. by both WSCorrection and ApplyManualCodes).
+    """
+    # of file path -> ((mtime, size), list of Coda message dicts,
+    #                  dict of scheme id -> set of indices into the list of messages,
+    #                  dict of frozenset of scheme ids -> serialized messages file for those schemes)
+    _datasets = dict()
+
+    @classmethod
+    def _get_dataset(cls, coda_file_path):
+        stat = os.stat(coda_file_path)
+        version = (stat.st_mtime_ns, stat.st_size)
+
+        if coda_file_path in cls._datasets and cls._datasets[coda_file_path][0] == version:
+            return cls._datasets[coda_file_path]
+
+        with open(coda_file_path) as f:
+            messages = json.load(f)
+
+        scheme_index = dict()  # of scheme id -> set of indices into messages
+        for i, message in enumerate(messages):
+            for label in message["Labels"]:
+                if label["SchemeID"] not in scheme_index:
+                    scheme_index[label["SchemeID"]] = set()
+                scheme_index[label["SchemeID"]].add(i)
+
+        cls._datasets[coda_file_path] = (version, messages, scheme_index, dict())
+        return cls._datasets[coda_file_path]
+
+    @staticmethod
+    def _is_in_schemes(label_scheme_id, scheme_ids):
+        # Labels in a duplicated scheme have the SchemeID "<scheme_id>-<n>", and are imported by TracedDataCodaV2IO
+        # along with the labels in the original scheme, so match them by prefix.
+        return any(label_scheme_id.startswith(scheme_id) for scheme_id in scheme_ids)
+
+    @classmethod
+    def open_for_schemes(cls, coda_file_path, code_schemes):
+        """
+        Returns a Coda V2 messages file containing the messages in the given file which have labels in any of the
+        given code schemes or their duplicates, with only the labels in those schemes.
+
+        :param coda_file_path: Path to the Coda V2 messages file to read.
+        :type coda_file_path: str
+        :param code_schemes: Code schemes to keep the labels of.
+        :type code_schemes: iterable of core_data_modules.data_models.CodeScheme
+        :return: File-like object which can be passed to the TracedDataCodaV2IO import functions in place of the
+                 original file.
+        :rtype: io.StringIO
+        """
+        _, messages, scheme_index, serialized_files = cls._get_dataset(coda_file_path)
+        scheme_ids = frozenset(code_scheme.scheme_id for code_scheme in code_schemes)
+
+        if scheme_ids not in serialized_files:
+            message_indices = set()
+            for label_scheme_id, indices in scheme_index.items():
+                if cls._is_in_schemes(label_scheme_id, scheme_ids):
+                    message_indices.update(indices)
+
+            filtered_messages = []
+            for i in sorted(message_indices):
+                filtered_message = dict(messages[i])
+                filtered_message["Labels"] = [label for label in messages[i]["Labels"]
+                                              if cls._is_in_schemes(label["SchemeID"], scheme_ids)]
+                filtered_messages.append(filtered_message)
+
+            serialized_files[scheme_ids] = json.dumps(filtered_messages)
+
+        return io.StringIO(serialized_files[scheme_ids])
@@ -0,0 +1,132 @@
+import json
+
+from core_data_modules.logging import Logger
+from core_data_modules.traced_data.io import TracedDataJsonIO
+from core_data_modules.util import IOUtils
+
+log = Logger(__name__)
+
+
+class ConvertedRunsCache(object):
+    # Prefix of the key that RapidProClient.convert_runs_to_traced_data sets to the id of the run each TracedData
+    # was converted from. The full key is f"{RUN_ID_KEY_PREFIX}{flow name}".
+    RUN_ID_KEY_PREFIX = "run_id - "
+
+    @staticmethod
+    def _cache_key(run, contacts_lut):
+        contact = contacts_lut.get(run.contact.uuid)
+        contact_modified_on = None if contact is None or contact.modified_on is None else contact.modified_on.isoformat()
+        return [run.id, run.modified_on.isoformat(), contact_modified_on]
+
+    @staticmethod
+    def _load(cache_path_prefix, test_contact_uuids):
+        """
+        Loads a conversion cache written by ConvertedRunsCache._save.
+
+        :return: Dictionary of run id -> (cache key, TracedData). Empty if there is no usable cache.
+        :rtype: dict of int -> (list, TracedData)
+        """
+        index_path = f"{cache_path_prefix}_index.json"
+        traced_data_path = f"{cache_path_prefix}.jsonl"
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+            with open(traced_data_path) as f:
+                traced_runs = TracedDataJsonIO.import_jsonl_to_traced_data_iterable(f)
+        except FileNotFoundError:
+            log.info(f"No conversion cache found at '{cache_path_prefix}', will convert all runs")
+            return dict()
+
+        if index["test_contact_uuids"] != sorted(test_contact_uuids):
+            log.info("The test contact uuids have changed since the conversion cache was written, "
+                     "will convert all runs")
+            return dict()
+
+        if len(index["keys"]) != len(traced_runs):
+            log.warning(f"Conversion cache index '{index_path}' does not match '{traced_data_path}', "
+                        f"will convert all runs")
+            return dict()
+
+        return {key[0]: (key, td) for key, td in zip(index["keys"], traced_runs)}
+
+    @staticmethod
+    def _save(cache_path_prefix, test_contact_uuids, keys, traced_runs):
+        index_path = f"{cache_path_prefix}_index.json"
+        traced_data_path = f"{cache_path_prefix}.jsonl"
+
+        IOUtils.ensure_dirs_exist_for_file(traced_data_path)
+        with open(traced_data_path, "w") as f:
+            TracedDataJsonIO.export_traced_data_iterable_to_jsonl(traced_runs, f)
+        with open(index_path, "w") as f:
+            json.dump({"test_contact_uuids": sorted(test_contact_uuids), "keys": keys}, f)
+
+    @classmethod
+    def convert_runs_to_traced_data(cls, rapid_pro, user, raw_runs, raw_contacts, phone_number_uuid_table,
+                                    test_contact_uuids, cache_path_prefix):
+        """
+        Converts runs to TracedData, in the same way as RapidProClient.convert_runs_to_traced_data, but only
+        converts runs which have changed since the previous call with the same cache_path_prefix.
+
+        The TracedData for unchanged runs are read back from a cache, which is keyed by run id, run modified_on,
+        and the modified_on of the run's contact. Runs which could not be converted last time (for example because
+        their contact had not been downloaded) are never cached, so are always converted again.
+
+        :param rapid_pro: Rapid Pro client to use to convert the runs which are not in the cache.
+        :type rapid_pro: RapidProClient
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param raw_runs: Raw runs to convert.
+        :type raw_runs: list of temba_client.v2.types.Run
+        :param raw_contacts: Raw contacts to use to look up the contact of each run.
+        :type raw_contacts: list of temba_client.v2.types.Contact
+        :param phone_number_uuid_table: Phone number <-> uuid table to use to set each run's avf_phone_id.
+        :type phone_number_uuid_table: id_infrastructure.firestore_uuid_table.FirestoreUuidTable
+        :param test_contact_uuids: Rapid Pro uuids of the contacts to tag as test contacts.
+        :type test_contact_uuids: list of str
+        :param cache_path_prefix: Path prefix of the cache files. The cache is stored in
+                                  f"{cache_path_prefix}.jsonl" and f"{cache_path_prefix}_index.json".
+        :type cache_path_prefix: str
+        :return: TracedData for each of the converted runs, in the order of raw_runs.
+        :rtype: list of TracedData
+        """
+        contacts_lut = {contact.uuid: contact for contact in raw_contacts}
+        cache = cls._load(cache_path_prefix, test_contact_uuids)
+
+        runs_to_convert = []
+        run_ids_to_convert = set()
+        for run in raw_runs:
+            if run.id not in cache or cache[run.id][0] != cls._cache_key(run, contacts_lut):
+                runs_to_convert.append(run)
+                run_ids_to_convert.add(run.id)
+        log.info(f"Converting {len(runs_to_convert)}/{len(raw_runs)} runs which are not in the conversion cache...")
+
+        converted_runs = rapid_pro.convert_runs_to_traced_data(
+            user, runs_to_convert, raw_contacts, phone_number_uuid_table, test_contact_uuids)
+
+        # Match each of the newly converted TracedData back to the run it was converted from.
+        run_id_keys = {f"{cls.RUN_ID_KEY_PREFIX}{run.flow.name}" for run in runs_to_convert}
+        converted_lut = dict()  # of run id -> TracedData
+        for td in converted_runs:
+            run_ids = [td[key] for key in run_id_keys if key in td]
+            if len(run_ids) != 1:
+                log.warning("Unable to match a converted run to its run id, so not using the conversion cache. "
+                            "Converting all runs...")
+                return rapid_pro.convert_runs_to_traced_data(
+                    user, raw_runs, raw_contacts, phone_number_uuid_table, test_contact_uuids)
+            converted_lut[run_ids[0]] = td
+
+        keys = []
+        traced_runs = []
+        for run in raw_runs:
+            if run.id in converted_lut:
+                td = converted_lut[run.id]
+            elif run.id not in run_ids_to_convert:
+                td = cache[run.id][1]
+            else:
+                continue
+            keys.append(cls._cache_key(run, contacts_lut))
+            traced_runs.append(td)
+
+        cls._save(cache_path_prefix, test_contact_uuids, keys, traced_runs)
+
+        return traced_runs
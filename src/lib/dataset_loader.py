@@ -0,0 +1,103 @@
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from core_data_modules.logging import Logger
+from core_data_modules.traced_data.io import TracedDataJsonIO
+
+log = Logger(__name__)
+
+
+class DatasetLoader(object):
+    # Files larger than this are split into chunks of about this size, so that a single large file can be
+    # deserialized by several processes at once.
+    DEFAULT_CHUNK_SIZE_BYTES = 64 * 1024 * 1024
+
+    @staticmethod
+    def _compute_chunks(file_path, chunk_size_bytes):
+        """
+        Splits a JSONL file into chunks of about chunk_size_bytes, with each chunk ending at the end of a line.
+
+        :return: List of (start offset, end offset) for each chunk, in order.
+        :rtype: list of (int, int)
+        """
+        file_size = os.path.getsize(file_path)
+        offsets = [0]
+        with open(file_path, "rb") as f:
+            while offsets[-1] + chunk_size_bytes < file_size:
+                f.seek(offsets[-1] + chunk_size_bytes)
+                f.readline()
+                if f.tell() >= file_size:
+                    break
+                offsets.append(f.tell())
+        offsets.append(file_size)
+
+        return list(zip(offsets[:-1], offsets[1:]))
+
+    @staticmethod
+    def _load_chunk(file_path, start, end):
+        """
+        Deserializes the TracedData in a chunk of a JSONL file.
+
+        This runs in a worker process, so the TracedData are deserialized in parallel but are then pickled back to the
+        parent process, which unpickles them in turn. Compare the combine_raw_datasets stage metrics with and without
+        --max-load-workers to check that this is faster for a given dataset.
+
+        :return: The TracedData on each line of the chunk, in order.
+        :rtype: list of TracedData
+        """
+        with open(file_path, "rb") as f:
+            f.seek(start)
+            chunk = f.read(end - start).decode("utf-8")
+        return TracedDataJsonIO.import_jsonl_to_traced_data_iterable(io.StringIO(chunk))
+
+    @classmethod
+    def load_jsonl_datasets(cls, file_paths, max_workers=1, chunk_size_bytes=DEFAULT_CHUNK_SIZE_BYTES):
+        """
+        Loads TracedData JSONL files, optionally deserializing them in parallel in a pool of worker processes.
+
+        :param file_paths: Paths to the JSONL files to load.
+        :type file_paths: list of str
+        :param max_workers: Maximum number of worker processes to deserialize the files with. If 1, the files are
+                            loaded in turn in this process.
+        :type max_workers: int
+        :param chunk_size_bytes: Approximate size of the chunks to split each file into when loading in parallel.
+        :type chunk_size_bytes: int
+        :return: The TracedData in each file, in the order of file_paths.
+        :rtype: list of list of TracedData
+        """
+        chunks = []  # of (index into file_paths, file path, start offset, end offset)
+        if max_workers > 1:
+            for i, file_path in enumerate(file_paths):
+                for start, end in cls._compute_chunks(file_path, chunk_size_bytes):
+                    chunks.append((i, file_path, start, end))
+
+        # Load in this process if there is nothing to parallelise, to avoid the cost of pickling the TracedData back
+        # from the workers.
+        if max_workers == 1 or len(chunks) <= 1:
+            datasets = []
+            for file_path in file_paths:
+                log.info(f"Loading {file_path}...")
+                with open(file_path, "r") as f:
+                    datasets.append(TracedDataJsonIO.import_jsonl_to_traced_data_iterable(f))
+                log.info(f"Loaded {len(datasets[-1])} TracedData objects")
+            return datasets
+
+        log.info(f"Loading {len(file_paths)} files in {len(chunks)} chunks, using up to {max_workers} processes...")
+
+        datasets = [[] for _ in file_paths]
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # executor.map returns the results in the order of the chunks, so each dataset is re-assembled in
+            # file order.
+            loaded_chunks = executor.map(
+                cls._load_chunk,
+                [file_path for _, file_path, _, _ in chunks],
+                [start for _, _, start, _ in chunks],
+                [end for _, _, _, end in chunks]
+            )
+            for (i, _, _, _), loaded_chunk in zip(chunks, loaded_chunks):
+                datasets[i].extend(loaded_chunk)
+
+        for file_path, dataset in zip(file_paths, datasets):
+            log.info(f"Loaded {len(dataset)} TracedData objects from {file_path}")
+        return datasets
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+from core_data_modules.logging import Logger
+from core_data_modules.util import IOUtils
+from storage.google_drive import drive_client_wrapper
+
+log = Logger(__name__)
+
+
+class GoogleDriveUploadTarget(object):
+    """
+    Uploads files to the "Shared with Me" directory of a Google Drive service account.
+    """
+    def __init__(self, drive_credentials_info):
+        """
+        :param drive_credentials_info: Google Drive service account credentials to upload with.
+        :type drive_credentials_info: dict
+        """
+        self.drive_credentials_info = drive_credentials_info
+
+    def get_url(self, drive_path):
+        """
+        :return: Identifier of the file that a file uploaded to drive_path is written to.
+        :rtype: str
+        """
+        return f"drive:{drive_path}"
+
+    def upload(self, file_path, drive_path):
+        # Initialise the Drive client in the process doing the upload, because the client can't be shared between
+        # processes.
+        drive_client_wrapper.init_client_from_info(self.drive_credentials_info)
+        drive_client_wrapper.update_or_create(file_path, os.path.dirname(drive_path),
+                                              target_file_name=os.path.basename(drive_path),
+                                              target_folder_is_shared_with_me=True)
+
+
+class LocalDirectoryUploadTarget(object):
+    """
+    Stand-in for Google Drive which "uploads" files by copying them to a local directory, for use in testing.
+    A file uploaded to <drive_path> is copied to <root_dir>/<drive_path>.
+    """
+    def __init__(self, root_dir):
+        """
+        :param root_dir: Directory to copy the uploaded files to.
+        :type root_dir: str
+        """
+        self.root_dir = root_dir
+
+    def get_url(self, drive_path):
+        return f"file://{os.path.abspath(os.path.join(self.root_dir, drive_path))}"
+
+    def upload(self, file_path, drive_path):
+        target_path = os.path.join(self.root_dir, drive_path)
+        IOUtils.ensure_dirs_exist_for_file(target_path)
+        shutil.copyfile(file_path, target_path)
+
+
+class DriveUploader(object):
+    """
+    Uploads files to Google Drive (or a stand-in), skipping the files which have not changed since they were last
+    uploaded.
+
+    A manifest records the sha256 of the contents of each file when it was last uploaded to each location. Only files
+    whose hash differs from the one in the manifest are uploaded. Note that this means that changes made to a file
+    directly in Drive will not be overwritten until the local copy changes, or the manifest is deleted.
+    """
+    def __init__(self, upload_target, manifest_path=None, max_workers=1):
+        """
+        :param upload_target: Where to upload the files to.
+        :type upload_target: GoogleDriveUploadTarget | LocalDirectoryUploadTarget
+        :param manifest_path: Path to the json file to read and write the manifest of uploaded files. If None, every
+                              file is uploaded.
+        :type manifest_path: str | None
+        :param max_workers: Maximum number of files to upload at once. Each upload is run in a separate process.
+        :type max_workers: int
+        """
+        self.upload_target = upload_target
+        self.manifest_path = manifest_path
+        self.max_workers = max_workers
+
+        self._manifest = dict()  # of upload target url -> sha256 of the file last uploaded there
+        if manifest_path is not None and os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self._manifest = json.load(f)
+
+    @staticmethod
+    def _hash_file(file_path):
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def _write_manifest(self):
+        if self.manifest_path is None:
+            return
+
+        IOUtils.ensure_dirs_exist_for_file(self.manifest_path)
+        temp_manifest_path = f"{self.manifest_path}.tmp"
+        with open(temp_manifest_path, "w") as f:
+            json.dump(self._manifest, f)
+        os.replace(temp_manifest_path, self.manifest_path)
+
+    def upload(self, uploads):
+        """
+        Uploads each of the given files whose contents have changed since they were last uploaded.
+
+        :param uploads: (path to the local file, path in Drive to upload the file to) for each file to upload.
+        :type uploads: list of (str, str)
+        """
+        changed_uploads = []  # of (local file path, drive path, url, sha256)
+        for file_path, drive_path in uploads:
+            url = self.upload_target.get_url(drive_path)
+            sha = self._hash_file(file_path)
+            if self._manifest.get(url) == sha:
+                log.info(f"Skipping uploading '{file_path}' to '{drive_path}' because it has not changed since it "
+                         f"was last uploaded")
+                continue
+            changed_uploads.append((file_path, drive_path, url, sha))
+
+        if len(changed_uploads) == 0:
+            return
+        log.info(f"Uploading {len(changed_uploads)}/{len(uploads)} changed files...")
+
+        def record_upload(file_path, drive_path, url, sha):
+            log.info(f"Uploaded '{file_path}' to '{drive_path}'")
+            self._manifest[url] = sha
+            self._write_manifest()
+
+        if self.max_workers == 1:
+            for file_path, drive_path, url, sha in changed_uploads:
+                self.upload_target.upload(file_path, drive_path)
+                record_upload(file_path, drive_path, url, sha)
+            return
+
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.upload_target.upload, file_path, drive_path)
+                       for file_path, drive_path, _, _ in changed_uploads]
+            # Record each upload which succeeded before raising the first failure, so that a re-run only needs to
+            # repeat the uploads which failed.
+            errors = []
+            for future, (file_path, drive_path, url, sha) in zip(futures, changed_uploads):
+                error = future.exception()
+                if error is None:
+                    record_upload(file_path, drive_path, url, sha)
+                else:
+                    log.warning(f"Failed to upload '{file_path}' to '{drive_path}': {error}")
+                    errors.append(error)
+            if len(errors) > 0:
+                raise errors[0]
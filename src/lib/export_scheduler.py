@@ -0,0 +1,69 @@
+import multiprocessing
+from multiprocessing.connection import wait
+
+from core_data_modules.logging import Logger
+
+log = Logger(__name__)
+
+
+class ExportScheduler(object):
+    """
+    Runs a batch of independent export functions, each of which writes one or more files, on up to max_workers
+    processes at once.
+
+    The processes are forked, so the export functions can read the data already in memory without it being
+    serialized. Any changes an export function makes to that data are not seen by this process, so the data must be
+    fully prepared (e.g. by computing message ids) before the exports are run.
+    """
+    def __init__(self, max_workers=1):
+        """
+        :param max_workers: Maximum number of export functions to run at once. If 1, each export function is run in
+                            turn in this process.
+        :type max_workers: int
+        """
+        self.max_workers = max_workers
+        self._exports = []  # of (description, export function)
+
+    def submit(self, description, export_fn):
+        """
+        Adds an export to the batch to be run by `run`.
+
+        :param description: Description of the export, for logging e.g. the path of the file it writes.
+        :type description: str
+        :param export_fn: Function which runs the export. Takes no arguments.
+        :type export_fn: function
+        """
+        self._exports.append((description, export_fn))
+
+    def run(self):
+        """
+        Runs all the submitted exports, returning once they have all completed.
+        Fails if any of the exports failed.
+        """
+        exports = self._exports
+        self._exports = []
+
+        if self.max_workers == 1:
+            for description, export_fn in exports:
+                export_fn()
+            return
+
+        fork_context = multiprocessing.get_context("fork")
+        pending = list(reversed(exports))
+        running = dict()  # of process sentinel -> (description, process)
+        failed = []  # of (description, exit code)
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < self.max_workers:
+                description, export_fn = pending.pop()
+                process = fork_context.Process(target=export_fn)
+                process.start()
+                running[process.sentinel] = (description, process)
+
+            for sentinel in wait(list(running.keys())):
+                description, process = running.pop(sentinel)
+                process.join()
+                if process.exitcode != 0:
+                    log.warning(f"Export '{description}' failed (exit code {process.exitcode})")
+                    failed.append((description, process.exitcode))
+
+        assert len(failed) == 0, f"{len(failed)}/{len(exports)} exports failed (description, exit code): {failed}"
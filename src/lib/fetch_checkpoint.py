@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import threading
+
+from core_data_modules.logging import Logger
+from dateutil.parser import isoparse
+
+log = Logger(__name__)
+
+
+class FetchCheckpoint(object):
+    """
+    Manifest of the progress of a fetch, so that a fetch which is interrupted can be resumed without repeating the
+    work which had already completed.
+
+    For each flow, the manifest records the size of the flow's raw export log when the flow was started and the
+    modified_on that the flow's fetch started from (so that the runs which were fetched before an interruption can be
+    read back from the log, and the range they were fetched from is known), and, once the flow has completed, the
+    sha256 of each of its output files. The manifest is deleted when the fetch completes.
+    """
+    def __init__(self, manifest_path):
+        """
+        :param manifest_path: Path to the json file to store the manifest in.
+        :type manifest_path: str
+        """
+        self.manifest_path = manifest_path
+
+        # Flows may be exported in parallel by fetch_raw_data.py, so serialise access to the manifest.
+        self._lock = threading.Lock()
+        # of flow name -> {"log_offset": int, "range_start_inclusive": iso string | None,
+        #                  "output_hashes": dict of str -> str | None}
+        self._flows = dict()
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self._flows = json.load(f)["flows"]
+            log.info(f"Found a checkpoint from an interrupted fetch at '{manifest_path}'. Resuming that fetch...")
+
+    @staticmethod
+    def _hash_file(file_path):
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def _write(self):
+        temp_manifest_path = f"{self.manifest_path}.tmp"
+        with open(temp_manifest_path, "w") as f:
+            json.dump({"flows": self._flows}, f)
+        os.replace(temp_manifest_path, self.manifest_path)
+
+    def is_flow_complete(self, flow):
+        """
+        :return: Whether the given flow completed in an earlier attempt at this fetch, and all of its output files
+                 are still as they were when it completed.
+        :rtype: bool
+        """
+        with self._lock:
+            output_hashes = self._flows.get(flow, dict()).get("output_hashes")
+        if output_hashes is None:
+            return False
+
+        for output_path, output_hash in output_hashes.items():
+            if not os.path.exists(output_path) or self._hash_file(output_path) != output_hash:
+                log.warning(f"Output file '{output_path}' of flow '{flow}' has changed since it was checkpointed, "
+                            f"so flow '{flow}' will be fetched again")
+                return False
+        return True
+
+    def start_flow(self, flow, raw_export_log_path, range_start_inclusive):
+        """
+        Records that a flow is starting.
+
+        :param flow: Name of the flow.
+        :type flow: str
+        :param raw_export_log_path: Path to the raw export log that runs for this flow are appended to.
+        :type raw_export_log_path: str
+        :param range_start_inclusive: modified_on from which runs for this flow are to be fetched, or None if all the
+                                      runs for this flow are to be fetched.
+        :type range_start_inclusive: datetime.datetime | None
+        :return: If there was an interrupted earlier attempt at this flow, a tuple of (offset into the raw export log
+                 from which that attempt logged the runs it fetched, modified_on from which that attempt fetched runs).
+                 Otherwise None.
+        :rtype: (int, datetime.datetime | None) | None
+        """
+        with self._lock:
+            if flow in self._flows:
+                checkpointed_range_start = self._flows[flow].get("range_start_inclusive")
+                return (
+                    self._flows[flow]["log_offset"],
+                    None if checkpointed_range_start is None else isoparse(checkpointed_range_start)
+                )
+
+            log_offset = os.path.getsize(raw_export_log_path) if os.path.exists(raw_export_log_path) else 0
+            self._flows[flow] = {
+                "log_offset": log_offset,
+                "range_start_inclusive": None if range_start_inclusive is None else range_start_inclusive.isoformat(),
+                "output_hashes": None
+            }
+            self._write()
+            return None
+
+    def complete_flow(self, flow, output_paths):
+        """
+        Records that a flow has completed, along with the hashes of its output files.
+
+        :param flow: Name of the flow.
+        :type flow: str
+        :param output_paths: Paths to the files written for this flow.
+        :type output_paths: iterable of str
+        """
+        output_hashes = {output_path: self._hash_file(output_path) for output_path in output_paths}
+        with self._lock:
+            self._flows[flow]["output_hashes"] = output_hashes
+            self._write()
+
+    def clear(self):
+        """
+        Deletes the manifest, once the fetch has completed.
+        """
+        with self._lock:
+            self._flows = dict()
+            if os.path.exists(self.manifest_path):
+                os.remove(self.manifest_path)
+
+    @staticmethod
+    def read_logged_objects(raw_export_log_path, offset, deserialize_fn):
+        """
+        Reads the objects logged to a raw export log from the given offset.
+
+        Each line in the log must be either a single serialized object or a list of serialized objects. The last line
+        is skipped if it can't be parsed, because the program may have been interrupted while writing it.
+
+        :param raw_export_log_path: Path to the raw export log to read.
+        :type raw_export_log_path: str
+        :param offset: Offset in bytes to start reading from.
+        :type offset: int
+        :param deserialize_fn: Function which deserializes a logged object e.g. temba_client.v2.types.Run.deserialize.
+        :type deserialize_fn: function of dict -> any
+        :return: Objects logged after the given offset, in the order they were logged.
+        :rtype: list of any
+        :raises ValueError: If any line other than the last can't be parsed, or if any line is not an object or a list
+                            of objects.
+        """
+        objs = []
+        incomplete_line_number = None
+        with open(raw_export_log_path, "rb") as f:
+            f.seek(offset)
+            for line_number, line in enumerate(f):
+                if incomplete_line_number is not None:
+                    raise ValueError(f"Raw export log '{raw_export_log_path}' has an unparseable line which is not "
+                                     f"the last line (line {incomplete_line_number} after offset {offset})")
+
+                try:
+                    logged = json.loads(line)
+                except ValueError:
+                    incomplete_line_number = line_number
+                    continue
+
+                if isinstance(logged, dict):
+                    logged = [logged]
+                if not isinstance(logged, list) or not all(isinstance(obj_json, dict) for obj_json in logged):
+                    raise ValueError(f"Raw export log '{raw_export_log_path}' has a line which is not an object or a "
+                                     f"list of objects (line {line_number} after offset {offset})")
+                objs.extend(deserialize_fn(obj_json) for obj_json in logged)
+
+        if incomplete_line_number is not None:
+            log.warning(f"Skipping an incomplete last line in raw export log '{raw_export_log_path}'")
+        return objs
+
+    @staticmethod
+    def is_contiguous_range(objs, modified_on_fn, range_start_inclusive):
+        """
+        Checks that objects read back from a raw export log look like an uninterrupted download from Rapid Pro, which
+        returns objects in descending order of modified_on: the objects must be in non-increasing order of
+        modified_on, and none may have been modified before the start of the range that was being fetched.
+
+        If this holds, the objects include every object modified between the earliest and the latest modified_on
+        logged, so only the objects modified between range_start_inclusive and the earliest logged modified_on still
+        need to be fetched.
+
+        :param objs: Objects read from the log, in the order they were logged.
+        :type objs: list of any
+        :param modified_on_fn: Function which returns the time an object was last modified e.g.
+                               lambda run: run.modified_on.
+        :type modified_on_fn: function of any -> datetime.datetime
+        :param range_start_inclusive: modified_on from which the objects were being fetched, or None if all objects
+                                      were being fetched.
+        :type range_start_inclusive: datetime.datetime | None
+        :return: Whether objs is a contiguous range of objects fetched from range_start_inclusive.
+        :rtype: bool
+        """
+        for prev_obj, obj in zip(objs, objs[1:]):
+            if modified_on_fn(obj) > modified_on_fn(prev_obj):
+                return False
+
+        if range_start_inclusive is not None and len(objs) > 0 and modified_on_fn(objs[-1]) < range_start_inclusive:
+            return False
+
+        return True
@@ -0,0 +1,111 @@
+import json
+import os
+
+from core_data_modules.util import IOUtils
+
+
+class FieldStats(object):
+    """
+    Counts how many TracedData contain each of a set of raw fields, and how many of those values were the empty string
+    or None, with a histogram of the lengths of the values which were not None, in a single pass over the data.
+
+    Lengths are bucketed by powers of two, with each bucket named by its inclusive lower and upper bounds
+    e.g. "8-15".
+    """
+    _MISSING = object()
+
+    def __init__(self, raw_fields, group_by_key=None):
+        """
+        :param raw_fields: Fields to compute the statistics of.
+        :type raw_fields: list of str
+        :param group_by_key: If set, only the last TracedData added with each value of this key is counted, e.g. "uid"
+                             to count each participant's survey responses once. If None, every TracedData is counted.
+        :type group_by_key: str | None
+        """
+        self.raw_fields = raw_fields
+        self.group_by_key = group_by_key
+
+        self._stats = {raw_field: self._empty_stats() for raw_field in raw_fields}
+        self._grouped_values = dict()  # of group_by_key value -> tuple of (value of each raw field, or _MISSING)
+
+    @staticmethod
+    def _empty_stats():
+        return {"present": 0, "empty": 0, "null": 0, "length_histogram": dict()}
+
+    @staticmethod
+    def _length_bucket(length):
+        if length == 0:
+            return "0"
+        lower = 1 << (length.bit_length() - 1)
+        return f"{lower}-{2 * lower - 1}"
+
+    @classmethod
+    def _count_value(cls, stats, value):
+        stats["present"] += 1
+        if value is None:
+            stats["null"] += 1
+            return
+        if value == "":
+            stats["empty"] += 1
+
+        bucket = cls._length_bucket(len(str(value)))
+        stats["length_histogram"][bucket] = stats["length_histogram"].get(bucket, 0) + 1
+
+    def add(self, td):
+        """
+        Adds a TracedData to the statistics.
+
+        :param td: TracedData to add.
+        :type td: TracedData
+        """
+        if self.group_by_key is not None:
+            self._grouped_values[td[self.group_by_key]] = \
+                tuple(td[raw_field] if raw_field in td else self._MISSING for raw_field in self.raw_fields)
+            return
+
+        for raw_field in self.raw_fields:
+            if raw_field in td:
+                self._count_value(self._stats[raw_field], td[raw_field])
+
+    def get_stats(self):
+        """
+        :return: The statistics of each raw field, as a dictionary of raw field ->
+                 {"present": int, "empty": int, "null": int, "length_histogram": dict of length bucket -> int}.
+        :rtype: dict
+        """
+        if self.group_by_key is None:
+            return self._stats
+
+        stats = {raw_field: self._empty_stats() for raw_field in self.raw_fields}
+        for values in self._grouped_values.values():
+            for raw_field, value in zip(self.raw_fields, values):
+                if value is not self._MISSING:
+                    self._count_value(stats[raw_field], value)
+        return stats
+
+    def log_stats(self, log):
+        """
+        Logs the number of values of each raw field which were the empty string, at debug level.
+
+        :param log: Logger to log to.
+        :type log: core_data_modules.logging.Logger
+        """
+        for raw_field, stats in self.get_stats().items():
+            log.debug(f"{raw_field}: {stats['empty']} messages were \"\", out of {stats['present']} total")
+
+    @staticmethod
+    def export_to_json_file(stats_by_category, output_path):
+        """
+        Writes the statistics computed by one or more FieldStats to a JSON file.
+
+        :param stats_by_category: Dictionary of category name (e.g. "rqa") -> the FieldStats for that category.
+        :type stats_by_category: dict of str -> FieldStats
+        :param output_path: Path to write the JSON file to.
+        :type output_path: str
+        """
+        IOUtils.ensure_dirs_exist_for_file(output_path)
+        temp_output_path = f"{output_path}.tmp"
+        with open(temp_output_path, "w") as f:
+            json.dump({category: field_stats.get_stats() for category, field_stats in stats_by_category.items()}, f,
+                      indent=2)
+        os.replace(temp_output_path, output_path)
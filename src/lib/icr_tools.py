@@ -5,17 +5,105 @@ from core_data_modules.logging import Logger
 log = Logger(__name__)
 
 
-# TODO: Move to Core
-class ICRTools(object):
-    @staticmethod
-    def generate_sample_for_icr(data, sample_size, random_generator=None):
-        # FIXME: Should data be de-duplicated before exporting for ICR?
+class ICRSampler(object):
+    """
+    Draws a seeded random sample of a stream of items for ICR in a single pass, using a reservoir sample, so that the
+    memory needed does not grow with the number of items.
 
+    The sample can optionally be stratified, in which case each stratum (e.g. each day) is represented in the sample in
+    proportion to its number of items, and items can optionally be de-duplicated, in which case only the first item
+    with each de-duplication key (e.g. the message text) is eligible for sampling. De-duplicating requires a record of
+    every distinct key seen.
+    """
+    def __init__(self, sample_size, random_generator=None, stratify_fn=None, deduplicate_fn=None):
+        """
+        :param sample_size: Number of items to sample.
+        :type sample_size: int
+        :param random_generator: Random generator to sample with. Pass a seeded random.Random for a deterministic
+                                 sample. If None, uses the `random` module.
+        :type random_generator: random.Random | None
+        :param stratify_fn: Function which returns the stratum of an item, or None to not stratify the sample.
+        :type stratify_fn: (function of any -> hashable) | None
+        :param deduplicate_fn: Function which returns the key to de-duplicate an item on, or None to not de-duplicate
+                               the items.
+        :type deduplicate_fn: (function of any -> hashable) | None
+        """
         if random_generator is None:
             random_generator = random
-        if len(data) < sample_size:
-            log.warning(f"The size of the ICR data ({len(data)} items) is less than the requested sample_size "
+
+        self.sample_size = sample_size
+        self.random_generator = random_generator
+        self.stratify_fn = stratify_fn
+        self.deduplicate_fn = deduplicate_fn
+
+        self._reservoirs = dict()  # of stratum -> list of up to sample_size items sampled from that stratum
+        self._stratum_counts = dict()  # of stratum -> number of items added to that stratum
+        self._seen_keys = set()  # of de-duplication keys of the items added so far
+
+    def add(self, item):
+        """
+        Offers an item to the sample.
+
+        :param item: Item to offer.
+        :type item: any
+        """
+        if self.deduplicate_fn is not None:
+            key = self.deduplicate_fn(item)
+            if key in self._seen_keys:
+                return
+            self._seen_keys.add(key)
+
+        stratum = None if self.stratify_fn is None else self.stratify_fn(item)
+        if stratum not in self._reservoirs:
+            self._reservoirs[stratum] = []
+            self._stratum_counts[stratum] = 0
+        reservoir = self._reservoirs[stratum]
+        self._stratum_counts[stratum] += 1
+
+        # Algorithm R: the nth item replaces a random item in the reservoir with probability sample_size / n.
+        if len(reservoir) < self.sample_size:
+            reservoir.append(item)
+        else:
+            i = self.random_generator.randrange(self._stratum_counts[stratum])
+            if i < self.sample_size:
+                reservoir[i] = item
+
+    def _allocate_sample_sizes(self, sample_size):
+        """
+        Allocates the sample between the strata in proportion to their sizes, using the largest remainder method.
+
+        :return: Dictionary of stratum -> number of items to sample from that stratum.
+        :rtype: dict
+        """
+        total_count = sum(self._stratum_counts.values())
+        quotas = {stratum: sample_size * count / total_count for stratum, count in self._stratum_counts.items()}
+        allocations = {stratum: int(quota) for stratum, quota in quotas.items()}
+
+        # Give the remaining items to the strata with the largest remainders, breaking ties by the order the strata
+        # were first seen in so that the allocation is deterministic.
+        remaining = sample_size - sum(allocations.values())
+        by_remainder = sorted(quotas.keys(), key=lambda stratum: quotas[stratum] - allocations[stratum], reverse=True)
+        for stratum in by_remainder[:remaining]:
+            allocations[stratum] += 1
+
+        return allocations
+
+    def get_sample(self):
+        """
+        :return: The sampled items. If fewer than sample_size items were added, returns all of them.
+        :rtype: list
+        """
+        total_count = sum(self._stratum_counts.values())
+        sample_size = self.sample_size
+        if total_count < sample_size:
+            log.warning(f"The size of the ICR data ({total_count} items) is less than the requested sample_size "
                         f"({sample_size} items). Returning all the input data as ICR.")
-            sample_size = len(data)
+            sample_size = total_count
+
+        if sample_size == 0:
+            return []
 
-        return random_generator.sample(data, sample_size)
+        sample = []
+        for stratum, stratum_sample_size in self._allocate_sample_sizes(sample_size).items():
+            sample.extend(self.random_generator.sample(self._reservoirs[stratum], stratum_sample_size))
+        return sample
@@ -1,5 +1,6 @@
 from core_data_modules.logging import Logger
-from dateutil.parser import isoparse
+
+from src.lib.timestamp_index import TimestampIndex
 
 log = Logger(__name__)
 
@@ -51,13 +52,13 @@ class MessageFilters(object):
             for message_key in message_keys:
                 if message_key in td:
                     filtered.append(td)
-                    continue
+                    break
         log.info(f"Filtered out empty message objects. "
                  f"Returning {len(filtered)}/{len(messages)} messages.")
         return filtered
 
     @staticmethod
-    def filter_time_range(messages, time_key, start_time_inclusive, end_time_inclusive):
+    def filter_time_range(messages, time_key, start_time_inclusive, end_time_inclusive, time_index=None):
         """
         Filters a list of messages for messages received within the given time range.
 
@@ -72,17 +73,47 @@ class MessageFilters(object):
         :param end_time_inclusive: Exclusive end time of the time range to keep.
                          Messages sent after this time will be dropped.
         :type end_time_inclusive: datetime.datetime
+        :param time_index: Index of the messages on time_key, if one has already been built for these messages.
+                           If None, an index is built.
+        :type time_index: TimestampIndex | None
         :return: Filtered list.
         :rtype: list of TracedData
         """
         log.debug(f"Filtering out messages sent outside the time range "
                   f"{start_time_inclusive.isoformat()} to {end_time_inclusive.isoformat()}...")
-        filtered = [td for td in messages if start_time_inclusive <= isoparse(td[time_key]) < end_time_inclusive]
+        if time_index is None:
+            time_index = TimestampIndex(messages, time_key)
+        assert time_index.time_key == time_key
+        assert len(time_index) == len(messages), f"Not all messages contain the time key '{time_key}'"
+        in_range_positions = set(time_index.select_range(start_time_inclusive, end_time_inclusive))
+        filtered = [msg for i, msg in enumerate(messages) if i in in_range_positions]
         log.info(f"Filtered out messages sent outside the time range "
                  f"{start_time_inclusive.isoformat()} to {end_time_inclusive.isoformat()}. "
                  f"Returning {len(filtered)}/{len(messages)} messages.")
         return filtered
 
+    @staticmethod
+    def filter_flows(messages, flow_names, run_id_key_prefix="run_id - "):
+        """
+        Filters a list of messages for messages which were received by one of the given Rapid Pro flows.
+
+        :param messages: List of message objects to filter.
+        :type messages: list of TracedData
+        :param flow_names: Names of the flows to keep the messages of.
+        :type flow_names: iterable of str
+        :param run_id_key_prefix: Prefix of the key in each TracedData of the id of the run which received the
+                                  message. The full key is f"{run_id_key_prefix}{flow_name}".
+        :type run_id_key_prefix: str
+        :return: Filtered list.
+        :rtype: list of TracedData
+        """
+        log.debug("Filtering for messages from the given flows...")
+        run_id_keys = [f"{run_id_key_prefix}{flow_name}" for flow_name in flow_names]
+        filtered = [td for td in messages if any(run_id_key in td for run_id_key in run_id_keys)]
+        log.info(f"Filtered for messages from the given flows. "
+                 f"Returning {len(filtered)}/{len(messages)} messages.")
+        return filtered
+
     @staticmethod
     def filter_noise(messages, message_key, noise_fn):
         """
@@ -102,3 +133,94 @@ class MessageFilters(object):
         log.info(f"Filtered out messages identified as noise. "
                  f"Returning {len(filtered)}/{len(messages)} messages.")
         return filtered
+
+
+class MessageFilterChain(object):
+    """
+    Applies a sequence of message filters in a single pass over the messages, without building an intermediate list
+    after each filter.
+
+    Each message is tested against the filters in the order they were added, and is dropped by the first filter it
+    fails, so later filters are only evaluated on the messages which passed all the earlier ones. The number of
+    messages dropped by each filter is logged once all the messages have been filtered.
+
+    The filters match the equivalent functions in MessageFilters. Each add_* method returns this chain, so that calls
+    can be chained e.g. MessageFilterChain().add_test_messages_filter().add_empty_messages_filter(keys).
+    """
+    def __init__(self):
+        self._filters = []  # of (filter name, function of TracedData -> bool, which returns whether to keep the td)
+        self.messages_in = 0
+        self.drop_counts = dict()  # of filter name -> number of messages dropped by that filter in the last pass
+
+    def add_filter(self, name, keep_fn):
+        """
+        Adds a filter to the end of this chain.
+
+        :param name: Name of the filter, for logging.
+        :type name: str
+        :param keep_fn: Function which, given a message, returns whether to keep that message.
+        :type keep_fn: function of TracedData -> bool
+        :return: This chain.
+        :rtype: MessageFilterChain
+        """
+        assert name not in {filter_name for filter_name, _ in self._filters}, f"Duplicate filter name '{name}'"
+        self._filters.append((name, keep_fn))
+        return self
+
+    def add_test_messages_filter(self, test_run_key="test_run"):
+        """
+        Drops messages tagged as being test messages. See MessageFilters.filter_test_messages.
+        """
+        return self.add_filter("test messages", lambda td: not td.get(test_run_key, False))
+
+    def add_empty_messages_filter(self, message_keys):
+        """
+        Keeps messages which contain an answer in at least one of the given message_keys.
+        See MessageFilters.filter_empty_messages.
+        """
+        return self.add_filter("empty messages",
+                               lambda td: any(message_key in td for message_key in message_keys))
+
+    def add_time_range_filter(self, time_key, start_time_inclusive, end_time_exclusive):
+        """
+        Keeps messages sent within the given time range. See MessageFilters.filter_time_range.
+        """
+        start_epoch_micros = TimestampIndex.datetime_to_epoch_micros(start_time_inclusive)
+        end_epoch_micros = TimestampIndex.datetime_to_epoch_micros(end_time_exclusive)
+
+        def keep_fn(td):
+            epoch_micros = TimestampIndex.iso_string_to_epoch_micros(td[time_key])
+            return start_epoch_micros <= epoch_micros < end_epoch_micros
+
+        return self.add_filter(f"time range {start_time_inclusive.isoformat()} to {end_time_exclusive.isoformat()}",
+                               keep_fn)
+
+    def filter(self, messages):
+        """
+        Filters the given messages through every filter in this chain.
+
+        The messages are filtered lazily, as the returned generator is consumed. The drop counts are logged, and
+        are available in `drop_counts`, once the generator has been exhausted.
+
+        :param messages: Messages to filter.
+        :type messages: iterable of TracedData
+        :return: Generator of the messages which passed every filter, in their original order.
+        :rtype: generator of TracedData
+        """
+        self.messages_in = 0
+        self.drop_counts = {name: 0 for name, _ in self._filters}
+
+        messages_out = 0
+        for td in messages:
+            self.messages_in += 1
+            for name, keep_fn in self._filters:
+                if not keep_fn(td):
+                    self.drop_counts[name] += 1
+                    break
+            else:
+                messages_out += 1
+                yield td
+
+        for name, drop_count in self.drop_counts.items():
+            log.info(f"Filter '{name}' dropped {drop_count} messages")
+        log.info(f"Filtered messages. Returning {messages_out}/{self.messages_in} messages.")
@@ -0,0 +1,127 @@
+import hashlib
+import inspect
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pkg_resources
+from core_data_modules.cleaners import somali
+from core_data_modules.logging import Logger
+from core_data_modules.util import IOUtils
+
+log = Logger(__name__)
+
+
+class NoiseClassifier(object):
+    """
+    Classifies texts as noise using somali.DemographicCleaner.is_noise, classifying each distinct text only once.
+
+    The verdicts can be cached in a JSON file, so that each run only needs to classify the texts which have not been
+    seen in a previous run. The cache is discarded if min_length, the installed version of CoreDataModules, or the
+    source of somali.DemographicCleaner changes.
+    Texts which aren't in the cache are classified in batches, optionally on a pool of processes.
+    """
+    BATCH_SIZE = 1000
+
+    def __init__(self, min_length, cache_path=None, max_workers=1):
+        """
+        :param min_length: Minimum length of a text which isn't noise, passed to is_noise.
+        :type min_length: int
+        :param cache_path: Path to the JSON file to read and write the cached verdicts, or None to not cache the
+                           verdicts between runs.
+        :type cache_path: str | None
+        :param max_workers: Maximum number of processes to classify the texts with. If 1, the texts are classified in
+                            this process.
+        :type max_workers: int
+        """
+        self.min_length = min_length
+        self.cache_path = cache_path
+        self.max_workers = max_workers
+
+        self._classifier_version = self._get_classifier_version(min_length)
+        if self._classifier_version is None and cache_path is not None:
+            log.warning(f"Not caching noise verdicts in '{cache_path}', because the version of the noise classifier "
+                        f"can't be determined")
+            self.cache_path = cache_path = None
+
+        self._verdicts = dict()  # of text -> whether that text is noise
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path) as f:
+                cache = json.load(f)
+            if cache["classifier_version"] == self._classifier_version:
+                self._verdicts = cache["verdicts"]
+            else:
+                log.info(f"Ignoring the noise cache at '{cache_path}' because it was computed by a different "
+                         f"classifier")
+
+    @staticmethod
+    def _get_classifier_version(min_length):
+        """
+        :return: Hash identifying the classifier, or None if neither the installed version of CoreDataModules nor the
+                 source of somali.DemographicCleaner can be found.
+        :rtype: str | None
+        """
+        # The source is hashed as well as the version, because CoreDataModules is installed from git and its
+        # version isn't always updated when the cleaners change.
+        classifier_ids = []
+        try:
+            classifier_ids.append(f"CoreDataModules=={pkg_resources.get_distribution('CoreDataModules').version}")
+        except pkg_resources.DistributionNotFound:
+            pass
+        try:
+            classifier_ids.append(inspect.getsource(somali.DemographicCleaner))
+        except (OSError, TypeError):
+            pass
+
+        if len(classifier_ids) == 0:
+            return None
+
+        sha = hashlib.sha256()
+        sha.update(str(min_length).encode("utf-8"))
+        for classifier_id in classifier_ids:
+            sha.update(classifier_id.encode("utf-8"))
+        return sha.hexdigest()
+
+    def _write_cache(self):
+        if self.cache_path is None:
+            return
+
+        IOUtils.ensure_dirs_exist_for_file(self.cache_path)
+        temp_cache_path = f"{self.cache_path}.tmp"
+        with open(temp_cache_path, "w") as f:
+            json.dump({"classifier_version": self._classifier_version, "verdicts": self._verdicts}, f)
+        os.replace(temp_cache_path, self.cache_path)
+
+    @staticmethod
+    def _classify_batch(texts, min_length):
+        return [somali.DemographicCleaner.is_noise(text, min_length=min_length) for text in texts]
+
+    def classify(self, texts):
+        """
+        Classifies each of the given texts as noise or not noise.
+
+        :param texts: Texts to classify. May contain duplicates.
+        :type texts: iterable of str
+        :return: Dictionary of each distinct text in texts -> whether that text is noise.
+        :rtype: dict of str -> bool
+        """
+        distinct_texts = set(texts)
+        uncached_texts = sorted(text for text in distinct_texts if text not in self._verdicts)
+        log.info(f"Classifying {len(uncached_texts)} texts as noise or not noise "
+                 f"({len(distinct_texts) - len(uncached_texts)}/{len(distinct_texts)} distinct texts were cached)...")
+
+        if len(uncached_texts) > 0:
+            batches = [uncached_texts[i:i + self.BATCH_SIZE] for i in range(0, len(uncached_texts), self.BATCH_SIZE)]
+            if self.max_workers == 1 or len(batches) == 1:
+                batch_verdicts = [self._classify_batch(batch, self.min_length) for batch in batches]
+            else:
+                with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                    batch_verdicts = list(executor.map(self._classify_batch, batches,
+                                                       [self.min_length] * len(batches)))
+
+            for batch, verdicts in zip(batches, batch_verdicts):
+                for text, is_noise in zip(batch, verdicts):
+                    self._verdicts[text] = is_noise
+            self._write_cache()
+
+        return {text: self._verdicts[text] for text in distinct_texts}
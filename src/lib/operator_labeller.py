@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+
+from core_data_modules.cleaners import Codes, PhoneCleaner
+from core_data_modules.cleaners.cleaning_utils import CleaningUtils
+from core_data_modules.logging import Logger
+from core_data_modules.traced_data import Metadata
+from core_data_modules.util import IOUtils, TimeUtils
+
+from src.lib.code_schemes import CodeSchemes
+
+log = Logger(__name__)
+
+
+class OperatorLabeller(object):
+    """
+    Labels TracedData with the operator of the phone number each one was sent from.
+
+    The operator of each avf_phone_id is only computed once, and is saved to a json file so that it can be re-used
+    by later runs. The phone number behind an avf_phone_id never changes, so neither does its operator.
+    """
+    def __init__(self, phone_number_uuid_table, cache_path):
+        """
+        :param phone_number_uuid_table: Phone number <-> uuid table to use to look up the phone numbers of
+                                        avf_phone_ids which are not in the cache.
+        :type phone_number_uuid_table: id_infrastructure.firestore_uuid_table.FirestoreUuidTable
+        :param cache_path: Path to the json file to read and write the avf_phone_id -> operator code cache.
+        :type cache_path: str
+        """
+        self.phone_number_uuid_table = phone_number_uuid_table
+        self.cache_path = cache_path
+
+        # Several flows may be labelled at once by fetch_raw_data.py, so serialise access to the cache.
+        self._lock = threading.Lock()
+        self._uuid_to_operator_code = dict()
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                self._uuid_to_operator_code = json.load(f)
+            log.info(f"Loaded the operator codes of {len(self._uuid_to_operator_code)} phone numbers from "
+                     f"'{cache_path}'")
+
+        self._operator_code_to_label = dict()  # of operator code -> operator_coded Label
+
+    def _get_label(self, operator_code):
+        if operator_code not in self._operator_code_to_label:
+            if operator_code == Codes.NOT_CODED:
+                code = CodeSchemes.SOMALIA_OPERATOR.get_code_with_control_code(Codes.NOT_CODED)
+            else:
+                code = CodeSchemes.SOMALIA_OPERATOR.get_code_with_match_value(operator_code)
+            self._operator_code_to_label[operator_code] = CleaningUtils.make_label_from_cleaner_code(
+                CodeSchemes.SOMALIA_OPERATOR, code, Metadata.get_call_location()
+            )
+        # Serialize a new dict for each message, so that no two TracedData objects share a mutable label.
+        return self._operator_code_to_label[operator_code].to_dict()
+
+    def _save(self):
+        IOUtils.ensure_dirs_exist_for_file(self.cache_path)
+        temp_cache_path = f"{self.cache_path}.tmp"
+        with open(temp_cache_path, "w") as f:
+            json.dump(self._uuid_to_operator_code, f)
+        os.replace(temp_cache_path, self.cache_path)
+
+    def set_operator_codes(self, user, data, uuid_key="avf_phone_id", operator_key="operator_coded"):
+        """
+        Sets the operator label of each TracedData object.
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param data: TracedData objects to set the operator labels of.
+        :type data: iterable of TracedData
+        :param uuid_key: Key in each TracedData object of the avf_phone_id to look up the operator of.
+        :type uuid_key: str
+        :param operator_key: Key in each TracedData object to write the operator label to.
+        :type operator_key: str
+        """
+        with self._lock:
+            uncached_uuids = {td[uuid_key] for td in data if td[uuid_key] not in self._uuid_to_operator_code}
+            log.info(f"Looking up the operators of {len(uncached_uuids)} uncached phone numbers...")
+            if len(uncached_uuids) > 0:
+                uuid_to_phone_lut = self.phone_number_uuid_table.uuid_to_data_batch(uncached_uuids)
+                for uuid in uncached_uuids:
+                    self._uuid_to_operator_code[uuid] = PhoneCleaner.clean_operator(uuid_to_phone_lut[uuid])
+                self._save()
+
+            metadata = Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
+            for td in data:
+                td.append_data({operator_key: self._get_label(self._uuid_to_operator_code[td[uuid_key]])}, metadata)
@@ -411,6 +411,20 @@ class PipelineConfiguration(object):
 
         self.validate()
 
+        # Compile the rapid_pro_key_remappings into lookup tables, so that translating the keys of each message only
+        # needs to look up the keys the message has, rather than search all of the remappings.
+        self.activation_message_remappings = dict()  # of Rapid Pro key -> pipeline key
+        self.key_remappings = dict()  # of Rapid Pro key -> list of (index of the remapping, pipeline key)
+        for i, remapping in enumerate(self.rapid_pro_key_remappings):
+            if remapping.is_activation_message:
+                assert remapping.rapid_pro_key not in self.activation_message_remappings, \
+                    f"Duplicate activation message remapping for Rapid Pro key '{remapping.rapid_pro_key}'"
+                self.activation_message_remappings[remapping.rapid_pro_key] = remapping.pipeline_key
+            else:
+                if remapping.rapid_pro_key not in self.key_remappings:
+                    self.key_remappings[remapping.rapid_pro_key] = []
+                self.key_remappings[remapping.rapid_pro_key].append((i, remapping.pipeline_key))
+
     @classmethod
     def from_configuration_dict(cls, configuration_dict):
         rapid_pro_domain = configuration_dict["RapidProDomain"]
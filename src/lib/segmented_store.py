@@ -0,0 +1,233 @@
+import json
+import os
+import threading
+
+from core_data_modules.logging import Logger
+from core_data_modules.util import IOUtils
+
+log = Logger(__name__)
+
+
+class SegmentedStore(object):
+    """
+    Append-only store for raw Rapid Pro objects (e.g. runs or contacts), for use in place of re-writing a single
+    json file of every object on each fetch.
+
+    The store is a directory of segments, each of which is a JSONL file of serialized objects, plus an index of
+    the id, modified_on, and segment of the latest version of every object. Saving only appends the objects which are
+    new or have been modified since they were last saved, as a new segment. Older versions of modified objects stay in
+    their original segments until the store is compacted, which re-writes all the latest versions into a single
+    segment and deletes the rest.
+    """
+    INDEX_FILE_NAME = "index.json"
+
+    # Compact when there are more superseded objects than live ones, or when the store has more than this many segments.
+    MAX_SEGMENTS = 16
+
+    def __init__(self, dir_path, deserialize_fn, id_fn, modified_on_fn):
+        """
+        :param dir_path: Directory to store the segments and index in.
+        :type dir_path: str
+        :param deserialize_fn: Function which deserializes an object e.g. temba_client.v2.types.Run.deserialize.
+        :type deserialize_fn: function of dict -> any
+        :param id_fn: Function which returns the id of an object e.g. lambda run: run.id.
+        :type id_fn: function of any -> int | str
+        :param modified_on_fn: Function which returns the time an object was last modified e.g.
+                               lambda run: run.modified_on.
+        :type modified_on_fn: function of any -> datetime.datetime
+        """
+        self.dir_path = dir_path
+        self.deserialize_fn = deserialize_fn
+        self.id_fn = id_fn
+        self.modified_on_fn = modified_on_fn
+
+        self._lock = threading.Lock()
+        self._compaction_thread = None
+        self._index = self._read_index()
+
+    def _index_path(self):
+        return os.path.join(self.dir_path, self.INDEX_FILE_NAME)
+
+    def _read_index(self):
+        try:
+            with open(self._index_path()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {
+                "next_segment_number": 0,
+                "segment_sizes": dict(),  # of segment file name -> number of objects in that segment
+                "objects": dict()  # of str(id) -> [modified_on iso string, segment file name]
+            }
+
+    def _write_index(self):
+        # Write to a temporary file then rename, so that an interrupted write can't corrupt the existing index.
+        IOUtils.ensure_dirs_exist(self.dir_path)
+        temp_index_path = f"{self._index_path()}.tmp"
+        with open(temp_index_path, "w") as f:
+            json.dump(self._index, f)
+        os.replace(temp_index_path, self._index_path())
+
+    def _new_segment_name(self):
+        segment_name = f"segment-{self._index['next_segment_number']:06d}.jsonl"
+        self._index["next_segment_number"] += 1
+        return segment_name
+
+    def _write_segment(self, segment_name, objs):
+        """
+        Writes the given objects to a new segment.
+
+        :return: Number of objects written.
+        :rtype: int
+        """
+        IOUtils.ensure_dirs_exist(self.dir_path)
+        count = 0
+        with open(os.path.join(self.dir_path, segment_name), "w") as f:
+            for obj in objs:
+                f.write(json.dumps(obj.serialize()))
+                f.write("\n")
+                count += 1
+
+        return count
+
+    def exists(self):
+        """
+        :return: Whether any objects have been saved to this store.
+        :rtype: bool
+        """
+        return len(self._index["segment_sizes"]) > 0
+
+    def __len__(self):
+        return len(self._index["objects"])
+
+    def _iterate_segments(self, objects, segment_names):
+        for segment_name in segment_names:
+            with open(os.path.join(self.dir_path, segment_name)) as f:
+                for line in f:
+                    obj = self.deserialize_fn(json.loads(line))
+                    # Skip versions of this object which have been superseded by a later segment.
+                    if objects[str(self.id_fn(obj))][1] == segment_name:
+                        yield obj
+
+    def iterate(self):
+        """
+        Lazily reads the latest version of every object in this store, one segment at a time.
+
+        :return: Generator of the objects in this store.
+        :rtype: generator of any
+        """
+        with self._lock:
+            objects = dict(self._index["objects"])
+            segment_names = sorted(self._index["segment_sizes"].keys())
+
+        yield from self._iterate_segments(objects, segment_names)
+
+    def load(self):
+        """
+        :return: The latest version of every object in this store.
+        :rtype: list of any
+        """
+        return list(self.iterate())
+
+    def save(self, objs):
+        """
+        Appends the objects which are not already in this store, or which have a different modified_on to the
+        version already in this store, as a new segment.
+
+        :param objs: Objects to save.
+        :type objs: iterable of any
+        :return: Number of objects which were appended.
+        :rtype: int
+        """
+        with self._lock:
+            changed = []
+            for obj in objs:
+                stored = self._index["objects"].get(str(self.id_fn(obj)))
+                if stored is None or stored[0] != self.modified_on_fn(obj).isoformat():
+                    changed.append(obj)
+
+            if len(changed) == 0:
+                return 0
+
+            segment_name = self._new_segment_name()
+            self._index["segment_sizes"][segment_name] = self._write_segment(segment_name, changed)
+            for obj in changed:
+                self._index["objects"][str(self.id_fn(obj))] = [self.modified_on_fn(obj).isoformat(), segment_name]
+            self._write_index()
+
+        return len(changed)
+
+    def migrate_from_json(self, json_path):
+        """
+        Imports a json file of serialized objects written by a previous version of fetch_raw_data.py, then renames
+        that file to `<json_path>.bak`, so that it is kept as a backup but isn't migrated again.
+        Does nothing if json_path does not exist or if this store already contains objects.
+
+        :param json_path: Path to the json file to migrate.
+        :type json_path: str
+        """
+        if self.exists() or not os.path.exists(json_path):
+            return
+
+        log.info(f"Migrating '{json_path}' to a segmented store at '{self.dir_path}'...")
+        with open(json_path) as f:
+            objs = [self.deserialize_fn(obj_json) for obj_json in json.load(f)]
+        self.save(objs)
+        os.replace(json_path, f"{json_path}.bak")
+        log.info(f"Migrated {len(objs)} objects. The original file was kept at '{json_path}.bak'")
+
+    def needs_compaction(self):
+        """
+        :return: Whether this store has enough superseded objects or segments that it should be compacted.
+        :rtype: bool
+        """
+        with self._lock:
+            total_count = sum(self._index["segment_sizes"].values())
+            live_count = len(self._index["objects"])
+            return total_count - live_count > live_count or \
+                len(self._index["segment_sizes"]) > self.MAX_SEGMENTS
+
+    def compact(self):
+        """
+        Re-writes the latest version of every object into a single segment, and deletes the segments it replaces.
+
+        The objects are streamed from the old segments into the new one, so the store is never held in memory.
+        Objects may be saved while the store is compacting: the segments they are saved to are kept, and the index
+        continues to point to those newer versions.
+        """
+        with self._lock:
+            objects = dict(self._index["objects"])
+            old_segment_names = sorted(self._index["segment_sizes"].keys())
+            segment_name = self._new_segment_name()
+
+        segment_size = self._write_segment(segment_name, self._iterate_segments(objects, old_segment_names))
+
+        with self._lock:
+            for obj_id, (modified_on, stored_segment_name) in objects.items():
+                # Only re-point objects which haven't been saved again since the snapshot. The stored lists are
+                # replaced rather than updated, because they are shared with the snapshots taken by `iterate`.
+                if self._index["objects"][obj_id][1] == stored_segment_name:
+                    self._index["objects"][obj_id] = [modified_on, segment_name]
+            for old_segment_name in old_segment_names:
+                del self._index["segment_sizes"][old_segment_name]
+            self._index["segment_sizes"][segment_name] = segment_size
+            self._write_index()
+
+        for old_segment_name in old_segment_names:
+            os.remove(os.path.join(self.dir_path, old_segment_name))
+        log.info(f"Compacted {len(old_segment_names)} segments of '{self.dir_path}' into 1")
+
+    def compact_in_background(self):
+        """
+        Compacts this store on a background thread, if it needs compaction. Call `wait_for_compaction` before the
+        program exits to ensure the compaction completes.
+        """
+        if not self.needs_compaction():
+            return
+
+        self._compaction_thread = threading.Thread(target=self.compact)
+        self._compaction_thread.start()
+
+    def wait_for_compaction(self):
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
+            self._compaction_thread = None
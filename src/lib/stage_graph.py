@@ -0,0 +1,243 @@
+import glob
+import hashlib
+import json
+import os
+
+from core_data_modules.logging import Logger
+from core_data_modules.traced_data.io import TracedDataJsonIO
+from core_data_modules.util import IOUtils
+
+log = Logger(__name__)
+
+
+def hash_file(file_path):
+    """
+    :return: sha256 of the contents of the given file, or None if the file does not exist.
+    :rtype: str | None
+    """
+    if not os.path.exists(file_path):
+        return None
+
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_files(root_dir, file_patterns):
+    """
+    :param root_dir: Directory the file patterns are relative to.
+    :type root_dir: str
+    :param file_patterns: Glob patterns of the files to hash, relative to root_dir. Each pattern must match at least
+                          one file.
+    :type file_patterns: iterable of str
+    :return: sha256 of the paths, relative to root_dir, and contents of all the files matching the given patterns.
+    :rtype: str
+    """
+    sha = hashlib.sha256()
+    for pattern in file_patterns:
+        file_paths = sorted(glob.glob(os.path.join(root_dir, pattern), recursive=True))
+        assert len(file_paths) > 0, f"No files in '{root_dir}' match the pattern '{pattern}'"
+        for file_path in file_paths:
+            sha.update(os.path.relpath(file_path, root_dir).encode("utf-8"))
+            sha.update(str(hash_file(file_path)).encode("utf-8"))
+    return sha.hexdigest()
+
+
+class PipelineStage(object):
+    def __init__(self, name, run_fn, upstream=None, input_paths=None, output_paths=None, output_count=1,
+                 cacheable=True):
+        """
+        :param name: Name of this stage. Must be unique within a StageGraph.
+        :type name: str
+        :param run_fn: Function which runs this stage. It is passed the outputs of each of the upstream stages,
+                       in order, and must return a list of TracedData if output_count is 1, otherwise a tuple of
+                       output_count lists of TracedData.
+                       run_fn may modify the TracedData it is passed, so each stage's output should only be used by
+                       one downstream stage.
+        :type run_fn: function
+        :param upstream: Names of the stages whose outputs are the inputs to this stage.
+        :type upstream: list of str | None
+        :param input_paths: Paths to the files, other than the upstream outputs, which this stage reads from.
+        :type input_paths: list of str | None
+        :param output_paths: Paths to the files which this stage writes to, other than its returned outputs.
+        :type output_paths: list of str | None
+        :param output_count: Number of datasets returned by run_fn.
+        :type output_count: int
+        :param cacheable: Whether to cache the outputs of this stage. Set to False for stages which are cheaper to
+                          re-run than to read back from the cache.
+        :type cacheable: bool
+        """
+        if upstream is None:
+            upstream = []
+        if input_paths is None:
+            input_paths = []
+        if output_paths is None:
+            output_paths = []
+
+        self.name = name
+        self.run_fn = run_fn
+        self.upstream = upstream
+        self.input_paths = input_paths
+        self.output_paths = output_paths
+        self.output_count = output_count
+        self.cacheable = cacheable
+
+
+class StageGraph(object):
+    """
+    Runs a directed acyclic graph of PipelineStages, optionally caching the outputs of each stage.
+
+    Each stage's cache key is a hash of the graph's fingerprint, the stage's name, the cache keys of its upstream
+    stages, and the contents of its input files, so the keys of all the stages can be computed before anything is run.
+    A stage is invalidated if it has no cached outputs under its key, if any of its output files have changed since
+    it was cached, or if any of its upstream stages are invalidated. Only invalidated stages are re-run, and cached
+    outputs are only read back where an invalidated stage needs them as inputs.
+    """
+    def __init__(self, stages, cache_dir=None, fingerprint="", stage_metrics=None):
+        """
+        :param stages: Stages in this graph, in an order where every stage appears after all of its upstream stages.
+        :type stages: list of PipelineStage
+        :param cache_dir: Directory to cache stage outputs in, or None to run every stage without caching.
+        :type cache_dir: str | None
+        :param fingerprint: String to include in every stage's cache key e.g. a hash of the pipeline configuration
+                            and code.
+        :type fingerprint: str
+        :param stage_metrics: StageMetrics to record the metrics of each stage which is run in, or None to not
+                              record metrics.
+        :type stage_metrics: src.lib.stage_metrics.StageMetrics | None
+        """
+        self.stages = dict()
+        for stage in stages:
+            assert stage.name not in self.stages, f"Duplicate stage name '{stage.name}'"
+            for upstream_name in stage.upstream:
+                assert upstream_name in self.stages, \
+                    f"Stage '{stage.name}' has upstream stage '{upstream_name}', which is not before it in the graph"
+            self.stages[stage.name] = stage
+
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+        self.stage_metrics = stage_metrics
+
+        self._keys = dict()  # of stage name -> cache key
+        for stage in stages:
+            self._keys[stage.name] = self._compute_key(stage)
+
+        self._invalidated = dict()  # of stage name -> bool
+        for stage in stages:
+            self._invalidated[stage.name] = self._compute_invalidated(stage)
+
+        self._outputs = dict()  # of stage name -> output of that stage
+
+    def _compute_key(self, stage):
+        key_components = [
+            self.fingerprint,
+            stage.name,
+            [self._keys[upstream_name] for upstream_name in stage.upstream],
+            [[input_path, hash_file(input_path)] for input_path in stage.input_paths]
+        ]
+        return hashlib.sha256(json.dumps(key_components).encode("utf-8")).hexdigest()
+
+    def _manifest_path(self, stage):
+        return os.path.join(self.cache_dir, f"{stage.name}-{self._keys[stage.name]}.json")
+
+    def _dataset_path(self, stage, i):
+        return os.path.join(self.cache_dir, f"{stage.name}-{self._keys[stage.name]}-{i}.jsonl")
+
+    def _is_cached(self, stage):
+        if self.cache_dir is None or not stage.cacheable or not os.path.exists(self._manifest_path(stage)):
+            return False
+
+        with open(self._manifest_path(stage)) as f:
+            manifest = json.load(f)
+        for output_path, output_hash in manifest["output_hashes"].items():
+            if hash_file(output_path) != output_hash:
+                log.info(f"Output file '{output_path}' of stage '{stage.name}' has changed since it was cached")
+                return False
+        return True
+
+    def _compute_invalidated(self, stage):
+        if any(self._invalidated[upstream_name] for upstream_name in stage.upstream):
+            return True
+        return stage.cacheable and not self._is_cached(stage)
+
+    def _save(self, stage, output):
+        datasets = [output] if stage.output_count == 1 else list(output)
+        assert len(datasets) == stage.output_count, \
+            f"Stage '{stage.name}' returned {len(datasets)} datasets, but has output_count {stage.output_count}"
+
+        # Delete the outputs cached for this stage under any other key, because those can no longer be used.
+        IOUtils.ensure_dirs_exist(self.cache_dir)
+        for stale_path in glob.glob(os.path.join(glob.escape(self.cache_dir), f"{stage.name}-*")):
+            if not os.path.basename(stale_path).startswith(f"{stage.name}-{self._keys[stage.name]}"):
+                os.remove(stale_path)
+
+        for i, dataset in enumerate(datasets):
+            with open(self._dataset_path(stage, i), "w") as f:
+                TracedDataJsonIO.export_traced_data_iterable_to_jsonl(dataset, f)
+
+        # Write the manifest last, so that a stage is only considered cached once all of its datasets are written.
+        with open(self._manifest_path(stage), "w") as f:
+            json.dump({"output_hashes": {output_path: hash_file(output_path) for output_path in stage.output_paths}},
+                      f)
+
+    def _load(self, stage):
+        log.info(f"Loading the cached outputs of stage '{stage.name}'...")
+        datasets = []
+        for i in range(stage.output_count):
+            with open(self._dataset_path(stage, i)) as f:
+                datasets.append(TracedDataJsonIO.import_jsonl_to_traced_data_iterable(f))
+        return datasets[0] if stage.output_count == 1 else tuple(datasets)
+
+    def _get_output(self, stage_name):
+        if stage_name in self._outputs:
+            return self._outputs.pop(stage_name)
+
+        stage = self.stages[stage_name]
+        if not self._invalidated[stage_name] and stage.cacheable:
+            return self._load(stage)
+
+        return self._run(stage)
+
+    def _run(self, stage):
+        upstream_outputs = [self._get_output(upstream_name) for upstream_name in stage.upstream]
+        log.info(f"Running stage '{stage.name}'...")
+        if self.stage_metrics is None:
+            output = stage.run_fn(*upstream_outputs)
+        else:
+            output = self.stage_metrics.measure(stage.name, stage.run_fn, upstream_outputs)
+        if self.cache_dir is not None and stage.cacheable:
+            self._save(stage, output)
+        return output
+
+    def needs_run(self):
+        """
+        :return: Whether any of the stages in this graph are invalidated, and so will be run by `run`.
+        :rtype: bool
+        """
+        return any(self._invalidated.values())
+
+    def run(self):
+        """
+        Runs all the invalidated stages in this graph.
+
+        :return: Dictionary of stage name -> output, for each stage which was run and whose output was not used as
+                 the input to another stage.
+        :rtype: dict of str -> (list of TracedData | tuple of list of TracedData)
+        """
+        for stage_name, stage in self.stages.items():
+            if not self._invalidated[stage_name]:
+                log.info(f"Skipping stage '{stage_name}' because its cached outputs are still valid")
+                continue
+
+            # Only run the stages which are not an input to another invalidated stage here. The others are run
+            # when their downstream stage requests their output.
+            is_upstream_of_invalidated = any(
+                stage_name in downstream.upstream and self._invalidated[downstream.name]
+                for downstream in self.stages.values()
+            )
+            if not is_upstream_of_invalidated:
+                self._outputs[stage_name] = self._run(stage)
+
+        return self._outputs
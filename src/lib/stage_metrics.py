@@ -0,0 +1,139 @@
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+
+from core_data_modules.logging import Logger
+from core_data_modules.util import IOUtils
+
+log = Logger(__name__)
+
+
+class StageMetrics(object):
+    """
+    Measures the wall time, CPU time, number of records in and out, and optionally the peak memory allocated by each
+    stage run by a src.lib.stage_graph.StageGraph, and writes them to a JSON report.
+
+    Tracing memory allocations slows down the stages being measured, so the timings in a report with traced memory
+    are only comparable with the timings in other reports with traced memory.
+
+    Only the work done in this process is measured. CPU time and memory used by child processes which a stage starts
+    (e.g. to load the raw data, correct wrong schemes, classify noise, or export Coda files on several workers) are
+    not included, so the report notes that these are excluded.
+    """
+    REPORT_FILE_NAME = "stage_metrics.json"
+
+    def __init__(self, output_dir, profile_stages=False, trace_memory=False):
+        """
+        :param output_dir: Directory to write the report to, and the cProfile stats of each stage if profile_stages
+                           is True.
+        :type output_dir: str
+        :param profile_stages: Whether to also profile each stage with cProfile. The stats for each stage are written
+                               to <output_dir>/<stage name>.prof, which can be read by pstats or converted to a
+                               flamegraph with e.g. flameprof.
+        :type profile_stages: bool
+        :param trace_memory: Whether to also measure the peak memory allocated by each stage, using tracemalloc.
+                             If False, the peak memory of each stage is reported as None.
+        :type trace_memory: bool
+        """
+        self.output_dir = output_dir
+        self.profile_stages = profile_stages
+        self.trace_memory = trace_memory
+
+        self._stages = []  # of dict of metric name -> value, in the order the stages were run
+
+    @staticmethod
+    def _count_records(datasets):
+        """
+        :param datasets: Outputs of one or more stages, each either a list of TracedData or a tuple of lists of
+                         TracedData.
+        :type datasets: list of (list of TracedData | tuple of list of TracedData)
+        :return: Total number of TracedData objects in the given datasets.
+        :rtype: int
+        """
+        count = 0
+        for dataset in datasets:
+            if isinstance(dataset, tuple):
+                count += sum(len(d) for d in dataset)
+            else:
+                count += len(dataset)
+        return count
+
+    def _write_report(self):
+        IOUtils.ensure_dirs_exist(self.output_dir)
+        report_path = os.path.join(self.output_dir, self.REPORT_FILE_NAME)
+        temp_report_path = f"{report_path}.tmp"
+        with open(temp_report_path, "w") as f:
+            json.dump({
+                "notes": "CPU time and peak allocated memory only include the work done in the pipeline's own "
+                         "process. Work done in forked or pooled worker processes is not measured, although it is "
+                         "included in the wall time.",
+                "stages": self._stages
+            }, f, indent=2)
+        os.replace(temp_report_path, report_path)
+
+    def measure(self, stage_name, run_fn, inputs):
+        """
+        Runs a stage, recording its metrics, and updates the report.
+
+        :param stage_name: Name of the stage to run.
+        :type stage_name: str
+        :param run_fn: Function which runs the stage.
+        :type run_fn: function
+        :param inputs: Arguments to pass to run_fn, one per upstream stage.
+        :type inputs: list of (list of TracedData | tuple of list of TracedData)
+        :return: The output of run_fn.
+        :rtype: list of TracedData | tuple of list of TracedData
+        """
+        records_in = self._count_records(inputs)
+
+        # tracemalloc in Python 3.6 can't reset the peak, so restart tracing to measure the peak of this stage alone.
+        if self.trace_memory:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            tracemalloc.start()
+
+        profile = cProfile.Profile() if self.profile_stages else None
+
+        start_wall_time = time.perf_counter()
+        start_cpu_time = time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            output = run_fn(*inputs)
+        finally:
+            if profile is not None:
+                profile.disable()
+            wall_time = time.perf_counter() - start_wall_time
+            cpu_time = time.process_time() - start_cpu_time
+            peak_allocated_bytes = None
+            if self.trace_memory:
+                _, peak_allocated_bytes = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+        # Throughput is measured on the stage's inputs, or on its outputs for stages which have no inputs.
+        records_out = self._count_records([output])
+        throughput_records = records_in if records_in > 0 else records_out
+
+        metrics = {
+            "name": stage_name,
+            "wall_time_seconds": wall_time,
+            "cpu_time_seconds": cpu_time,
+            "records_in": records_in,
+            "records_out": records_out,
+            "records_per_second": throughput_records / wall_time if wall_time > 0 else None,
+            "peak_allocated_bytes": peak_allocated_bytes
+        }
+        peak_allocated_message = "" if peak_allocated_bytes is None else \
+            f", peak allocated {peak_allocated_bytes / (1024 * 1024):.1f} MiB"
+        log.info(f"Stage '{stage_name}' took {wall_time:.1f}s ({cpu_time:.1f}s CPU), {records_in} records in, "
+                 f"{records_out} records out{peak_allocated_message}")
+        self._stages.append(metrics)
+        self._write_report()
+
+        if profile is not None:
+            IOUtils.ensure_dirs_exist(self.output_dir)
+            profile.dump_stats(os.path.join(self.output_dir, f"{stage_name}.prof"))
+
+        return output
@@ -0,0 +1,85 @@
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+import pytz
+from dateutil.parser import isoparse
+
+_EPOCH = pytz.utc.localize(datetime(1970, 1, 1))
+_MICROSECOND = timedelta(microseconds=1)
+
+
+class TimestampIndex(object):
+    """
+    Index of the TracedData in a dataset, sorted by the time in one of their keys, for selecting the TracedData in a
+    time range in O(log n).
+
+    Building an index parses the time of every TracedData, so build one index per dataset and time key and share it
+    between all the selections on that dataset. The index is not updated when the data is, so TracedData whose time
+    key has since been changed or hidden will still be selected by their original time.
+    """
+    def __init__(self, data, time_key):
+        """
+        :param data: TracedData objects to index. TracedData which don't contain the time_key are not indexed.
+        :type data: iterable of TracedData
+        :param time_key: Key in each TracedData of an ISO 8601-formatted datetime string to index on.
+        :type time_key: str
+        """
+        entries = sorted(
+            (self.iso_string_to_epoch_micros(td[time_key]), i) for i, td in enumerate(data) if time_key in td
+        )
+        self.time_key = time_key
+        self._epoch_micros = [epoch_micros for epoch_micros, _ in entries]
+        self._positions = [i for _, i in entries]  # In the same (time) order as self._epoch_micros
+
+    def __len__(self):
+        return len(self._positions)
+
+    @staticmethod
+    def iso_string_to_epoch_micros(iso_string):
+        """
+        :param iso_string: Timezone-aware, ISO 8601-formatted datetime string.
+        :type iso_string: str
+        :return: Microseconds since the epoch.
+        :rtype: int
+        """
+        return TimestampIndex.datetime_to_epoch_micros(isoparse(iso_string))
+
+    @staticmethod
+    def datetime_to_epoch_micros(dt):
+        """
+        :param dt: Timezone-aware datetime.
+        :type dt: datetime
+        :return: Microseconds since the epoch.
+        :rtype: int
+        """
+        return (dt - _EPOCH) // _MICROSECOND
+
+    def select_range(self, range_start_inclusive=None, range_end_exclusive=None):
+        """
+        :param range_start_inclusive: Start of the time range to select, inclusive. If None, defaults to the
+                                      beginning of time.
+        :type range_start_inclusive: datetime | None
+        :param range_end_exclusive: End of the time range to select, exclusive. If None, defaults to the end of time.
+        :type range_end_exclusive: datetime | None
+        :return: Positions, in the indexed data, of the TracedData whose time is in the given range, in time order.
+        :rtype: list of int
+        """
+        start = 0
+        if range_start_inclusive is not None:
+            start = bisect_left(self._epoch_micros, self.datetime_to_epoch_micros(range_start_inclusive))
+
+        end = len(self._epoch_micros)
+        if range_end_exclusive is not None:
+            end = bisect_left(self._epoch_micros, self.datetime_to_epoch_micros(range_end_exclusive))
+
+        return self._positions[start:end]
+
+    def select_after(self, time_exclusive):
+        """
+        :param time_exclusive: Time to select the TracedData after, exclusive.
+        :type time_exclusive: datetime
+        :return: Positions, in the indexed data, of the TracedData whose time is after time_exclusive, in time order.
+        :rtype: list of int
+        """
+        start = bisect_left(self._epoch_micros, self.datetime_to_epoch_micros(time_exclusive) + 1)
+        return self._positions[start:]
@@ -0,0 +1,260 @@
+import json
+import os
+
+from core_data_modules.logging import Logger
+from core_data_modules.traced_data.io import TracedDataJsonIO
+from core_data_modules.util import IOUtils
+from storage.google_cloud import google_cloud_utils
+
+from src.analysis_file import AnalysisFile
+from src.apply_manual_codes import ApplyManualCodes
+from src.auto_code_show_messages import AutoCodeShowMessages
+from src.auto_code_surveys import AutoCodeSurveys
+from src.lib import PipelineConfiguration, MessageFilters
+from src.lib.drive_uploader import DriveUploader
+from src.lib.pipeline_configuration import CodeSchemes
+from src.lib.stage_graph import PipelineStage
+from src.production_file import ProductionFile
+from src.translate_rapid_pro_keys import TranslateRapidProKeys
+from src.ws_correction import WSCorrection
+
+log = Logger(__name__)
+
+
+class LocationPipeline(object):
+    """
+    The stages of generate_outputs.py which are specific to one location (i.e. to one pipeline configuration), from
+    filtering the combined raw data for the location's operator to writing the analysis files.
+    """
+    def __init__(self, user, pipeline_configuration, prev_coded_dir_path, messages_json_output_path,
+                 individuals_json_output_path, icr_output_dir, coded_dir_path, csv_by_message_output_path,
+                 csv_by_individual_output_path, production_csv_output_path, drive_upload_manifest_path=None,
+                 max_stage_workers=1, field_stats_output_path=None, noise_cache_path=None):
+        """
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param pipeline_configuration: Pipeline configuration for this location.
+        :type pipeline_configuration: PipelineConfiguration
+        :param prev_coded_dir_path: Directory containing Coda files generated by a previous run of this pipeline.
+        :type prev_coded_dir_path: str
+        :param messages_json_output_path: Path to a JSONL file to write the messages TracedData to.
+        :type messages_json_output_path: str
+        :param individuals_json_output_path: Path to a JSONL file to write the individuals TracedData to.
+        :type individuals_json_output_path: str
+        :param icr_output_dir: Directory to write the ICR CSVs to.
+        :type icr_output_dir: str
+        :param coded_dir_path: Directory to write coded Coda files to.
+        :type coded_dir_path: str
+        :param csv_by_message_output_path: Path to write the messages analysis CSV to.
+        :type csv_by_message_output_path: str
+        :param csv_by_individual_output_path: Path to write the individuals analysis CSV to.
+        :type csv_by_individual_output_path: str
+        :param production_csv_output_path: Path to write the production CSV to.
+        :type production_csv_output_path: str
+        :param drive_upload_manifest_path: Path to a json file to record the hashes of the files uploaded to Google
+                                           Drive in, so that unchanged files are not uploaded again, or None to upload
+                                           every file.
+        :type drive_upload_manifest_path: str | None
+        :param max_stage_workers: Maximum number of processes that each of the stages which can be run in parallel
+                                  (the noise classification, and the Coda and ICR exports)
+                                  may use.
+        :type max_stage_workers: int
+        :param field_stats_output_path: Path to write a JSON file of statistics about the raw radio show and survey
+                                        fields to, or None to only log them.
+        :type field_stats_output_path: str | None
+        :param noise_cache_path: Path to a JSON file to cache whether each message text is noise in between runs, or
+                                 None to classify every text on every run.
+        :type noise_cache_path: str | None
+        """
+        self.user = user
+        self.pipeline_configuration = pipeline_configuration
+        self.prev_coded_dir_path = prev_coded_dir_path
+        self.messages_json_output_path = messages_json_output_path
+        self.individuals_json_output_path = individuals_json_output_path
+        self.icr_output_dir = icr_output_dir
+        self.coded_dir_path = coded_dir_path
+        self.csv_by_message_output_path = csv_by_message_output_path
+        self.csv_by_individual_output_path = csv_by_individual_output_path
+        self.production_csv_output_path = production_csv_output_path
+        self.drive_upload_manifest_path = drive_upload_manifest_path
+        self.max_stage_workers = max_stage_workers
+        self.field_stats_output_path = field_stats_output_path
+        self.noise_cache_path = noise_cache_path
+
+    @classmethod
+    def from_output_dir(cls, user, pipeline_configuration, prev_coded_dir_path, output_dir, max_stage_workers=1):
+        """
+        Creates a LocationPipeline which writes its outputs to the standard file names in the given directory, using
+        the same layout as the `Outputs` directory written by run_scripts/3_generate_outputs.sh.
+        """
+        return cls(
+            user, pipeline_configuration, prev_coded_dir_path,
+            os.path.join(output_dir, "messages_traced_data.jsonl"),
+            os.path.join(output_dir, "individuals_traced_data.jsonl"),
+            os.path.join(output_dir, "ICR"),
+            os.path.join(output_dir, "Coda Files"),
+            os.path.join(output_dir, "messages.csv"),
+            os.path.join(output_dir, "individuals.csv"),
+            os.path.join(output_dir, "production.csv"),
+            os.path.join(output_dir, "drive_upload_manifest.json"),
+            max_stage_workers,
+            os.path.join(output_dir, "field_stats.json"),
+            os.path.join(output_dir, "noise_cache.json")
+        )
+
+    def set_rqa_coding_plans(self):
+        """
+        Sets PipelineConfiguration.RQA_CODING_PLANS to the plans for this location, inferred from the operator.
+
+        This 'hack' is necessary because the rqa coding plans are still not being set in the configuration json.
+        Because the plans are a class attribute, at most one location can be run in each process at a time.
+        """
+        if self.pipeline_configuration.filter_operator == "golis":
+            log.info("Running in Bossaso mode")
+            PipelineConfiguration.RQA_CODING_PLANS = PipelineConfiguration.BOSSASO_RQA_CODING_PLANS
+        else:
+            assert self.pipeline_configuration.filter_operator == "hormud", \
+                "FilterOperator must be either 'golis' or 'hormud'"
+            log.info("Running in Baidoa mode")
+            PipelineConfiguration.RQA_CODING_PLANS = PipelineConfiguration.BAIDOA_RQA_CODING_PLANS
+
+    def filter_operator(self, data):
+        if self.pipeline_configuration.filter_operator is not None:
+            data = MessageFilters.filter_operator(
+                data, "operator_coded",
+                CodeSchemes.SOMALIA_OPERATOR.get_code_with_match_value(self.pipeline_configuration.filter_operator)
+            )
+        return data
+
+    def translate_rapid_pro_keys(self, data):
+        log.info("Translating Rapid Pro Keys...")
+        return TranslateRapidProKeys.translate_rapid_pro_keys(self.user, data, self.pipeline_configuration,
+                                                              self.prev_coded_dir_path)
+
+    def move_wrong_scheme_messages(self, data):
+        log.info("Redirecting WS messages...")
+        return WSCorrection.move_wrong_scheme_messages(self.user, data, self.prev_coded_dir_path)
+
+    def auto_code_show_messages(self, data):
+        log.info("Auto Coding Messages...")
+        return AutoCodeShowMessages.auto_code_show_messages(self.user, data, self.pipeline_configuration,
+                                                            self.icr_output_dir, self.coded_dir_path,
+                                                            self.field_stats_output_path, self.max_stage_workers,
+                                                            self.noise_cache_path)
+
+    def generate_production_file(self, data):
+        log.info("Exporting production CSV...")
+        return ProductionFile.generate(data, self.production_csv_output_path)
+
+    def auto_code_surveys(self, data):
+        log.info("Auto Coding Surveys...")
+        return AutoCodeSurveys.auto_code_surveys(self.user, data, self.pipeline_configuration, self.coded_dir_path,
+                                                 self.max_stage_workers)
+
+    def apply_manual_codes(self, data):
+        log.info("Applying Manual Codes from Coda...")
+        return ApplyManualCodes.apply_manual_codes(self.user, data, self.prev_coded_dir_path)
+
+    def generate_analysis_files(self, data):
+        log.info("Generating Analysis CSVs...")
+        messages_data, individuals_data = AnalysisFile.generate(self.user, data, self.csv_by_message_output_path,
+                                                                self.csv_by_individual_output_path)
+
+        log.info("Writing messages TracedData to file...")
+        IOUtils.ensure_dirs_exist_for_file(self.messages_json_output_path)
+        with open(self.messages_json_output_path, "w") as f:
+            TracedDataJsonIO.export_traced_data_iterable_to_jsonl(messages_data, f)
+
+        log.info("Writing individuals TracedData to file...")
+        IOUtils.ensure_dirs_exist_for_file(self.individuals_json_output_path)
+        with open(self.individuals_json_output_path, "w") as f:
+            TracedDataJsonIO.export_traced_data_iterable_to_jsonl(individuals_data, f)
+
+        return messages_data, individuals_data
+
+    def build_stages(self, combine_raw_datasets_stage):
+        """
+        Builds the stages for this location. set_rqa_coding_plans must have been called first.
+
+        :param combine_raw_datasets_stage: Stage which outputs the combined raw data that this location's stages
+                                           should start from.
+        :type combine_raw_datasets_stage: src.lib.stage_graph.PipelineStage
+        :return: combine_raw_datasets_stage followed by the stages for this location.
+        :rtype: list of src.lib.stage_graph.PipelineStage
+        """
+        prev_coded_paths = [os.path.join(self.prev_coded_dir_path, plan.coda_filename) for plan in
+                            PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS]
+
+        return [
+            combine_raw_datasets_stage,
+            PipelineStage("filter_operator", self.filter_operator, [combine_raw_datasets_stage.name],
+                          cacheable=False),
+            PipelineStage("translate_rapid_pro_keys", self.translate_rapid_pro_keys, ["filter_operator"]),
+            PipelineStage("ws_correction", self.move_wrong_scheme_messages, ["translate_rapid_pro_keys"],
+                          input_paths=prev_coded_paths),
+            PipelineStage("auto_code_show_messages", self.auto_code_show_messages, ["ws_correction"],
+                          output_paths=[os.path.join(self.coded_dir_path, plan.coda_filename)
+                                        for plan in PipelineConfiguration.RQA_CODING_PLANS] +
+                                       [os.path.join(self.icr_output_dir, plan.icr_filename)
+                                        for plan in PipelineConfiguration.RQA_CODING_PLANS] +
+                                       ([] if self.field_stats_output_path is None
+                                        else [self.field_stats_output_path])),
+            PipelineStage("production_file", self.generate_production_file, ["auto_code_show_messages"],
+                          output_paths=[self.production_csv_output_path]),
+            PipelineStage("auto_code_surveys", self.auto_code_surveys, ["production_file"],
+                          output_paths=[os.path.join(self.coded_dir_path, plan.coda_filename)
+                                        for plan in PipelineConfiguration.SURVEY_CODING_PLANS]),
+            PipelineStage("apply_manual_codes", self.apply_manual_codes, ["auto_code_surveys"],
+                          input_paths=prev_coded_paths),
+            PipelineStage("analysis_file", self.generate_analysis_files, ["apply_manual_codes"], output_count=2,
+                          output_paths=[self.csv_by_message_output_path, self.csv_by_individual_output_path,
+                                        self.messages_json_output_path, self.individuals_json_output_path])
+        ]
+
+    def download_drive_credentials(self, google_cloud_credentials_file_path):
+        """
+        :return: The Google Drive service account credentials to upload this location's outputs with, or None if
+                 this location's pipeline configuration does not request a Drive upload.
+        :rtype: dict | None
+        """
+        if self.pipeline_configuration.drive_upload is None:
+            return None
+
+        log.info("Downloading Google Drive service account credentials...")
+        return json.loads(google_cloud_utils.download_blob_to_string(
+            google_cloud_credentials_file_path, self.pipeline_configuration.drive_upload.drive_credentials_file_url))
+
+    def upload_to_drive(self, upload_target, max_upload_workers=1):
+        """
+        Uploads this location's output files to Google Drive, if requested by the pipeline configuration.
+        Files which have not changed since they were last uploaded are skipped, if this location has a
+        drive_upload_manifest_path.
+
+        :param upload_target: Where to upload the files to e.g. a GoogleDriveUploadTarget created from the credentials
+                              returned by download_drive_credentials. May be None if the pipeline configuration does
+                              not request a Drive upload.
+        :type upload_target: src.lib.drive_uploader.GoogleDriveUploadTarget |
+                             src.lib.drive_uploader.LocalDirectoryUploadTarget | None
+        :param max_upload_workers: Maximum number of files to upload at once.
+        :type max_upload_workers: int
+        """
+        # Note: This should happen as late as possible in order to reduce the risk of the remainder of the pipeline
+        # failing after a Drive upload has occurred. Failures could result in inconsistent outputs or outputs with no
+        # traced data log.
+        if self.pipeline_configuration.drive_upload is None:
+            log.info("Skipping uploading to Google Drive (because the pipeline configuration json does not contain "
+                     "the key 'DriveUploadPaths')")
+            return
+
+        assert upload_target is not None, "The pipeline configuration requests a Drive upload, but no upload target " \
+                                          "was given"
+
+        log.info("Uploading CSVs to Google Drive...")
+        drive_upload = self.pipeline_configuration.drive_upload
+        DriveUploader(upload_target, self.drive_upload_manifest_path, max_upload_workers).upload([
+            (self.production_csv_output_path, drive_upload.production_upload_path),
+            (self.csv_by_message_output_path, drive_upload.messages_upload_path),
+            (self.csv_by_individual_output_path, drive_upload.individuals_upload_path),
+            (self.messages_json_output_path, drive_upload.messages_traced_data_upload_path),
+            (self.individuals_json_output_path, drive_upload.individuals_traced_data_upload_path)
+        ])
@@ -4,44 +4,17 @@ import pytz
 from core_data_modules.logging import Logger
 from core_data_modules.traced_data import Metadata
 from core_data_modules.util import TimeUtils
-from dateutil.parser import isoparse
 
 from src.lib import PipelineConfiguration
+from src.lib.timestamp_index import TimestampIndex
 
 log = Logger(__name__)
 
 
 class TranslateRapidProKeys(object):
-    @classmethod
-    def set_show_ids(cls, user, data, pipeline_configuration):
-        """
-        Sets a show pipeline key for each message, using the presence of Rapid Pro value keys to determine which
-        show each message belongs to.
-
-        :param user: Identifier of the user running this program, for TracedData Metadata.
-        :type user: str
-        :param data: TracedData objects to set the show ids of.
-        :type data: iterable of TracedData
-        :param pipeline_configuration: Pipeline configuration.
-        :type pipeline_configuration: PipelineConfiguration
-        """
-        for td in data:
-            show_dict = dict()
-
-            for remapping in pipeline_configuration.rapid_pro_key_remappings:
-                if not remapping.is_activation_message:
-                    continue
-
-                if td.get(remapping.rapid_pro_key) is not None:
-                    assert "rqa_message" not in show_dict
-                    show_dict["rqa_message"] = td[remapping.rapid_pro_key]
-                    show_dict["show_pipeline_key"] = remapping.pipeline_key
-
-            td.append_data(show_dict, Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
-
     @classmethod
     def _remap_radio_show_by_time_range(cls, user, data, time_key, show_pipeline_key_to_remap_to,
-                                        range_start=None, range_end=None, time_to_adjust_to=None):
+                                        range_start=None, range_end=None, time_to_adjust_to=None, time_index=None):
         """
         Remaps radio show messages received in the given time range to another radio show.
 
@@ -65,6 +38,10 @@ class TranslateRapidProKeys(object):
         :param time_to_adjust_to: Datetime to assign to the 'sent_on' field of re-mapped shows.
                                   If None, re-mapped shows will not have timestamps re-adjusted.
         :type time_to_adjust_to: datetime | None
+        :param time_index: Index of data on time_key, to share one index between several remaps of the same data.
+                           The index is not updated by a remap, so an index must not be shared with a later remap
+                           after a remap which adjusts the times. If None, an index is built.
+        :type time_index: TimestampIndex | None
         """
         if range_start is None:
             range_start = pytz.utc.localize(datetime.min)
@@ -74,19 +51,24 @@ class TranslateRapidProKeys(object):
         log.info(f"Remapping messages in time range {range_start.isoformat()} to {range_end.isoformat()} "
                  f"to show {show_pipeline_key_to_remap_to}...")
 
+        data = list(data)
+        if time_index is None:
+            time_index = TimestampIndex(data, time_key)
+        assert time_index.time_key == time_key
+
         remapped_count = 0
-        for td in data:
-            if time_key in td and range_start <= isoparse(td[time_key]) < range_end:
-                remapped_count += 1
+        for i in time_index.select_range(range_start, range_end):
+            td = data[i]
+            remapped_count += 1
 
-                remapped = {
-                    "show_pipeline_key": show_pipeline_key_to_remap_to
-                }
-                if time_to_adjust_to is not None:
-                    remapped[time_key] = time_to_adjust_to.isoformat()
+            remapped = {
+                "show_pipeline_key": show_pipeline_key_to_remap_to
+            }
+            if time_to_adjust_to is not None:
+                remapped[time_key] = time_to_adjust_to.isoformat()
 
-                td.append_data(remapped,
-                               Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+            td.append_data(remapped,
+                           Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
 
         log.info(f"Remapped {remapped_count} messages to show {show_pipeline_key_to_remap_to}")
 
@@ -107,68 +89,94 @@ class TranslateRapidProKeys(object):
         pass
 
     @classmethod
-    def remap_key_names(cls, user, data, pipeline_configuration):
+    def set_show_ids(cls, user, data, pipeline_configuration):
         """
-        Remaps key names.
-        
+        Sets 'rqa_message' and 'show_pipeline_key' for each message, using the presence of Rapid Pro activation
+        message keys to determine which show each message belongs to.
+
         :param user: Identifier of the user running this program, for TracedData Metadata.
         :type user: str
-        :param data: TracedData objects to remap the key names of.
+        :param data: TracedData objects to set the show ids of.
         :type data: iterable of TracedData
         :param pipeline_configuration: Pipeline configuration.
         :type pipeline_configuration: PipelineConfiguration
         """
-        for td in data:
-            remapped = dict()
-               
-            for remapping in pipeline_configuration.rapid_pro_key_remappings:
-                if remapping.is_activation_message:
-                    continue
+        activation_message_remappings = pipeline_configuration.activation_message_remappings
 
-                old_key = remapping.rapid_pro_key
-                new_key = remapping.pipeline_key
-                
-                if old_key in td and new_key not in td:
-                    remapped[new_key] = td[old_key]
+        metadata = Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
+        for td in data:
+            show_dict = dict()
+            for key in td.keys():
+                if key in activation_message_remappings and td[key] is not None:
+                    assert "rqa_message" not in show_dict
+                    show_dict["rqa_message"] = td[key]
+                    show_dict["show_pipeline_key"] = activation_message_remappings[key]
 
-            td.append_data(remapped, Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+            if len(show_dict) > 0:
+                td.append_data(show_dict, metadata)
 
     @classmethod
-    def set_rqa_raw_keys_from_show_ids(cls, user, data):
+    def translate_message_keys(cls, user, data, pipeline_configuration):
         """
-        Despite the earlier phases of this pipeline stage using a common 'rqa_message' field and then a
-        'show_pipeline_key' field to identify which radio show a message belonged to, the rest of the pipeline still
-        uses the presence of a raw field for each show to determine which show a message belongs to.
-        This function translates from the new 'show_id' method back to the old 'raw field presence` method.
-        
+        Translates the Rapid Pro keys in each message to the keys used by the rest of the pipeline, updating each
+        message with a single append_data and a single hide_keys. The show ids must already have been set by
+        set_show_ids.
+
+        For each message, this:
+         - Remaps the Rapid Pro keys to their pipeline keys, where the pipeline key isn't already set.
+           Where more than one of a message's Rapid Pro keys remap to the same pipeline key, the last remapping in the
+           pipeline configuration is used.
+         - Sets the raw field of the message's show to the 'rqa_message'. Despite using 'show_pipeline_key' to
+           identify which radio show a message belongs to, the rest of the pipeline still uses the presence of a raw
+           field for each show.
+         - Hides the raw and time fields of coding plans whose raw field is null. Some Text inputs in Rapid Pro can be
+           null. We don't know why, but there's no useful messages in those cases so hide (which means the rest of the
+           pipeline will treat those as NA).
+
         TODO: Update the rest of the pipeline to use show_ids, and/or perform remapping before combining the datasets.
 
         :param user: Identifier of the user running this program, for TracedData Metadata.
         :type user: str
-        :param data: TracedData objects to set raw radio show message fields for.
+        :param data: TracedData objects to translate the keys of.
         :type data: iterable of TracedData
+        :param pipeline_configuration: Pipeline configuration.
+        :type pipeline_configuration: PipelineConfiguration
         """
-        for td in data:
-            if "show_pipeline_key" in td:
-                td.append_data({td["show_pipeline_key"]: td["rqa_message"]},
-                               Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+        key_remappings = pipeline_configuration.key_remappings
 
-    @classmethod
-    def hide_null_messages(cls, user, data):
-        """
-        Hides messages which were null in Rapid Pro.
+        null_message_keys = dict()  # of raw field -> keys to hide if that raw field is null
+        for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS:
+            if plan.raw_field not in null_message_keys:
+                null_message_keys[plan.raw_field] = set()
+            null_message_keys[plan.raw_field].update({plan.raw_field, plan.time_field})
 
-        :param user: Identifier of the user running this program, for TracedData Metadata.
-        :type user: str
-        :param data: TracedData objects to search for null messages in and hide.
-        :type data: iterable of TracedData
-        """
+        metadata = Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
         for td in data:
+            matched_remappings = []  # of (index of the remapping, Rapid Pro key, pipeline key)
+            for key in td.keys():
+                for i, pipeline_key in key_remappings.get(key, []):
+                    matched_remappings.append((i, key, pipeline_key))
+
+            translated = dict()
+            for _, rapid_pro_key, pipeline_key in sorted(matched_remappings):
+                if pipeline_key not in td:
+                    translated[pipeline_key] = td[rapid_pro_key]
+
+            def get_translated_value(key):
+                return translated[key] if key in translated else td[key]
+
+            if "show_pipeline_key" in translated or "show_pipeline_key" in td:
+                translated[get_translated_value("show_pipeline_key")] = get_translated_value("rqa_message")
+
             null_keys = set()
-            for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS:
-                if plan.raw_field in td and td[plan.raw_field] is None:
-                    null_keys.update({plan.raw_field, plan.time_field})
-            td.hide_keys(null_keys, Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+            for raw_field, keys in null_message_keys.items():
+                if (raw_field in translated or raw_field in td) and get_translated_value(raw_field) is None:
+                    null_keys.update(keys)
+
+            if len(translated) > 0:
+                td.append_data(translated, metadata)
+            if len(null_keys) > 0:
+                td.hide_keys(null_keys, metadata)
 
     @classmethod
     def translate_rapid_pro_keys(cls, user, data, pipeline_configuration, coda_input_dir):
@@ -187,14 +195,7 @@ class TranslateRapidProKeys(object):
         # Move rqa messages which ended up in the wrong flow to the correct one.
         cls.remap_radio_shows(user, data, coda_input_dir)
 
-        # Remap the keys used by Rapid Pro to more usable key names that will be used by the rest of the pipeline.
-        cls.remap_key_names(user, data, pipeline_configuration)
-
-        # Convert from the new show key format to the raw field format still used by the rest of the pipeline.
-        cls.set_rqa_raw_keys_from_show_ids(user, data)
-
-        # Some Text inputs in Rapid Pro can be null. We don't know why, but there's no useful messages in those
-        # cases so hide (which means the rest of the pipeline will treat those as NA).
-        cls.hide_null_messages(user, data)
+        # Translate the remaining keys of each message in a single pass.
+        cls.translate_message_keys(user, data, pipeline_configuration)
 
         return data
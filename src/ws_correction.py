@@ -3,10 +3,11 @@ import time
 from core_data_modules.cleaners import Codes
 from core_data_modules.cleaners.cleaning_utils import CleaningUtils
 from core_data_modules.logging import Logger
-from core_data_modules.traced_data import Metadata
+from core_data_modules.traced_data import Metadata, TracedData
 from core_data_modules.traced_data.io import TracedDataCodaV2IO
 
 from src.lib import PipelineConfiguration
+from src.lib.coda_dataset_cache import CodaDatasetCache
 from src.lib.pipeline_configuration import CodeSchemes, CodingModes
 
 log = Logger(__name__)
@@ -19,160 +20,154 @@ class _WSUpdate(object):
         self.source = source
 
 
-class WSCorrection(object):
-    @staticmethod
-    def move_wrong_scheme_messages(user, data, coda_input_dir):
-        log.info("Importing manually coded Coda files to '_WS' fields...")
-        for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS:
-            TracedDataCodaV2IO.compute_message_ids(user, data, plan.raw_field, f"{plan.id_field}_WS")
-            with open(f"{coda_input_dir}/{plan.coda_filename}") as f:
-                TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable(
-                    user, data, f"{plan.id_field}_WS",
-                    {f"{plan.raw_field}_WS_correct_dataset": CodeSchemes.WS_CORRECT_DATASET}, f
-                )
+class _WSPlanTables(object):
+    """
+    Lookup tables of the coding plans' fields and of the 'WS - Correct Dataset' codes, for the WS correction.
 
-            for cc in plan.coding_configurations:
-                with open(f"{coda_input_dir}/{plan.coda_filename}") as f:
-                    if cc.coding_mode == CodingModes.SINGLE:
-                        TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable(
-                            user, data, plan.id_field + "_WS",
-                            {f"{cc.coded_field}_WS": cc.code_scheme}, f
-                        )
-                    else:
-                        assert cc.coding_mode == CodingModes.MULTIPLE
-                        TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable_multi_coded(
-                            user, data, f"{plan.id_field}_WS",
-                            {f"{cc.coded_field}_WS": cc.code_scheme}, f
-                        )
+    These are computed once per run rather than once per uid.
+    """
+    def __init__(self, survey_plans, rqa_plans, ws_code_to_raw_field_map, ws_codes):
+        """
+        :param survey_plans: (raw field, time field, 'WS - Correct Dataset' field) for each survey coding plan.
+        :type survey_plans: list of (str, str, str)
+        :param rqa_plans: (raw field, time field, 'WS - Correct Dataset' field) for each RQA coding plan.
+        :type rqa_plans: list of (str, str, str)
+        :param ws_code_to_raw_field_map: Map from WS normal code id to the raw field that code indicates a requested
+                                         move to.
+        :type ws_code_to_raw_field_map: dict of str -> str
+        :param ws_codes: Map from each 'WS - Correct Dataset' code id to its (code type, display text).
+        :type ws_codes: dict of str -> (str, str)
+        """
+        self.survey_plans = survey_plans
+        self.rqa_plans = rqa_plans
+        self.ws_code_to_raw_field_map = ws_code_to_raw_field_map
+        self.ws_codes = ws_codes
 
-        log.info("Checking for WS Coding Errors...")
-        # Check for coding errors
-        for td in data:
-            for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS:
-                rqa_codes = []
-                for cc in plan.coding_configurations:
-                    if cc.coding_mode == CodingModes.SINGLE:
-                        if f"{cc.coded_field}_WS" in td:
-                            label = td[f"{cc.coded_field}_WS"]
-                            rqa_codes.append(cc.code_scheme.get_code_with_id(label["CodeID"]))
-                    else:
-                        assert cc.coding_mode == CodingModes.MULTIPLE
-                        for label in td.get(f"{cc.coded_field}_WS", []):
-                            rqa_codes.append(cc.code_scheme.get_code_with_id(label["CodeID"]))
-
-                has_ws_code_in_code_scheme = False
-                for code in rqa_codes:
-                    if code.control_code == Codes.WRONG_SCHEME:
-                        has_ws_code_in_code_scheme = True
-
-                has_ws_code_in_ws_scheme = False
-                if f"{plan.raw_field}_WS_correct_dataset" in td:
-                    has_ws_code_in_ws_scheme = CodeSchemes.WS_CORRECT_DATASET.get_code_with_id(
-                        td[f"{plan.raw_field}_WS_correct_dataset"]["CodeID"]).code_type == "Normal"
-
-                if has_ws_code_in_code_scheme != has_ws_code_in_ws_scheme:
-                    log.warning(f"Coding Error: {plan.raw_field}: {td[plan.raw_field]}")
-                    coding_error_dict = {
-                        f"{plan.raw_field}_WS_correct_dataset":
-                            CleaningUtils.make_label_from_cleaner_code(
-                                CodeSchemes.WS_CORRECT_DATASET,
-                                CodeSchemes.WS_CORRECT_DATASET.get_code_with_control_code(Codes.CODING_ERROR),
-                                Metadata.get_call_location(),
-                            ).to_dict()
-                    }
-                    td.append_data(coding_error_dict, Metadata(user, Metadata.get_call_location(), time.time()))
+        self.plans = survey_plans + rqa_plans
+        self.raw_survey_fields = {raw_field for raw_field, _, _ in survey_plans}
+        self.raw_rqa_fields = {raw_field for raw_field, _, _ in rqa_plans}
+        self.time_fields_by_raw_field = dict()  # of raw field -> list of time field, in survey then RQA plan order
+        for raw_field, time_field, _ in self.plans:
+            if raw_field not in self.time_fields_by_raw_field:
+                self.time_fields_by_raw_field[raw_field] = []
+            self.time_fields_by_raw_field[raw_field].append(time_field)
 
+    @classmethod
+    def from_pipeline_configuration(cls):
         # Construct a map from WS normal code id to the raw field that code indicates a requested move to.
         ws_code_to_raw_field_map = dict()
         for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS:
             if plan.ws_code is not None:
                 ws_code_to_raw_field_map[plan.ws_code.code_id] = plan.raw_field
 
-        # Group the TracedData by uid.
-        data_grouped_by_uid = dict()
-        for td in data:
-            uid = td["uid"]
-            if uid not in data_grouped_by_uid:
-                data_grouped_by_uid[uid] = []
-            data_grouped_by_uid[uid].append(td)
+        return cls(
+            [(plan.raw_field, plan.time_field, f"{plan.raw_field}_WS_correct_dataset")
+             for plan in PipelineConfiguration.SURVEY_CODING_PLANS],
+            [(plan.raw_field, plan.time_field, f"{plan.raw_field}_WS_correct_dataset")
+             for plan in PipelineConfiguration.RQA_CODING_PLANS],
+            ws_code_to_raw_field_map,
+            {code.code_id: (code.code_type, code.display_text) for code in CodeSchemes.WS_CORRECT_DATASET.codes}
+        )
 
-        # Perform the WS correction for each uid.
-        log.info("Performing WS correction...")
-        corrected_data = []  # List of TracedData with the WS data moved.
-        unknown_target_code_counts = dict()  # 'WS - Correct Dataset' codes with no matching code id in any coding plan
-                                             # for this project, with a count of the ogcurrences.
-        for group in data_grouped_by_uid.values():
+
+class WSCorrection(object):
+    @staticmethod
+    def _get_move(ws_code_id, plan_tables, unknown_target_code_counts):
+        """
+        :return: Whether a message coded with the given 'WS - Correct Dataset' code id is moving, and the raw field it
+                 is moving to (None if the code doesn't match any coding plan).
+        :rtype: (bool, str | None)
+        """
+        code_type, display_text = plan_tables.ws_codes[ws_code_id]
+        if code_type != "Normal":
+            return False, None
+
+        if ws_code_id in plan_tables.ws_code_to_raw_field_map:
+            return True, plan_tables.ws_code_to_raw_field_map[ws_code_id]
+
+        if (ws_code_id, display_text) not in unknown_target_code_counts:
+            unknown_target_code_counts[(ws_code_id, display_text)] = 0
+        unknown_target_code_counts[(ws_code_id, display_text)] += 1
+        return True, None
+
+    @staticmethod
+    def _plan_uid_group_corrections(groups, plan_tables):
+        """
+        Computes the moves of the WS messages of each of the given uids to the fields they were coded as belonging to.
+
+        :param groups: The TracedData of each uid to correct.
+        :type groups: list of (list of TracedData)
+        :param plan_tables: Lookup tables for the coding plans.
+        :type plan_tables: _WSPlanTables
+        :return: For each group, the survey updates to make to the last item in that group (a dict of key -> new value,
+                 where None means the key is to be hidden) and the rqa data of each message to derive from that item,
+                 plus the number of occurrences of each (code id, display text) 'WS - Correct Dataset' code with no
+                 matching code id in any coding plan for this project.
+        :rtype: (list of (dict, list of dict), dict of (str, str) -> int)
+        """
+        corrections = []
+        unknown_target_code_counts = dict()
+        for group in groups:
             # Find all the surveys data being moved.
             # (Note: we only need to check one td in this group because all the demographics are the same)
             td = group[0]
             survey_moves = dict()  # of source_field -> target_field
-            for plan in PipelineConfiguration.SURVEY_CODING_PLANS:
-                if plan.raw_field not in td:
+            for raw_field, _, ws_correct_dataset_field in plan_tables.survey_plans:
+                if raw_field not in td:
                     continue
-                ws_code = CodeSchemes.WS_CORRECT_DATASET.get_code_with_id(td[f"{plan.raw_field}_WS_correct_dataset"]["CodeID"])
-                if ws_code.code_type == "Normal":
-                    if ws_code.code_id in ws_code_to_raw_field_map:
-                        survey_moves[plan.raw_field] = ws_code_to_raw_field_map[ws_code.code_id]
-                    else:
-                        if (ws_code.code_id, ws_code.display_text) not in unknown_target_code_counts:
-                            unknown_target_code_counts[(ws_code.code_id, ws_code.display_text)] = 0
-                        unknown_target_code_counts[(ws_code.code_id, ws_code.display_text)] += 1
-                        survey_moves[plan.raw_field] = None
+                is_moving, target_field = WSCorrection._get_move(
+                    td[ws_correct_dataset_field]["CodeID"], plan_tables, unknown_target_code_counts)
+                if is_moving:
+                    survey_moves[raw_field] = target_field
 
             # Find all the RQA data being moved.
             rqa_moves = dict()  # of (index in group, source_field) -> target_field
             for i, td in enumerate(group):
-                for plan in PipelineConfiguration.RQA_CODING_PLANS:
-                    if plan.raw_field not in td:
+                for raw_field, _, ws_correct_dataset_field in plan_tables.rqa_plans:
+                    if raw_field not in td:
                         continue
-                    ws_code = CodeSchemes.WS_CORRECT_DATASET.get_code_with_id(td[f"{plan.raw_field}_WS_correct_dataset"]["CodeID"])
-                    if ws_code.code_type == "Normal":
-                        if ws_code.code_id in ws_code_to_raw_field_map:
-                            rqa_moves[(i, plan.raw_field)] = ws_code_to_raw_field_map[ws_code.code_id]
-                        else:
-                            if (ws_code.code_id, ws_code.display_text) not in unknown_target_code_counts:
-                                unknown_target_code_counts[(ws_code.code_id, ws_code.display_text)] = 0
-                            unknown_target_code_counts[(ws_code.code_id, ws_code.display_text)] += 1
-                            rqa_moves[(i, plan.raw_field)] = None
+                    is_moving, target_field = WSCorrection._get_move(
+                        td[ws_correct_dataset_field]["CodeID"], plan_tables, unknown_target_code_counts)
+                    if is_moving:
+                        rqa_moves[(i, raw_field)] = target_field
 
             # Build a dictionary of the survey fields that haven't been moved, and cleared fields for those which have.
             survey_updates = dict()  # of raw_field -> updated value
-            for plan in PipelineConfiguration.SURVEY_CODING_PLANS:
-                if plan.raw_field in survey_moves.keys():
+            for raw_field, time_field, _ in plan_tables.survey_plans:
+                if raw_field in survey_moves.keys():
                     # Data is moving
-                    survey_updates[plan.raw_field] = []
-                elif plan.raw_field in td:
+                    survey_updates[raw_field] = []
+                elif raw_field in td:
                     # Data is not moving
-                    survey_updates[plan.raw_field] = [_WSUpdate(td[plan.raw_field], td[plan.time_field], plan.raw_field)]
+                    survey_updates[raw_field] = [_WSUpdate(td[raw_field], td[time_field], raw_field)]
 
             # Build a list of the rqa fields that haven't been moved.
             rqa_updates = []  # of (field, value)
             for i, td in enumerate(group):
-                for plan in PipelineConfiguration.RQA_CODING_PLANS:
-                    if plan.raw_field in td:
-                        if (i, plan.raw_field) in rqa_moves.keys():
+                for raw_field, time_field, _ in plan_tables.rqa_plans:
+                    if raw_field in td:
+                        if (i, raw_field) in rqa_moves.keys():
                             # Data is moving
                             pass
                         else:
                             # Data is not moving
-                            rqa_updates.append((plan.raw_field, _WSUpdate(td[plan.raw_field], td[plan.time_field], plan.raw_field)))
+                            rqa_updates.append((raw_field, _WSUpdate(td[raw_field], td[time_field], raw_field)))
 
             # Add data moving from survey fields to the relevant survey_/rqa_updates
-            raw_survey_fields = {plan.raw_field for plan in PipelineConfiguration.SURVEY_CODING_PLANS}
-            raw_rqa_fields = {plan.raw_field for plan in PipelineConfiguration.RQA_CODING_PLANS}
-            for plan in PipelineConfiguration.SURVEY_CODING_PLANS + PipelineConfiguration.RQA_CODING_PLANS:
-                if plan.raw_field not in survey_moves:
+            for raw_field, time_field, _ in plan_tables.plans:
+                if raw_field not in survey_moves:
                     continue
-                    
-                target_field = survey_moves[plan.raw_field]
+
+                target_field = survey_moves[raw_field]
                 if target_field is None:
                     continue
-                    
-                update = _WSUpdate(td[plan.raw_field], td[plan.time_field], plan.raw_field)
-                if target_field in raw_survey_fields:
+
+                update = _WSUpdate(td[raw_field], td[time_field], raw_field)
+                if target_field in plan_tables.raw_survey_fields:
                     survey_updates[target_field] = survey_updates.get(target_field, []) + [update]
                 else:
-                    assert target_field in raw_rqa_fields, f"Raw field '{target_field}' not in any coding plan"
+                    assert target_field in plan_tables.raw_rqa_fields, \
+                        f"Raw field '{target_field}' not in any coding plan"
                     rqa_updates.append((target_field, update))
 
             # Add data moving from RQA fields to the relevant survey_/rqa_updates
@@ -180,30 +175,62 @@ class WSCorrection(object):
                 if target_field is None:
                     continue
 
-                for plan in PipelineConfiguration.SURVEY_CODING_PLANS + PipelineConfiguration.RQA_CODING_PLANS:
-                    if plan.raw_field == source_field:
-                        _td = group[i]
-                        update = _WSUpdate(_td[plan.raw_field], _td[plan.time_field], plan.raw_field)
-                        if target_field in raw_survey_fields:
-                            survey_updates[target_field] = survey_updates.get(target_field, []) + [update]
-                        else:
-                            assert target_field in raw_rqa_fields, f"Raw field '{target_field}' not in any coding plan"
-                            rqa_updates.append((target_field, update))
+                _td = group[i]
+                for time_field in plan_tables.time_fields_by_raw_field[source_field]:
+                    update = _WSUpdate(_td[source_field], _td[time_field], source_field)
+                    if target_field in plan_tables.raw_survey_fields:
+                        survey_updates[target_field] = survey_updates.get(target_field, []) + [update]
+                    else:
+                        assert target_field in plan_tables.raw_rqa_fields, \
+                            f"Raw field '{target_field}' not in any coding plan"
+                        rqa_updates.append((target_field, update))
 
             # Re-format the survey updates to a form suitable for use by the rest of the pipeline
             flattened_survey_updates = {}
-            for plan in PipelineConfiguration.SURVEY_CODING_PLANS:
-                if plan.raw_field in survey_updates:
-                    plan_updates = survey_updates[plan.raw_field]
+            for raw_field, time_field, _ in plan_tables.survey_plans:
+                if raw_field in survey_updates:
+                    plan_updates = survey_updates[raw_field]
 
                     if len(plan_updates) > 0:
-                        flattened_survey_updates[plan.raw_field] = "; ".join([u.message for u in plan_updates])
-                        flattened_survey_updates[plan.time_field] = sorted([u.sent_on for u in plan_updates])[0]
-                        flattened_survey_updates[f"{plan.raw_field}_source"] = "; ".join([u.source for u in plan_updates])
+                        flattened_survey_updates[raw_field] = "; ".join([u.message for u in plan_updates])
+                        flattened_survey_updates[time_field] = sorted([u.sent_on for u in plan_updates])[0]
+                        flattened_survey_updates[f"{raw_field}_source"] = "; ".join([u.source for u in plan_updates])
                     else:
-                        flattened_survey_updates[plan.raw_field] = None
-                        flattened_survey_updates[plan.time_field] = None
-                        flattened_survey_updates[f"{plan.raw_field}_source"] = None
+                        flattened_survey_updates[raw_field] = None
+                        flattened_survey_updates[time_field] = None
+                        flattened_survey_updates[f"{raw_field}_source"] = None
+
+            rqa_dicts = [
+                {
+                    target_field: update.message,
+                    "sent_on": update.sent_on,
+                    f"{target_field}_source": update.source
+                }
+                for target_field, update in rqa_updates
+            ]
+            corrections.append((flattened_survey_updates, rqa_dicts))
+
+        return corrections, unknown_target_code_counts
+
+    @staticmethod
+    def _apply_uid_group_corrections(user, groups, corrections, plan_tables):
+        """
+        Applies the corrections computed by _plan_uid_group_corrections to the TracedData of each uid.
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param groups: The TracedData of each uid to correct.
+        :type groups: list of (list of TracedData)
+        :param corrections: The corrections for each group, as returned by _plan_uid_group_corrections.
+        :type corrections: list of (dict, list of dict)
+        :param plan_tables: Lookup tables for the coding plans.
+        :type plan_tables: _WSPlanTables
+        :return: The TracedData with the WS data moved.
+        :rtype: list of TracedData
+        """
+        corrected_data = []  # List of TracedData with the WS data moved.
+        for group, (flattened_survey_updates, rqa_dicts) in zip(groups, corrections):
+            td = group[-1]
 
             # Hide the survey keys currently in the TracedData which have had data moved away.
             td.hide_keys({k for k, v in flattened_survey_updates.items() if v is None}.intersection(td.keys()),
@@ -214,22 +241,115 @@ class WSCorrection(object):
                            Metadata(user, Metadata.get_call_location(), time.time()))
 
             # Hide all the RQA fields (they will be added back, in turn, in the next step).
-            td.hide_keys({plan.raw_field for plan in PipelineConfiguration.RQA_CODING_PLANS}.intersection(td.keys()),
+            td.hide_keys(plan_tables.raw_rqa_fields.intersection(td.keys()),
                          Metadata(user, Metadata.get_call_location(), time.time()))
 
-            # For each rqa message, create a copy of this td, append the rqa message, and add this to the
-            # list of TracedData.
-            for target_field, update in rqa_updates:
-                rqa_dict = {
-                    target_field: update.message,
-                    "sent_on": update.sent_on,
-                    f"{target_field}_source": update.source
-                }
-
-                corrected_td = td.copy()
+            # For each rqa message, derive a new TracedData from this td, append the rqa message, and add this to
+            # the list of TracedData.
+            # The derived TracedData reference this td via append_traced_data rather than being copies of it, so the
+            # participant's history is shared by all of their messages, and each message only stores its own updates.
+            # This td is not updated after this point, so the updates made to each message later in the pipeline
+            # are only applied to that message.
+            for rqa_dict in rqa_dicts:
+                corrected_td = TracedData(dict(), Metadata(user, Metadata.get_call_location(), time.time()))
+                corrected_td.append_traced_data("ws_correction_source", td,
+                                                Metadata(user, Metadata.get_call_location(), time.time()))
                 corrected_td.append_data(rqa_dict, Metadata(user, Metadata.get_call_location(), time.time()))
                 corrected_data.append(corrected_td)
 
+        return corrected_data
+
+    @staticmethod
+    def move_wrong_scheme_messages(user, data, coda_input_dir):
+        """
+        Imports the manually coded WS labels from Coda, and moves each message coded as being in the wrong scheme
+        to the field it was coded as belonging to.
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param data: TracedData objects to correct.
+        :type data: iterable of TracedData
+        :param coda_input_dir: Directory containing the manually coded Coda files.
+        :type coda_input_dir: str
+        :return: The TracedData with the WS data moved.
+        :rtype: list of TracedData
+        """
+        log.info("Importing manually coded Coda files to '_WS' fields...")
+        for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS:
+            TracedDataCodaV2IO.compute_message_ids(user, data, plan.raw_field, f"{plan.id_field}_WS")
+            coda_input_path = f"{coda_input_dir}/{plan.coda_filename}"
+            TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable(
+                user, data, f"{plan.id_field}_WS",
+                {f"{plan.raw_field}_WS_correct_dataset": CodeSchemes.WS_CORRECT_DATASET},
+                CodaDatasetCache.open_for_schemes(coda_input_path, [CodeSchemes.WS_CORRECT_DATASET])
+            )
+
+            for cc in plan.coding_configurations:
+                f = CodaDatasetCache.open_for_schemes(coda_input_path, [cc.code_scheme])
+                if cc.coding_mode == CodingModes.SINGLE:
+                    TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable(
+                        user, data, plan.id_field + "_WS",
+                        {f"{cc.coded_field}_WS": cc.code_scheme}, f
+                    )
+                else:
+                    assert cc.coding_mode == CodingModes.MULTIPLE
+                    TracedDataCodaV2IO.import_coda_2_to_traced_data_iterable_multi_coded(
+                        user, data, f"{plan.id_field}_WS",
+                        {f"{cc.coded_field}_WS": cc.code_scheme}, f
+                    )
+
+        log.info("Checking for WS Coding Errors...")
+        # Check for coding errors
+        for td in data:
+            for plan in PipelineConfiguration.RQA_CODING_PLANS + PipelineConfiguration.SURVEY_CODING_PLANS:
+                rqa_codes = []
+                for cc in plan.coding_configurations:
+                    if cc.coding_mode == CodingModes.SINGLE:
+                        if f"{cc.coded_field}_WS" in td:
+                            label = td[f"{cc.coded_field}_WS"]
+                            rqa_codes.append(cc.code_scheme.get_code_with_id(label["CodeID"]))
+                    else:
+                        assert cc.coding_mode == CodingModes.MULTIPLE
+                        for label in td.get(f"{cc.coded_field}_WS", []):
+                            rqa_codes.append(cc.code_scheme.get_code_with_id(label["CodeID"]))
+
+                has_ws_code_in_code_scheme = False
+                for code in rqa_codes:
+                    if code.control_code == Codes.WRONG_SCHEME:
+                        has_ws_code_in_code_scheme = True
+
+                has_ws_code_in_ws_scheme = False
+                if f"{plan.raw_field}_WS_correct_dataset" in td:
+                    has_ws_code_in_ws_scheme = CodeSchemes.WS_CORRECT_DATASET.get_code_with_id(
+                        td[f"{plan.raw_field}_WS_correct_dataset"]["CodeID"]).code_type == "Normal"
+
+                if has_ws_code_in_code_scheme != has_ws_code_in_ws_scheme:
+                    log.warning(f"Coding Error: {plan.raw_field}: {td[plan.raw_field]}")
+                    coding_error_dict = {
+                        f"{plan.raw_field}_WS_correct_dataset":
+                            CleaningUtils.make_label_from_cleaner_code(
+                                CodeSchemes.WS_CORRECT_DATASET,
+                                CodeSchemes.WS_CORRECT_DATASET.get_code_with_control_code(Codes.CODING_ERROR),
+                                Metadata.get_call_location(),
+                            ).to_dict()
+                    }
+                    td.append_data(coding_error_dict, Metadata(user, Metadata.get_call_location(), time.time()))
+
+        # Group the TracedData by uid.
+        data_grouped_by_uid = dict()
+        for td in data:
+            uid = td["uid"]
+            if uid not in data_grouped_by_uid:
+                data_grouped_by_uid[uid] = []
+            data_grouped_by_uid[uid].append(td)
+        groups = list(data_grouped_by_uid.values())
+
+        # Perform the WS correction for each uid.
+        log.info("Performing WS correction...")
+        plan_tables = _WSPlanTables.from_pipeline_configuration()
+        corrections, unknown_target_code_counts = WSCorrection._plan_uid_group_corrections(groups, plan_tables)
+        corrected_data = WSCorrection._apply_uid_group_corrections(user, groups, corrections, plan_tables)
+
         if len(unknown_target_code_counts) > 0:
             log.warning("Found the following 'WS - Correct Dataset' CodeIDs with no matching coding plan:")
             for (code_id, display_text), count in unknown_target_code_counts.items():